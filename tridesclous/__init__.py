@@ -3,10 +3,17 @@ from .dataio import DataIO
 from .tools import *
 from .peakdetector import *
 from .waveformextractor import *
-from .clustering import Clustering
-from .peeler import Peeler
+from .editlog import EditLog
+from .catalogue import complete_catalogue, save_catalogue, load_catalogue, make_shifted_bank, make_low_rank, make_channel_index, update_centers
+from .spiketable import spike_dtype, make_spikes, SpikeTable
+from .peaktable import PeakTable
+from .clustering import Clustering, find_clusters, clustering_engines
+from .templatematching import TemplateMatcher
+from .peeler import Peeler, StreamingPeeler, peel_chunk, peel_signals
+from .online import RingBuffer, OnlinePeeler
 
 from .spikesorter import SpikeSorter
+from .pipeline import Pipeline
 
 from .mpl_plot import *
 
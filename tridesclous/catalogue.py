@@ -0,0 +1,257 @@
+import numpy as np
+import scipy.signal
+
+
+"""
+Catalogue handling.
+
+A catalogue is a dict of np.array (see Clustering.construct_catalogue):
+    * 'cluster_labels' : shape (nb_cluster,)
+    * 'center', 'centerD', 'centerDD', 'mad' : shape (nb_cluster, nb_channel*width)
+    * 'limit_left', 'limit_right', 'nb_channel' : scalar
+and constants precomputed for the Peeler (see complete_catalogue).
+Optionally a bank of sub sample shifted templates (see make_shifted_bank)
+and a low rank approximation of templates (see make_low_rank)
+and candidate clusters by channel (see make_channel_index).
+Centers can be moved during a long recording to follow a drift (see update_centers).
+
+On disk a catalogue is one npz file (not compressed) with all these arrays
+stacked so it can be loaded in a few milliseconds and applied to many
+recordings without clustering again.
+
+"""
+
+# version of the on disk format, increment this when keys change
+catalogue_version = 1
+
+
+# keys added by complete_catalogue
+peeler_constants = ['center_norm2', 'centerD_norm2', 'centerDD_norm2',
+            'center_dot_centerD', 'center_dot_centerDD', 'centerD_dot_centerDD']
+
+
+def complete_catalogue(catalogue):
+    """
+    Add to the catalogue (inplace) constants used by the Peeler that
+    only depend on the catalogue:
+        * 'center_norm2' : |center|^2
+        * 'centerD_norm2' : |centerD|^2
+        * 'centerDD_norm2' : |centerDD|^2
+        * 'center_dot_centerD' : <center, centerD>
+        * 'center_dot_centerDD' : <center, centerDD>
+        * 'centerD_dot_centerDD' : <centerD, centerDD>
+
+    Returns
+    ----------
+    catalogue: dict
+        The same dict.
+    """
+    center, centerD, centerDD = catalogue['center'], catalogue['centerD'], catalogue['centerDD']
+    catalogue['center_norm2'] = np.sum(center**2, axis=1)
+    catalogue['centerD_norm2'] = np.sum(centerD**2, axis=1)
+    catalogue['centerDD_norm2'] = np.sum(centerDD**2, axis=1)
+    catalogue['center_dot_centerD'] = np.sum(center*centerD, axis=1)
+    catalogue['center_dot_centerDD'] = np.sum(center*centerDD, axis=1)
+    catalogue['centerD_dot_centerDD'] = np.sum(centerD*centerDD, axis=1)
+    return catalogue
+
+
+def shift_templates(templates, nb_channel, shifts):
+    """
+    Shift templates by fractional number of samples with FFT interpolation.
+    Each channel is zero padded to twice its width before the FFT so
+    the circular shift do not wrap.
+    
+    Arguments
+    ---------------
+    templates: np.array
+        shape (nb_template, nb_channel*width)
+    nb_channel: int
+    shifts: np.array
+        Shifts in sample, the shifted template for shift s is template(t+s),
+        so it has the same sign as the jitter of the Peeler.
+    
+    Returns
+    ----------
+    shifted: np.array
+        shape (nb_template, shifts.size, nb_channel*width)
+    """
+    nb_template = templates.shape[0]
+    wfs = templates.reshape(nb_template, nb_channel, -1)
+    width = wfs.shape[2]
+    nfft = 2*width
+    spectrum = np.fft.rfft(wfs, n = nfft, axis = 2)
+    freqs = np.fft.rfftfreq(nfft)
+    phases = np.exp(2j*np.pi*freqs[None, :]*np.asarray(shifts)[:, None])
+    shifted = np.fft.irfft(spectrum[:, None, :, :]*phases[None, :, None, :], n = nfft, axis = 3)[..., :width]
+    return shifted.reshape(nb_template, len(shifts), nb_channel*width)
+
+
+def make_shifted_bank(catalogue, step = 0.1, max_shift = 1.):
+    """
+    Add to the catalogue (inplace) a bank of centers shifted every step
+    sample in [-max_shift, max_shift], for Peeler(alignment_method='bank'):
+        * 'bank_shifts' : shape (nb_shift, )
+        * 'shifted_bank' : shape (nb_cluster, nb_shift, nb_channel*width)
+        * 'shifted_bank_norm2' : shape (nb_cluster, nb_shift)
+    
+    Returns
+    ----------
+    catalogue: dict
+        The same dict.
+    """
+    n = int(round(max_shift/step))
+    shifts = np.arange(-n, n+1)*step
+    bank = shift_templates(catalogue['center'], catalogue['nb_channel'], shifts)
+    catalogue['bank_shifts'] = shifts
+    catalogue['shifted_bank'] = bank.astype(catalogue['center'].dtype)
+    catalogue['shifted_bank_norm2'] = np.sum(catalogue['shifted_bank']**2, axis=2)
+    return catalogue
+
+
+def make_low_rank(catalogue, rank = None, max_error = 0.01):
+    """
+    Add to the catalogue (inplace) a temporal basis shared by all channels of
+    center, centerD and centerDD (truncated SVD) and the templates projected on it:
+        * 'temporal_basis' : shape (rank, width)
+        * 'center_lowrank', 'centerD_lowrank', 'centerDD_lowrank' : shape (nb_cluster, nb_channel*rank)
+        * 'lowrank_error' : shape (nb_cluster, ) worst relative error |t - t_lowrank|^2/|t|^2
+          of center, centerD and centerDD of each cluster
+    
+    Dot products between a waveform and templates can then be done in the reduced
+    space: <wf, t> ~ <wf.basis, t_lowrank>.
+    
+    Arguments
+    ---------------
+    rank: int or None
+        Number of temporal components. If None the smallest rank that gives
+        an error under max_error for all templates.
+    max_error: float
+        See rank.
+    
+    Returns
+    ----------
+    catalogue: dict
+        The same dict.
+    """
+    nb_channel = catalogue['nb_channel']
+    keys = ['center', 'centerD', 'centerDD']
+    templates = np.stack([catalogue[k] for k in keys], axis=0)
+    nb_cluster = templates.shape[1]
+    templates = templates.reshape(len(keys), nb_cluster, nb_channel, -1)
+    width = templates.shape[3]
+    
+    # one line for each (template, channel)
+    u, s, vt = np.linalg.svd(templates.reshape(-1, width), full_matrices = False)
+    
+    norm2 = np.sum(templates**2, axis=(2, 3))
+    norm2[norm2==0] = 1.
+    coefs = templates.dot(vt.T)
+    # error when keeping r components is the energy of the others
+    remaining = np.cumsum(np.sum(coefs[..., ::-1]**2, axis=2), axis=2)[..., ::-1]
+    errors = np.max(remaining/norm2[:, :, None], axis=0)
+    errors = np.concatenate([errors[:, 1:], np.zeros((nb_cluster, 1))], axis=1)
+    if rank is None:
+        rank = int(np.argmax(np.max(errors, axis=0)<=max_error)) + 1
+    
+    catalogue['temporal_basis'] = vt[:rank, :]
+    for i, k in enumerate(keys):
+        catalogue[k+'_lowrank'] = coefs[i, :, :, :rank].reshape(nb_cluster, nb_channel*rank)
+    catalogue['lowrank_error'] = errors[:, rank-1]
+    return catalogue
+
+
+def make_channel_index(catalogue, ratio = 0.5):
+    """
+    Add to the catalogue (inplace) candidate clusters for each peak channel:
+        * 'channel_candidates' : bool shape (nb_channel, nb_cluster)
+    
+    A cluster is a candidate for channel c when the amplitude of its center
+    at the peak sample on c is at least ratio times its amplitude on its
+    best channel. So a peak whose biggest amplitude is on channel c only need
+    to be compared with these clusters.
+    
+    Returns
+    ----------
+    catalogue: dict
+        The same dict.
+    """
+    nb_channel = catalogue['nb_channel']
+    nb_cluster = catalogue['center'].shape[0]
+    centers = catalogue['center'].reshape(nb_cluster, nb_channel, -1)
+    amplitudes = np.abs(centers[:, :, -catalogue['limit_left']])
+    candidates = (amplitudes >= ratio*np.max(amplitudes, axis=1, keepdims=True)).T
+    # a channel that is the best for no one keep all clusters
+    candidates[~np.any(candidates, axis=1), :] = True
+    catalogue['channel_candidates'] = candidates
+    return catalogue
+
+
+def update_centers(catalogue, deltas, weights):
+    """
+    Move centers toward center + deltas (arrays of the dict are replaced,
+    not modified inplace):
+        center <- center + weights*deltas
+    centerD and centerDD are moved with the derivatives of deltas (same kernel
+    as clustering.compute_template), then constants (see complete_catalogue)
+    and the shifted bank and the low rank approximation, if any, are computed again.
+    
+    Arguments
+    ---------------
+    deltas: np.array
+        shape (nb_cluster, nb_channel, width+4) with 2 samples of margin on each side
+        for the derivative, for instance the mean residual around spikes of each cluster.
+    weights: np.array
+        shape (nb_cluster, ), 0 is no change.
+    
+    Returns
+    ----------
+    catalogue: dict
+        The same dict.
+    """
+    kernel = np.array([1,0,-1])/2.
+    kernel = kernel[None, None, :]
+    deltasD = scipy.signal.fftconvolve(deltas, kernel, 'same')
+    deltasDD = scipy.signal.fftconvolve(deltasD, kernel, 'same')
+    
+    nb_cluster = deltas.shape[0]
+    weights = np.asarray(weights)[:, None]
+    for key, d in zip(['center', 'centerD', 'centerDD'], [deltas, deltasD, deltasDD]):
+        catalogue[key] = catalogue[key] + weights*d[:, :, 2:-2].reshape(nb_cluster, -1)
+    
+    complete_catalogue(catalogue)
+    if 'shifted_bank' in catalogue:
+        shifts = catalogue['bank_shifts']
+        step = shifts[1] - shifts[0] if shifts.size>1 else 1.
+        make_shifted_bank(catalogue, step = step, max_shift = shifts[-1])
+    if 'temporal_basis' in catalogue:
+        make_low_rank(catalogue, rank = catalogue['temporal_basis'].shape[0])
+    return catalogue
+
+
+def save_catalogue(catalogue, filename):
+    """
+    Save a catalogue in a npz file.
+    """
+    if not all(k in catalogue for k in peeler_constants):
+        complete_catalogue(catalogue)
+    arrays = { k: np.asarray(v) for k, v in catalogue.items() }
+    arrays['version'] = np.array(catalogue_version)
+    np.savez(filename, **arrays)
+
+
+def load_catalogue(filename):
+    """
+    Load a catalogue saved with save_catalogue.
+    """
+    with np.load(filename) as npz:
+        version = int(npz['version'])
+        assert version == catalogue_version, 'Catalogue version {} not supported (must be {})'.format(version, catalogue_version)
+        catalogue = { k: npz[k] for k in npz.files if k!='version' }
+
+    # scalars are back to python scalars
+    for k in ['limit_left', 'limit_right', 'nb_channel']:
+        if k in catalogue:
+            catalogue[k] = int(catalogue[k])
+
+    return catalogue
@@ -6,17 +6,109 @@ import sklearn.decomposition
 import sklearn.cluster
 import sklearn.mixture
 
-def find_clusters(features, n_clusters,  method='kmeans', **kargs):
-    if method == 'kmeans':
-        km = sklearn.cluster.KMeans(n_clusters=n_clusters,**kargs)
-        labels_ = km.fit_predict(features.values)
-    elif method == 'gmm':
-        gmm = self._cluster_instance = sklearn.mixture.GMM(n_clusters=n_clusters,**kargs)
-        labels_ =gmm.fit_predict(features.values)
+from concurrent.futures import ThreadPoolExecutor
+
+from .editlog import EditLog
+from .catalogue import complete_catalogue
+
+def _make_kmeans(n_clusters, **kargs):
+    return sklearn.cluster.KMeans(n_clusters=n_clusters, **kargs)
+
+def _make_minibatchkmeans(n_clusters, **kargs):
+    return sklearn.cluster.MiniBatchKMeans(n_clusters=n_clusters, **kargs)
+
+def _make_gmm(n_clusters, **kargs):
+    return sklearn.mixture.GaussianMixture(n_components=n_clusters, **kargs)
+
+# Available clustering engines.
+# Each engine is a function (n_clusters, **kargs) that return an object with
+# the sklearn interface fit(data)/predict(data).
+# Other engines can be added here by the user.
+clustering_engines = {
+    'kmeans' : _make_kmeans,
+    'minibatchkmeans' : _make_minibatchkmeans,
+    'gmm' : _make_gmm,
+}
+
+
+def find_clusters(features, n_clusters,  method='kmeans', n_fit_max=20000, chunksize=50000, **kargs):
+    """
+    Find clusters on features.
+    
+    The engine is fitted on a random subsample of at most n_fit_max rows and
+    then all rows are assigned by block of chunksize rows.
+    So the cost of the fit do not grow with the number of peaks.
+    
+    Arguments
+    ---------------
+    features: pd.DataFrame
+        Features (for instance PCA projection of waveforms)
+    n_clusters: int
+        Number of cluster.
+    method: str
+        Key in clustering_engines: 'kmeans', 'minibatchkmeans' or 'gmm'.
+    n_fit_max: int or None
+        Max number of rows used for fitting. None is for all rows.
+    chunksize: int
+        Number of rows by predict call.
+    kargs:
+        Passed to the engine constructor.
+    
+    Returns
+    ----------
+    labels: pd.Series
+        Cluster label for each row of features.
+    
+    """
+    assert method in clustering_engines, 'Unknown clustering method {}'.format(method)
+    engine = clustering_engines[method](n_clusters, **kargs)
+    
+    data = features.values
+    nb = data.shape[0]
+    if n_fit_max is not None and nb>n_fit_max:
+        fit_ind = np.sort(np.random.choice(nb, size=n_fit_max, replace=False))
+        engine.fit(data[fit_ind])
+    else:
+        engine.fit(data)
+    
+    labels_ = np.empty(nb, dtype='int64')
+    for i in range(0, nb, chunksize):
+        labels_[i:i+chunksize] = engine.predict(data[i:i+chunksize])
     
     labels = pd.Series(labels_, index = features.index, name = 'label')
     return labels
 
+def compute_template(wf):
+    """
+    Compute the template of one cluster.
+    
+    Arguments
+    ---------------
+    wf: np.ndarray
+        Waveforms of the cluster, shape (nb_peak, nb_channel, nb_sample)
+    
+    Returns
+    ----------
+    center, centerD, centerDD, mad: np.ndarray
+        The median, first and second derivative of the median and the mad.
+        The 2 samples margin (border effect of derivative) are removed and
+        arrays are flatten (nb_channel*(nb_sample-4), )
+    
+    """
+    center = np.median(wf, axis=0)
+    mad = np.median(np.abs(wf-center),axis=0)*1.4826
+    
+    #compute first and second derivative on dim=1 (time)
+    # only on the median which is a good approximation of the median of derivatives
+    kernel = np.array([1,0,-1])/2.
+    kernel = kernel[None, :]
+    centerD =  scipy.signal.fftconvolve(center,kernel,'same') # first derivative
+    centerDD =  scipy.signal.fftconvolve(centerD,kernel,'same') # second derivative
+    
+    #eliminate margin because of border effect of derivative and reshape
+    return tuple(a[:, 2:-2].reshape(-1) for a in (center, centerD, centerDD, mad))
+    
+
 #~ def order_clusters(features, labels):
     
     
@@ -26,7 +118,7 @@ class Clustering_:
     """
     Clustering class :
         * project waveform with PCA
-        * do clustering (kmean or gmm)
+        * do clustering (kmean, minibatch kmean or gmm see clustering_engines)
         * propose method for merge and split cluster.
     """
     def __init__(self, waveforms):
@@ -44,60 +136,228 @@ class Clustering_:
         return self.features
     
     def find_clusters(self, n_clusters,method='kmeans', **kargs):
-        self.labels = find_clusters(self.features, n_clusters, method='kmeans', **kargs)
+        labels = find_clusters(self.features, n_clusters, method=method, **kargs)
+        return self.set_labels(labels)
+    
+    def set_labels(self, labels):
+        """
+        Start from given labels (for instance find_clusters labels saved on disk):
+        cluster summaries are computed and the history of edits is cleared.
+        
+        Arguments
+        ---------------
+        labels: pd.Series
+            One label for each waveform, same index as features.
+        """
+        self.labels = labels
         self.cluster_labels = np.unique(self.labels)
+        
+        # per cluster summaries, they are then updated incrementally by merge/split/reassign
+        # cluster_indices is the sorted positions of peaks of each cluster (one stable sort)
+        order = np.argsort(self.labels.values, kind = 'mergesort')
+        bounds = np.searchsorted(self.labels.values[order], self.cluster_labels, side = 'right')
+        self.cluster_indices = dict(zip(self.cluster_labels, np.split(order, bounds[:-1])))
+        self.cluster_count = pd.Series(0, index = self.cluster_labels, name = 'count')
+        self.cluster_centroid = pd.DataFrame(0., index = self.cluster_labels, columns = self.features.columns)
+        for k in self.cluster_labels:
+            ind = self.cluster_indices[k]
+            self.cluster_count[k] = ind.size
+            self.cluster_centroid.loc[k, :] = np.mean(self.features.values[ind], axis=0)
+        
+        # the catalogue must be fully recomputed
+        self._templates = {}
+        self.dirty_labels = set(self.cluster_labels)
+        
+        # new history of edits
+        self.editlog = EditLog()
+        
         return self.labels
     
+    def _move_peaks(self, indices, old_labels, new_labels):
+        """
+        Change labels of some peaks and update incrementally:
+        cluster_count, cluster_indices, cluster_centroid, cluster_labels and dirty_labels.
+        The cost depend on the size of changed clusters not on the number of peaks.
+        """
+        features = self.features.values[indices]
+        
+        # remove peaks from old clusters
+        for k in np.unique(old_labels):
+            mask = old_labels==k
+            n, n_removed = self.cluster_count[k], np.sum(mask)
+            if n==n_removed:
+                self.cluster_count = self.cluster_count.drop(k)
+                del self.cluster_indices[k]
+                self.cluster_centroid = self.cluster_centroid.drop(k)
+                self._templates.pop(k, None)
+                self.dirty_labels.discard(k)
+            else:
+                self.cluster_centroid.loc[k, :] = (n*self.cluster_centroid.loc[k, :].values - np.sum(features[mask], axis=0))/(n-n_removed)
+                self.cluster_count[k] = n - n_removed
+                self.cluster_indices[k] = np.setdiff1d(self.cluster_indices[k], indices[mask], assume_unique = True)
+                self.dirty_labels.add(k)
+        
+        # add peaks to new clusters
+        for k in np.unique(new_labels):
+            mask = new_labels==k
+            n_added = np.sum(mask)
+            if k in self.cluster_count.index:
+                n = self.cluster_count[k]
+                self.cluster_centroid.loc[k, :] = (n*self.cluster_centroid.loc[k, :].values + np.sum(features[mask], axis=0))/(n+n_added)
+                self.cluster_count[k] = n + n_added
+                self.cluster_indices[k] = np.union1d(self.cluster_indices[k], indices[mask])
+            else:
+                self.cluster_centroid.loc[k, :] = np.mean(features[mask], axis=0)
+                self.cluster_count[k] = n_added
+                self.cluster_indices[k] = np.sort(indices[mask])
+            self.dirty_labels.add(k)
+        
+        self.labels.iloc[indices] = new_labels
+        
+        self.cluster_count = self.cluster_count.sort_index()
+        self.cluster_centroid = self.cluster_centroid.sort_index()
+        self.cluster_labels = self.cluster_count.index.values
+    
+    def _edit_labels(self, name, indices, new_labels):
+        old_labels = self.labels.values[indices]
+        self.editlog.record(name, indices, old_labels, new_labels)
+        self._move_peaks(indices, old_labels, new_labels)
+    
     def merge_cluster(self, label1, label2):
-        self.labels[self.labels==label2] = label1
+        indices = self.cluster_indices[label2]
+        self._edit_labels('merge', indices, np.full(indices.size, label1, dtype = self.labels.dtype))
         return self.labels
     
-    def split_cluster(self, label, n, method='kmeans', **kargs):
-        mask = self.labels==label
-        new_label = find_clusters(self.features, n, method='kmeans', **kargs)
-        new_label += max(self.labels)+1
-        self.labels[mask] = new_label
+    def reassign_peaks(self, indices, label):
+        """
+        Move some peaks (positions) to one cluster, an existing one or a new one.
+        """
+        indices = np.unique(np.asarray(indices, dtype = 'int64'))
+        self._edit_labels('reassign', indices, np.full(indices.size, label, dtype = self.labels.dtype))
         return self.labels
     
-
-    def construct_catalogue(self):
+    def split_cluster(self, label, n, method='kmeans', n_components=None, **kargs):
         """
+        Split one cluster in n clusters.
+        
+        Only waveforms of this cluster are used: they are projected with a local PCA
+        and then clustered. So the cost depend on the cluster size not the dataset size.
+        
+        Arguments
+        ---------------
+        label: int
+            The label of the cluster to split.
+        n: int
+            Number of new clusters.
+        method: str
+            Clustering method see find_clusters.
+        n_components: int or None
+            Number of components for the local PCA. By default the same as global features.
         
         """
+        indices = self.cluster_indices[label]
+        wf = self.waveforms.values[indices]
+        
+        if n_components is None:
+            n_components = self.features.shape[1]
+        n_components = min(n_components, wf.shape[0], wf.shape[1])
+        pca = sklearn.decomposition.PCA(n_components = n_components)
+        local_features = pd.DataFrame(pca.fit_transform(wf), index = self.labels.index[indices])
         
-        self.catalogue = {}
+        local_labels = find_clusters(local_features, n, method=method, **kargs)
+        new_labels = local_labels.values + max(self.cluster_labels)+1
+        self._edit_labels('split', indices, new_labels)
+        
+        return self.labels
+    
+    def undo(self):
+        """
+        Undo the last merge/split/reassign. The cost is proportional to the number of peaks
+        that were changed.
+        """
+        name, indices, old_labels, new_labels = self.editlog.undo()
+        self._move_peaks(indices, new_labels, old_labels)
+        return self.labels
+    
+    def redo(self):
+        """
+        Redo the last undone merge/split/reassign.
+        """
+        name, indices, old_labels, new_labels = self.editlog.redo()
+        self._move_peaks(indices, old_labels, new_labels)
+        return self.labels
+    
+    def construct_catalogue(self, n_max_per_cluster=1000, n_jobs=1):
+        """
+        Construct the catalogue : median, mad, first and second derivative of the median
+        for each cluster.
+        
+        Arguments
+        ---------------
+        n_max_per_cluster: int or None
+            Max number of waveforms (randomly choosen) by cluster used for the median/mad.
+            None is for all waveforms.
+        n_jobs: int
+            Number of threads for computing clusters in parallel.
+        
+        Returns
+        ----------
+        catalogue: dict of np.array
+            * 'cluster_labels' : shape (nb_cluster,)
+            * 'center', 'centerD', 'centerDD', 'mad' : shape (nb_cluster, nb_channel*nb_sample)
+              the ith row correspond to cluster_labels[i]
+            * 'limit_left', 'limit_right', 'nb_channel'
+            * constants for the Peeler see complete_catalogue
+        
+        """
+        self._templates = {}
+        self.dirty_labels = set(self.cluster_labels)
+        return self.update_catalogue(n_max_per_cluster=n_max_per_cluster, n_jobs=n_jobs)
+    
+    def update_catalogue(self, n_max_per_cluster=1000, n_jobs=1):
+        """
+        Update the catalogue after merge_cluster/split_cluster.
+        Only clusters in dirty_labels are recomputed, others are kept.
+        
+        Arguments are the same as construct_catalogue.
+        """
         nb_channel = self.waveforms.columns.levels[0].size
-        for k in self.cluster_labels:
-            # take peak of this cluster
-            # and reshaape (nb_peak, nb_channel, nb_csample)
-            wf = self.waveforms[self.labels==k].values
-            wf = wf.reshape(wf.shape[0], nb_channel, -1)
-            
-            #compute first and second derivative on dim=2
-            kernel = np.array([1,0,-1])/2.
-            kernel = kernel[None, None, :]
-            wfD =  scipy.signal.fftconvolve(wf,kernel,'same') # first derivative
-            wfDD =  scipy.signal.fftconvolve(wfD,kernel,'same') # second derivative
-            
-            # medians
-            center = np.median(wf, axis=0)
-            centerD = np.median(wfD, axis=0)
-            centerDD = np.median(wfDD, axis=0)
-            mad = np.median(np.abs(wf-center),axis=0)*1.4826
-            
-            #eliminate margin because of border effect of derivative and reshape
-            center = center[:, 2:-2].reshape(-1)
-            centerD = centerD[:, 2:-2].reshape(-1)
-            centerDD = centerDD[:, 2:-2].reshape(-1)
-            mad = mad[:, 2:-2].reshape(-1)
-            
-            self.catalogue[k] = {'center' : center, 'centerD' : centerD, 'centerDD': centerDD,
-                                            'mad': mad}
+        # reshape (nb_peak, nb_channel, nb_csample)
+        all_wf = self.waveforms.values.reshape(self.waveforms.shape[0], nb_channel, -1)
+        
+        # take peak of each dirty cluster with a random subsample
+        dirty_labels = [k for k in self.cluster_labels if k in self.dirty_labels]
+        wf_by_cluster = []
+        for k in dirty_labels:
+            ind = self.cluster_indices[k]
+            if n_max_per_cluster is not None and ind.size>n_max_per_cluster:
+                ind = np.sort(np.random.choice(ind, size=n_max_per_cluster, replace=False))
+            wf_by_cluster.append(all_wf[ind])
+        
+        if n_jobs == 1:
+            templates = [compute_template(wf) for wf in wf_by_cluster]
+        else:
+            # numpy release the GIL for median so threads are enough
+            with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                templates = list(executor.map(compute_template, wf_by_cluster))
+        
+        self._templates.update(zip(dirty_labels, templates))
+        self.dirty_labels = set()
+        
+        self.catalogue = {'cluster_labels' : np.array(self.cluster_labels)}
+        for i, key in enumerate(['center', 'centerD', 'centerDD', 'mad']):
+            self.catalogue[key] = np.array([self._templates[k][i] for k in self.cluster_labels])
+        
+        # good limits (2 samples of margin are removed)
+        samples = self.waveforms.columns.levels[1]
+        self.catalogue['limit_left'] = int(min(samples)+2)
+        self.catalogue['limit_right'] = int(max(samples)-1)
+        self.catalogue['nb_channel'] = nb_channel
+        complete_catalogue(self.catalogue)
         
         return self.catalogue
 
 
-
 from .mpl_plot import ClusteringPlot
 class Clustering(Clustering_, ClusteringPlot):
     pass
@@ -1,8 +1,12 @@
 import os
+import re
 import pandas as pd
 import numpy as np
 import json
 
+from .catalogue import save_catalogue, load_catalogue
+from .spiketable import spike_dtype, SpikeTable
+
 
 class DataIO:
     """
@@ -171,6 +175,7 @@ nb_segments: {}""".format(self.sampling_rate, self.nb_channel, self.nb_segments)
             assert np.all(~((times>=self.segments.loc[seg_num, 't_start']) & (times<=self.segments.loc[seg_num, 't_stop']))), 'data already in store for seg_num {}'.format(seg_num)
             
         df.to_hdf(self.store, path, format = 'table', append=True)
+        self.remove_signals_memmap(seg_num)
         
         if seg_num in self.segments.index:
             self.segments.loc[seg_num, 't_start'] = min(self.segments.loc[seg_num, 't_start'], times[0])
@@ -210,6 +215,80 @@ nb_segments: {}""".format(self.sampling_rate, self.nb_channel, self.nb_segments)
         
         return self.store.select(path, query)
     
+    def get_segment_shape(self, seg_num=0, filtered = True):
+        """
+        Get the shape (nb_sample, nb_channel) of a segment without loading it.
+        """
+        path = 'segment_{}'.format(seg_num)
+        if filtered:
+            path += '/signals'
+        else:
+            path += '/unfiltered_signals'
+        return (self.store.get_storer(path).nrows, self.nb_channel)
+    
+    def get_signals_chunk(self, seg_num=0, i_start = None, i_stop = None, filtered = True):
+        """
+        Get a chunk of signals given by sample position (and not by time like get_signals).
+        Only this chunk is read from the file.
+        
+        Arguments
+        -----------------
+        seg_num: int
+        i_start, i_stop: int
+            Sample position of the chunk.
+        
+        """
+        path = 'segment_{}'.format(seg_num)
+        if filtered:
+            path += '/signals'
+        else:
+            path += '/unfiltered_signals'
+        return self.store.select(path, start = i_start, stop = i_stop)
+    
+    def export_signals_memmap(self, seg_num=0, chunksize = 2**18):
+        """
+        Copy filtered signals and times of a segment in 2 raw files of the directory
+        (segment_N_signals.raw and segment_N_times.raw) so chunks can be read through
+        a memmap by other processes that can not share the hdf5 file (see read_memmap_chunk).
+        Files are written once, append_signals removes them.
+        
+        Returns
+        ----------
+        memmap_info: dict
+            'filename', 'times_filename', 'shape', 'dtype', 'channels'
+        """
+        nb_sample, nb_channel = self.get_segment_shape(seg_num)
+        first = self.get_signals_chunk(seg_num = seg_num, i_start = 0, i_stop = 1)
+        dtype = first.values.dtype
+        memmap_info = {'filename' : os.path.join(self.dirname, 'segment_{}_signals.raw'.format(seg_num)),
+                'times_filename' : os.path.join(self.dirname, 'segment_{}_times.raw'.format(seg_num)),
+                'shape' : (nb_sample, nb_channel), 'dtype' : dtype.str, 'channels' : list(first.columns)}
+        
+        filename, times_filename = memmap_info['filename'], memmap_info['times_filename']
+        if os.path.exists(filename) and os.path.exists(times_filename) and \
+                    os.path.getsize(filename) == nb_sample*nb_channel*dtype.itemsize:
+            return memmap_info
+        
+        sigs = np.memmap(filename+'.tmp', dtype = dtype, mode = 'w+', shape = (nb_sample, nb_channel))
+        times = np.memmap(times_filename+'.tmp', dtype = 'float64', mode = 'w+', shape = (nb_sample, ))
+        for i in range(0, nb_sample, chunksize):
+            chunk = self.get_signals_chunk(seg_num = seg_num, i_start = i, i_stop = i+chunksize)
+            sigs[i:i+chunk.shape[0], :] = chunk.values
+            times[i:i+chunk.shape[0]] = chunk.index.values
+        sigs.flush()
+        times.flush()
+        del sigs, times
+        # the signals file is the last one to appear so it is never incomplete
+        os.replace(times_filename+'.tmp', times_filename)
+        os.replace(filename+'.tmp', filename)
+        return memmap_info
+    
+    def remove_signals_memmap(self, seg_num=0):
+        for name in ['signals', 'times']:
+            filename = os.path.join(self.dirname, 'segment_{}_{}.raw'.format(seg_num, name))
+            if os.path.exists(filename):
+                os.remove(filename)
+    
     def append_peaks(self, peaks, seg_num=0, append = False):
         """
         Append detected peaks in the store.
@@ -235,6 +314,164 @@ nb_segments: {}""".format(self.sampling_rate, self.nb_channel, self.nb_segments)
     def get_peaks(self, seg_num=0):
         path = 'segment_{}/peaks'.format(seg_num)
         return self.store[path]
+    
+    def append_spikes(self, spikes, seg_num=0, append = True):
+        """
+        Append spikes found by the Peeler in the store.
+        
+        Arguments
+        -----------------
+        spikes: np.array
+            Structured array of spikes with spiketable.spike_dtype.
+        seg_num: int
+            The segment num.
+        append: bool, default True
+            If True append to existing spikes for the segment.
+            If False overwrite.
+        """
+        path = 'segment_{}/spikes'.format(seg_num)
+        if not append:
+            self.remove_spikes(seg_num = seg_num)
+        self.store.append(path, pd.DataFrame(spikes), format = 'table')
+    
+    def remove_spikes(self, seg_num=0):
+        path = 'segment_{}/spikes'.format(seg_num)
+        if path in self.store:
+            self.store.remove(path)
+    
+    def get_nb_spikes(self, seg_num=0):
+        """
+        Number of spikes of a segment in the store (without loading them).
+        """
+        path = 'segment_{}/spikes'.format(seg_num)
+        if path not in self.store:
+            return 0
+        return self.store.get_storer(path).nrows
+    
+    def truncate_spikes(self, seg_num=0, nb_spike=0):
+        """
+        Keep only the nb_spike first spikes of a segment, for instance spikes
+        written after the last checkpoint of an interrupted StreamingPeeler.
+        """
+        path = 'segment_{}/spikes'.format(seg_num)
+        nrows = self.get_nb_spikes(seg_num = seg_num)
+        if nb_spike == 0:
+            self.remove_spikes(seg_num = seg_num)
+        elif nrows > nb_spike:
+            self.store.remove(path, start = nb_spike, stop = nrows)
+    
+    def save_peeler_checkpoint(self, checkpoint):
+        """
+        Save the StreamingPeeler cursor: a dict {seg_num : {'i_stop':..., 'nb_spike':...}}.
+        The hdf5 file is flushed first and the json file is replaced atomically, so
+        the checkpoint never refer to spikes that are not on disk.
+        """
+        self.store.flush(fsync = True)
+        filename = os.path.join(self.dirname, 'peeler_checkpoint.json')
+        with open(filename+'.tmp', 'w', encoding = 'utf8') as f:
+            json.dump({ str(k):v for k, v in checkpoint.items() }, f, indent = 4)
+        os.replace(filename+'.tmp', filename)
+    
+    def load_peeler_checkpoint(self):
+        """
+        Load the StreamingPeeler cursor, empty dict if there is no checkpoint.
+        """
+        filename = os.path.join(self.dirname, 'peeler_checkpoint.json')
+        if not os.path.exists(filename):
+            return {}
+        with open(filename, 'r', encoding = 'utf8') as f:
+            checkpoint = json.load(f)
+        return { int(k):v for k, v in checkpoint.items() }
+    
+    def save_peeler_drift(self, num, catalogue, drift_state):
+        """
+        Save the drift state of the StreamingPeeler for a checkpoint: the catalogue with
+        drifted centers (peeler_drift_N_catalogue.npz) and drift_state, a dict of np.array
+        (peeler_drift_N_state.npz). Files of a new num are written before the checkpoint
+        that refer to it, so the checkpoint never refer to incomplete files.
+        """
+        self.save_catalogue(catalogue, name = 'peeler_drift_{}_catalogue'.format(num))
+        np.savez(os.path.join(self.dirname, 'peeler_drift_{}_state.npz'.format(num)), **drift_state)
+    
+    def load_peeler_drift(self, num):
+        """
+        Load the catalogue and the drift state saved by save_peeler_drift.
+        """
+        catalogue = self.load_catalogue(name = 'peeler_drift_{}_catalogue'.format(num))
+        assert catalogue is not None, 'No peeler drift state {} in {}'.format(num, self.dirname)
+        with np.load(os.path.join(self.dirname, 'peeler_drift_{}_state.npz'.format(num))) as npz:
+            drift_state = { k: npz[k] for k in npz.files }
+        return catalogue, drift_state
+    
+    def remove_peeler_drift(self, keep = []):
+        """
+        Remove files of drift states (see save_peeler_drift) except those of nums in keep.
+        """
+        for filename in os.listdir(self.dirname):
+            m = re.match(r'peeler_drift_(\d+)_(catalogue|state)\.npz$', filename)
+            if m is not None and int(m.group(1)) not in keep:
+                os.remove(os.path.join(self.dirname, filename))
+    
+    def get_spikes(self, seg_num=0):
+        """
+        Get spikes of a segment, None if the Peeler has not been run on this segment.
+        
+        Returns
+        ----------
+        spikes: np.array
+            Structured array with spiketable.spike_dtype sorted by index.
+        """
+        path = 'segment_{}/spikes'.format(seg_num)
+        if path not in self.store:
+            return None
+        df = self.store[path]
+        spikes = np.zeros(df.shape[0], dtype = spike_dtype)
+        for name, _ in spike_dtype:
+            spikes[name] = df[name].values
+        return spikes
+    
+    def get_spike_table(self, seg_num=0, cluster_labels = None):
+        """
+        SpikeTable of a segment, None if the Peeler has not been run on this segment.
+        """
+        spikes = self.get_spikes(seg_num = seg_num)
+        if spikes is None:
+            return None
+        return SpikeTable(spikes, cluster_labels = cluster_labels)
+    
+    def save_catalogue(self, catalogue, name = 'catalogue'):
+        """
+        Save a catalogue in the working directory (name.npz).
+        See catalogue.save_catalogue.
+        """
+        save_catalogue(catalogue, os.path.join(self.dirname, name+'.npz'))
+    
+    def load_catalogue(self, name = 'catalogue'):
+        """
+        Load a catalogue from the working directory.
+        Return None if there is no catalogue.
+        """
+        filename = os.path.join(self.dirname, name+'.npz')
+        if not os.path.exists(filename):
+            return None
+        return load_catalogue(filename)
         
         
     
+
+
+# memmaps opened by this process (see read_memmap_chunk)
+_opened_memmaps = {}
+
+def read_memmap_chunk(memmap_info, i_start, i_stop):
+    """
+    Chunk of signals exported by DataIO.export_signals_memmap, the same pd.DataFrame as
+    DataIO.get_signals_chunk. Memmaps are opened once by process.
+    """
+    shape = tuple(memmap_info['shape'])
+    key = (memmap_info['filename'], shape)
+    if key not in _opened_memmaps:
+        _opened_memmaps[key] = (np.memmap(memmap_info['filename'], dtype = memmap_info['dtype'], mode = 'r', shape = shape),
+                        np.memmap(memmap_info['times_filename'], dtype = 'float64', mode = 'r', shape = shape[:1]))
+    sigs, times = _opened_memmaps[key]
+    return pd.DataFrame(np.array(sigs[i_start:i_stop]), index = np.array(times[i_start:i_stop]), columns = memmap_info['channels'])
@@ -0,0 +1,143 @@
+import numpy as np
+
+
+"""
+History of edits on a label array (merge, split, ...).
+
+Each edit is stored as a compact delta:
+  * indices : int32 positions of peaks whose label changed
+  * old_labels : int32 labels before the edit
+  * new_labels : int32 labels after the edit
+So undo/redo cost is proportional to the size of the edit and not to the
+number of peaks.
+
+"""
+
+
+class EditLog:
+    """
+    Undo/redo history of label edits.
+
+    Usage:
+        editlog = EditLog()
+        editlog.record('merge', indices, old_labels, new_labels)
+        editlog.undo(labels)
+        editlog.redo(labels)
+        editlog.save('edits.npz')
+
+        #later on a label array saved before edits
+        editlog = EditLog.load('edits.npz')
+        editlog.replay(labels)
+
+    """
+    def __init__(self):
+        self.edits = []
+        # number of edits currently applied
+        self.position = 0
+
+    def __len__(self):
+        return len(self.edits)
+
+    def __repr__(self):
+        return 'EditLog <{} edits, position {}>'.format(len(self.edits), self.position)
+
+    @property
+    def can_undo(self):
+        return self.position>0
+
+    @property
+    def can_redo(self):
+        return self.position<len(self.edits)
+
+    def record(self, name, indices, old_labels, new_labels):
+        """
+        Record a new edit. Edits that were undone are forgotten.
+
+        Arguments
+        ---------------
+        name: str
+            Name of the edit ('merge', 'split', ...)
+        indices: np.array
+            Positions of peaks that change.
+        old_labels, new_labels: np.array or int
+            Labels before/after the edit for each indices.
+
+        """
+        indices = np.asarray(indices, dtype='int32')
+        old_labels = np.broadcast_to(np.asarray(old_labels, dtype='int32'), indices.shape).copy()
+        new_labels = np.broadcast_to(np.asarray(new_labels, dtype='int32'), indices.shape).copy()
+        del self.edits[self.position:]
+        self.edits.append((name, indices, old_labels, new_labels))
+        self.position += 1
+
+    def undo(self, labels=None):
+        """
+        Undo the last applied edit on labels (inplace) if given.
+        Return the edit (name, indices, old_labels, new_labels).
+        """
+        assert self.can_undo, 'Nothing to undo'
+        self.position -= 1
+        edit = self.edits[self.position]
+        name, indices, old_labels, new_labels = edit
+        if labels is not None:
+            labels[indices] = old_labels
+        return edit
+
+    def redo(self, labels=None):
+        """
+        Redo the next edit on labels (inplace) if given.
+        Return the edit (name, indices, old_labels, new_labels).
+        """
+        assert self.can_redo, 'Nothing to redo'
+        edit = self.edits[self.position]
+        name, indices, old_labels, new_labels = edit
+        if labels is not None:
+            labels[indices] = new_labels
+        self.position += 1
+        return edit
+
+    def replay(self, labels, position=None):
+        """
+        Apply edits (inplace) on a label array as it was before the first edit,
+        for instance a label array reloaded from disk.
+
+        Arguments
+        ---------------
+        labels: np.array
+            Labels before the first edit.
+        position: int or None
+            Apply edits up to this position. None is for the current position.
+        """
+        if position is None:
+            position = self.position
+        for name, indices, old_labels, new_labels in self.edits[:position]:
+            labels[indices] = new_labels
+        return labels
+
+    def save(self, filename):
+        """
+        Save the history in a npz file.
+        All edits are concatenated so the file contains only 6 arrays.
+        """
+        sizes = np.array([e[1].size for e in self.edits], dtype='int64')
+        offsets = np.zeros(len(self.edits)+1, dtype='int64')
+        offsets[1:] = np.cumsum(sizes)
+        if len(self.edits)>0:
+            all_indices, all_old, all_new = [np.concatenate([e[i] for e in self.edits]) for i in (1, 2, 3)]
+        else:
+            all_indices, all_old, all_new = [np.zeros(0, dtype='int32') for i in range(3)]
+        np.savez(filename, names=np.array([e[0] for e in self.edits], dtype='U'),
+                offsets=offsets, indices=all_indices, old_labels=all_old, new_labels=all_new,
+                position=np.array(self.position))
+
+    @classmethod
+    def load(cls, filename):
+        editlog = cls()
+        with np.load(filename) as npz:
+            offsets = npz['offsets']
+            all_indices, all_old, all_new = npz['indices'], npz['old_labels'], npz['new_labels']
+            for i, name in enumerate(npz['names']):
+                sl = slice(offsets[i], offsets[i+1])
+                editlog.edits.append((str(name), all_indices[sl], all_old[sl], all_new[sl]))
+            editlog.position = int(npz['position'])
+        return editlog
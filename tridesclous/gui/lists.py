@@ -22,7 +22,7 @@ class PeakModel(QtCore.QAbstractItemModel):
         
     def rowCount(self, parentIndex):
         if not parentIndex.isValid():
-            return self.spikesorter.all_peaks.shape[0]
+            return len(self.spikesorter.all_peaks)
         else :
             return 0
         
@@ -44,24 +44,23 @@ class PeakModel(QtCore.QAbstractItemModel):
         if role ==QtCore.Qt.DisplayRole :
             col = index.column()
             row = index.row()
-            ind = self.spikesorter.all_peaks.index[row]
-            peak =  self.spikesorter.all_peaks.iloc[row, :]
+            peaks = self.spikesorter.all_peaks
             
             if col == 0:
                 return '{}'.format(row)
             elif col == 1:
-                return '{}'.format(int(ind[0]))
+                return '{}'.format(peaks.segment[row])
             elif col == 2:
-                return '{:.4f}'.format(ind[1])
+                return '{:.4f}'.format(peaks.get_time(row))
             elif col == 3:
-                return '{}'.format(peak['label'])
+                return '{}'.format(peaks.label[row])
             else:
                 return None
         elif role == QtCore.Qt.DecorationRole :
             col = index.column()
             if col != 0: return None
             row = index.row()
-            label = self.spikesorter.all_peaks.iloc[row, :]['label']
+            label = self.spikesorter.all_peaks.label[row]
             if label in self.icons:
                 return self.icons[label]
             else:
@@ -128,11 +127,8 @@ class PeakList(QtGui.QWidget):
         self.model.refresh_colors()
     
     def on_tree_selection(self):
-        self.spikesorter.all_peaks.loc[:, 'selected'] = False
-        for index in self.tree.selectedIndexes():
-            if index.column() == 0: 
-                ind = self.spikesorter.all_peaks.index[index.row()]
-                self.spikesorter.all_peaks.loc[ind, 'selected'] = True
+        rows = [index.row() for index in self.tree.selectedIndexes() if index.column() == 0]
+        self.spikesorter.all_peaks.select(rows)
         self.peak_selection_changed.emit()
 
     def open_context_menu(self):
@@ -141,10 +137,9 @@ class PeakList(QtGui.QWidget):
     def on_peak_selection_changed(self):
         self.tree.selectionModel().selectionChanged.disconnect(self.on_tree_selection)
         
-        selected_peaks = self.spikesorter.all_peaks[self.spikesorter.all_peaks['selected']]
-        if selected_peaks.shape[0]>100:#otherwise this is verry slow
-            selected_peaks = selected_peaks.iloc[:10,:]
-        rows = [self.spikesorter.all_peaks.index.get_loc(ind) for ind in selected_peaks.index]
+        rows = self.spikesorter.all_peaks.get_selected()
+        if rows.size>100:#otherwise this is verry slow
+            rows = rows[:10]
         
         # change selection
         self.tree.selectionModel().clearSelection()
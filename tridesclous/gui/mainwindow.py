@@ -5,6 +5,7 @@ import pyqtgraph as pg
 from pyqtgraph.Qt import QtCore, QtGui
 
 from ..spikesorter import SpikeSorter
+from ..peaktable import PeakTable
 from .traceviewer import TraceViewer
 from .lists import PeakList, ClusterList
 from .ndscatter import NDScatter
@@ -50,11 +51,15 @@ class SpikeSortingWindow(QtGui.QMainWindow):
     def from_classes(cls, dataio, peakdetector, waveformextractor, clustering):
         spikesorter = SpikeSorter(dataio = dataio)
         
-        spikesorter.all_peaks = pd.DataFrame(np.zeros(peakdetector.peak_index.size, dtype = 'int32'), columns = ['label'], index = peakdetector.peak_index)
-        spikesorter.all_peaks['label'] = clustering.labels
-        spikesorter.all_peaks['selected'] = False
         spikesorter.all_waveforms  = waveformextractor.get_ajusted_waveforms()
+        # peaks with a waveform (the ones too near borders are removed)
+        times = spikesorter.all_waveforms.index.get_level_values(1)
+        index = np.searchsorted(peakdetector.sigs.index.values, times)
+        seg_num = peakdetector.seg_num
+        spikesorter.all_peaks = PeakTable(np.full(index.size, seg_num, dtype = 'int32'), index, label = clustering.labels.values,
+                            sampling_rate = dataio.sampling_rate, t_starts = {seg_num : dataio.segments.loc[seg_num, 't_start']})
         spikesorter.clustering = clustering
+        spikesorter._refresh_clusters()
         
         spikesorter.refresh_colors()
         
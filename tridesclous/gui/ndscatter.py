@@ -190,9 +190,9 @@ class NDScatter(QtGui.QWidget):
             #~ if k not in visible_labels:
             scatter.setData([], [])
         
-        visible_labels = np.unique(self.metadata['label'].values)
+        visible_labels = np.unique(self.metadata.label)
         for k in visible_labels:
-            data = self.data[self.metadata['label']==k].values
+            data = self.data.values[self.metadata.label==k]
             projected = np.dot(data, self.projection )
             #~ print(data.shape)
             #~ print(projected.shape)
@@ -206,7 +206,7 @@ class NDScatter(QtGui.QWidget):
             
             self.scatters[k].setData(projected[:,0], projected[:,1])
         
-        data = self.data[self.metadata['selected']]
+        data = self.data.values[self.metadata.selected]
         projected = np.dot(data, self.projection )
         self.scatters['sel'].setData(projected[:,0], projected[:,1])
         
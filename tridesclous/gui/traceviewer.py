@@ -194,7 +194,6 @@ class TraceViewer(QtGui.QWidget):
 
         if self.spikesorter.all_peaks is None:
             self.spikesorter.load_all_peaks()
-        self.seg_peaks = self.spikesorter.all_peaks.xs(self.seg_num)
             
         if self.isVisible():
             self.refresh()
@@ -238,8 +237,15 @@ class TraceViewer(QtGui.QWidget):
             self.curves[c].setData(chunk.index.values, chunk.iloc[:, c].values*self.gains[c]+self.offsets[c])
             self.channel_labels[c].setPos(t1, self.dataio.nb_channel-c-1)
         
-        inwin = self.seg_peaks.loc[t1:t2,:]
-        visible_labels = np.unique(inwin['label'].values)
+        # peaks in the window and their values in the chunk (by sample position)
+        peaks = self.spikesorter.all_peaks
+        chunk_start = int(round((chunk.index[0] - peaks.t_starts.get(self.seg_num, 0.))*peaks.sampling_rate)) if chunk.shape[0]>0 else 0
+        inwin = peaks.get_index_window(self.seg_num, chunk_start, chunk_start + chunk.shape[0])
+        inwin_times = peaks.get_times(inwin)
+        inwin_values = chunk.values[peaks.index[inwin] - chunk_start, :]
+        inwin_labels = peaks.label[inwin]
+        inwin_selected = peaks.selected[inwin]
+        visible_labels = np.unique(inwin_labels)
         for c in range(self.dataio.nb_channel):
             #reset scatters
             for k, scatter in self.scatters[c].items():
@@ -252,14 +258,11 @@ class TraceViewer(QtGui.QWidget):
                 pen = QtGui.QColor( 'yellow')
                 self.scatters[c]['sel'] = pg.ScatterPlotItem(pen=pen, brush=brush, size=20, pxMode = True)
                 self.plot.addItem(self.scatters[c]['sel'])
-            sel = inwin[inwin['selected']]
-            p = chunk.loc[sel.index]
-            self.scatters[c]['sel'].setData(p.index.values, p.iloc[:,c].values*self.gains[c]+self.offsets[c])
+            self.scatters[c]['sel'].setData(inwin_times[inwin_selected], inwin_values[inwin_selected, c]*self.gains[c]+self.offsets[c])
         
         for k in visible_labels:
             for c in range(self.dataio.nb_channel):
-                sel = inwin[inwin['label']==k]
-                p = chunk.loc[sel.index]
+                sel = inwin_labels==k
                 
                 color = self.spikesorter.qcolors.get(k, QtGui.QColor( 'white'))
                 if k not in self.scatters[c]:
@@ -267,7 +270,7 @@ class TraceViewer(QtGui.QWidget):
                     self.plot.addItem(self.scatters[c][k])
                     self.scatters[c][k].sigClicked.connect(self.item_clicked)
                 self.scatters[c][k].setBrush(color)
-                self.scatters[c][k].setData(p.index.values, p.iloc[:,c].values*self.gains[c]+self.offsets[c])
+                self.scatters[c][k].setData(inwin_times[sel], inwin_values[sel, c]*self.gains[c]+self.offsets[c])
         
         self.plot.setXRange( t1, t2, padding = 0.0)
         self.plot.setYRange(-.5, self.dataio.nb_channel-.5, padding = 0.0)
@@ -306,9 +309,10 @@ class TraceViewer(QtGui.QWidget):
         self.refresh()
     
     def on_peak_selection_changed(self):
-        selected_peaks = self.spikesorter.all_peaks[self.spikesorter.all_peaks['selected']]
-        if self.params['auto_zoom_on_select'] and selected_peaks.shape[0]==1:
-            seg_num, time= selected_peaks.index[0]
+        peaks = self.spikesorter.all_peaks
+        selected = peaks.get_selected()
+        if self.params['auto_zoom_on_select'] and selected.size==1:
+            seg_num, time = peaks.segment[selected[0]], peaks.get_time(selected[0])
             if seg_num != self.seg_num:
                 seg_pos = self.dataio.segments.index.tolist().index(seg_num)
                 self.combo.setCurrentIndex(seg_pos)
@@ -320,8 +324,8 @@ class TraceViewer(QtGui.QWidget):
     def item_clicked(self, plot, points):
         if self.select_button.isChecked()and len(points)==1:
             x = points[0].pos().x()
-            self.spikesorter.all_peaks['selected'] = False
-            self.spikesorter.all_peaks.loc[(self.seg_num, x), 'selected'] = True
+            i = self.spikesorter.all_peaks.find_peak(self.seg_num, x)
+            self.spikesorter.all_peaks.select([i] if i>=0 else [])
             
             self.peak_selection_changed.emit()
             self.refresh()
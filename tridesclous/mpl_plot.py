@@ -89,12 +89,12 @@ class ClusteringPlot:
     
     def plot_catalogue(self, colors = None, palette = 'husl'):
         if colors is None:
-            colors = sns.color_palette(palette, len(self.catalogue))
+            colors = sns.color_palette(palette, len(self.catalogue['cluster_labels']))
 
         fix, ax = pyplot.subplots()
-        for i,k in enumerate(self.catalogue):
-            wf0 = self.catalogue[k]['center']
-            mad = self.catalogue[k]['mad']
+        for i,k in enumerate(self.catalogue['cluster_labels']):
+            wf0 = self.catalogue['center'][i]
+            mad = self.catalogue['mad'][i]
             ax.plot(wf0, color = colors[i], label = '#{}'.format(k))
             ax.fill_between(np.arange(wf0.size), wf0-mad, wf0+mad, color = colors[i], alpha = .4)
 
@@ -107,13 +107,13 @@ class ClusteringPlot:
     
     def plot_derivatives(self,  colors = None, palette = 'husl'):
         if colors is None:
-            colors = sns.color_palette(palette, len(self.catalogue))
+            colors = sns.color_palette(palette, len(self.catalogue['cluster_labels']))
 
         fix, axs = pyplot.subplots(nrows = 3)
-        for i,k in enumerate(self.catalogue):
-            axs[0].plot(self.catalogue[k]['center'], color = colors[i], label = '#{}'.format(k))
-            axs[1].plot(self.catalogue[k]['centerD'], color = colors[i])
-            axs[2].plot(self.catalogue[k]['centerDD'], color = colors[i])    
+        for i,k in enumerate(self.catalogue['cluster_labels']):
+            axs[0].plot(self.catalogue['center'][i], color = colors[i], label = '#{}'.format(k))
+            axs[1].plot(self.catalogue['centerD'][i], color = colors[i])
+            axs[2].plot(self.catalogue['centerDD'][i], color = colors[i])    
         
         axs[0].set_ylabel("waveform")
         axs[1].set_ylabel("waveform '")
@@ -0,0 +1,293 @@
+import time
+import collections
+
+import numpy as np
+import pandas as pd
+
+from .catalogue import complete_catalogue, peeler_constants
+from .spiketable import spike_dtype, make_spikes
+from .peeler import Peeler_
+
+
+"""
+Online mode: apply a fixed catalogue on signals pushed by small blocks
+(for instance 1 to 10 ms) during an acquisition.
+
+Normalized signals are written in a ring buffer. After each block the Peeler_
+is applied on the samples not done yet plus a left context, with noise
+statistics frozen before the acquisition (no median over a 1 ms block).
+A spike is emitted when all samples of its waveform and of the peak
+detection neighborhood are in the buffer, so the delay between a spike and
+its emission is at most self.delay samples plus the processing time of one block.
+Emitted spikes are subtracted from the ring buffer so next blocks work on the residual.
+
+"""
+
+
+class RingBuffer:
+    """
+    Circular buffer of samples addressed by absolute sample position.
+
+    Arguments
+    ---------------
+    size: int
+        Number of samples kept.
+    nb_channel: int
+
+    """
+    def __init__(self, size, nb_channel, dtype = 'float64'):
+        self.size = size
+        self.nb_channel = nb_channel
+        self.buffer = np.zeros((size, nb_channel), dtype = dtype)
+        # absolute position of the next sample to write
+        self.head = 0
+
+    def write(self, block):
+        n = block.shape[0]
+        assert n <= self.size, 'block bigger than the ring buffer'
+        i = self.head % self.size
+        first = min(n, self.size - i)
+        self.buffer[i:i+first] = block[:first]
+        self.buffer[:n-first] = block[first:]
+        self.head += n
+
+    def _indexes(self, start, stop):
+        assert start >= self.head - self.size and stop <= self.head, 'samples [{}, {}[ not in the ring buffer'.format(start, stop)
+        return np.arange(start, stop) % self.size
+
+    def read(self, start, stop):
+        """
+        Copy of samples [start, stop[ (absolute positions).
+        """
+        i, j = start % self.size, stop % self.size
+        if stop > start and i < j:
+            # contiguous in the buffer
+            assert start >= self.head - self.size and stop <= self.head, 'samples [{}, {}[ not in the ring buffer'.format(start, stop)
+            return self.buffer[i:j].copy()
+        return self.buffer[self._indexes(start, stop)]
+
+    def subtract(self, start, values):
+        """
+        Subtract values inplace on samples [start, start+values.shape[0][.
+        """
+        self.buffer[self._indexes(start, start+values.shape[0])] -= values
+
+
+class OnlinePeeler:
+    """
+    Apply the Peeler on signals pushed block by block.
+
+    Usage:
+        med, mad = StreamingPeeler(dataio, catalogue).estimate_noise(seg_num=0)
+        onlinepeeler = OnlinePeeler(catalogue, med, mad, nb_level=2)
+        for block in acquisition:
+            new_spikes = onlinepeeler.push(block)
+        onlinepeeler.flush()
+        print(onlinepeeler.get_latency_stats())
+
+    Or with a stand-in data source:
+        onlinepeeler.run_queue(q)
+        onlinepeeler.run_socket(sock, block_size=300)
+
+    Arguments
+    ---------------
+    catalogue: dict
+        Given by Clustering.construct_catalogue or load_catalogue.
+    med, mad: np.array
+        Frozen noise statistics of each channel used to normalize blocks,
+        estimated before the acquisition (for instance StreamingPeeler.estimate_noise).
+    nb_level: int
+        Maximum number of peel levels for each block (see Peeler_.run).
+    ring_size: int
+        Number of samples of the ring buffer. It must contain the left context,
+        the samples not done yet and one block.
+    callback: None or function
+        Called with new spikes (np.array with spike_dtype) after each block.
+    history: int
+        Number of blocks whose spikes and processing time are kept (see get_spikes
+        and get_latency_stats), so memory is bounded during a long acquisition.
+    peeler_params:
+        Other parameters for the Peeler_ (threshold, peak_sign, n_span, alignment_method, ...)
+
+    """
+    def __init__(self, catalogue, med, mad, nb_level = 2, ring_size = 2**14, callback = None, history = 10000, **peeler_params):
+        self.catalogue = catalogue
+        if not all(k in catalogue for k in peeler_constants):
+            complete_catalogue(catalogue)
+        self.med = np.asarray(med, dtype = 'float64')
+        self.mad = np.asarray(mad, dtype = 'float64')
+        self.nb_channel = catalogue['nb_channel']
+        assert self.med.size == self.nb_channel and self.mad.size == self.nb_channel, 'med and mad must have nb_channel values'
+        self.nb_level = nb_level
+        self.callback = callback
+        peeler_params = dict(peeler_params, verbose = False)
+
+        n_left, n_right = catalogue['limit_left'], catalogue['limit_right']
+        self.n_left = n_left
+        n_span = peeler_params.get('n_span', 2)
+        # Peeler_ keep peaks at pos>-n_left+1 and pos<length-n_right-1, detection need n_span samples on each side
+        self.left_margin = -n_left + n_span + 2
+        self.right_margin = n_right + n_span + 2
+        # worst delay in samples between a peak and its emission (spike at the beginning of a block)
+        self.delay = self.right_margin
+
+        self.ring = RingBuffer(ring_size, self.nb_channel)
+        self.max_block_size = ring_size - self.left_margin - self.right_margin
+        assert self.max_block_size > 0, 'ring_size too small'
+
+        # one Peeler_ for all blocks, only signals change (see Peeler_.reset)
+        self.peeler = Peeler_(pd.DataFrame(np.zeros((0, self.nb_channel))), catalogue, med = np.zeros(self.nb_channel),
+                            mad = np.ones(self.nb_channel), **peeler_params)
+        
+        # absolute position of the first sample not done yet
+        self.done = 0
+        self.nb_block = 0
+        self.spikes = collections.deque(maxlen = history)
+        self.latencies = collections.deque(maxlen = history)
+
+    @property
+    def nb_sample(self):
+        return self.ring.head
+
+    def push(self, block):
+        """
+        Add a block of signals (raw, not normalized) and peel samples that can be done.
+
+        Arguments
+        ---------------
+        block: np.array
+            shape (nb_sample, nb_channel)
+
+        Returns
+        ----------
+        spikes: np.array
+            New spikes (spike_dtype), 'index' is the absolute sample position.
+        """
+        t0 = time.perf_counter()
+        block = np.asarray(block)
+        assert block.ndim == 2 and block.shape[1] == self.nb_channel, 'block must have shape (nb_sample, nb_channel)'
+        assert block.shape[0] <= self.max_block_size, 'block bigger than {} samples'.format(self.max_block_size)
+        self.ring.write((block - self.med)/self.mad)
+        spikes = self._process(self.ring.head - self.right_margin)
+        self.latencies.append(time.perf_counter() - t0)
+        self.nb_block += 1
+        return spikes
+
+    def flush(self):
+        """
+        At the end of the acquisition, peel the last samples (without waiting for next blocks).
+        """
+        return self._process(self.ring.head)
+
+    def _process(self, limit):
+        # spikes with position in [done, limit[ are emitted
+        if limit <= self.done:
+            return np.zeros(0, dtype = spike_dtype)
+        start = max(self.done - self.left_margin, 0)
+        sigs = self.ring.read(start, self.ring.head)
+        peeler = self.peeler
+        peeler.reset(pd.DataFrame(sigs))
+        # same as Peeler_.run without the stats DataFrame
+        while peeler.level < self.nb_level:
+            peeler.peel()
+            if peeler.level_stats[-1]['nb_spike'] == 0:
+                break
+
+        levels = sorted(peeler.spike_pos.keys())
+        spike_pos = np.concatenate([peeler.spike_pos[l] for l in levels]) + start
+        jitters = np.concatenate([peeler.spike_jitters[l] for l in levels])
+        labels = np.concatenate([peeler.spike_labels[l] for l in levels])
+        spike_levels = np.concatenate([np.full(peeler.spike_pos[l].size, l, dtype = 'uint8') for l in levels])
+        keep = (spike_pos>=self.done) & (spike_pos<limit)
+        spike_pos, jitters, labels, spike_levels = spike_pos[keep], jitters[keep], labels[keep], spike_levels[keep]
+
+        # others spikes will be found again with the next block
+        preds = peeler._predicted_waveforms(jitters, labels)
+        for pos, pred in zip(spike_pos, preds):
+            self.ring.subtract(pos + self.n_left, pred)
+
+        self.done = limit
+        spikes = make_spikes(spike_pos, labels, jitters, spike_levels)
+        if spikes.size > 0:
+            self.spikes.append(spikes)
+            if self.callback is not None:
+                self.callback(spikes)
+        return spikes
+
+    def get_spikes(self):
+        """
+        Spikes emitted (spike_dtype) by the last history blocks, sorted by index.
+        """
+        if len(self.spikes) == 0:
+            return np.zeros(0, dtype = spike_dtype)
+        return np.concatenate(self.spikes)
+
+    def get_latency_stats(self, percentiles = [50, 90, 99]):
+        """
+        Processing time of the last history blocks (push) in ms.
+
+        Returns
+        ----------
+        stats: pd.Series
+            'p50', 'p90', 'p99', 'max' in ms, 'nb_block' the number of blocks pushed and 'delay' the worst number of samples
+            between a peak and the end of the block that emit it.
+        """
+        latencies = np.array(self.latencies)*1000.
+        stats = {}
+        for p in percentiles:
+            stats['p{}'.format(p)] = np.percentile(latencies, p) if latencies.size>0 else np.nan
+        stats['max'] = np.max(latencies) if latencies.size>0 else np.nan
+        stats['nb_block'] = self.nb_block
+        stats['delay'] = self.delay
+        return pd.Series(stats)
+
+    def run_queue(self, q, timeout = None):
+        """
+        Push blocks taken from a queue.Queue (or multiprocessing.Queue) until None is received
+        then flush.
+
+        Returns
+        ----------
+        spikes: np.array
+            See get_spikes.
+        """
+        while True:
+            block = q.get(timeout = timeout)
+            if block is None:
+                break
+            self.push(block)
+        self.flush()
+        return self.get_spikes()
+
+    def run_socket(self, sock, block_size, dtype = 'float32'):
+        """
+        Push blocks received on a connected socket until it is closed by the other side
+        then flush.
+
+        The stream is raw samples with the given dtype, channels interleaved
+        (sample 0 channel 0, sample 0 channel 1, ...). Received samples are pushed
+        by blocks of block_size samples, remaining complete samples are pushed at the end.
+
+        Returns
+        ----------
+        spikes: np.array
+            See get_spikes.
+        """
+        dtype = np.dtype(dtype)
+        frame_size = self.nb_channel*dtype.itemsize
+        block_bytes = block_size*frame_size
+        buf = bytearray()
+        while True:
+            data = sock.recv(max(block_bytes - len(buf), frame_size))
+            if len(data) == 0:
+                break
+            buf += data
+            if len(buf) >= block_bytes:
+                block = np.frombuffer(bytes(buf[:block_bytes]), dtype = dtype).reshape(block_size, self.nb_channel)
+                del buf[:block_bytes]
+                self.push(block)
+        n = len(buf)//frame_size
+        if n > 0:
+            self.push(np.frombuffer(bytes(buf[:n*frame_size]), dtype = dtype).reshape(n, self.nb_channel))
+        self.flush()
+        return self.get_spikes()
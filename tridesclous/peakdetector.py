@@ -69,7 +69,7 @@ def detect_peak_method_span(rectified_signals, peak_sign='-', n_span = 2):
     
     Argument
     --------------
-    rectified_signals: pandas.dataFrame
+    rectified_signals: pandas.dataFrame or np.array
         rectified signals see normalize_signals and rectify_signals
     peak_sign: '+' or '-'
         sign of the peak
@@ -82,7 +82,7 @@ def detect_peak_method_span(rectified_signals, peak_sign='-', n_span = 2):
         position in sample of peaks.
     """
     k = n_span
-    sig = rectified_signals.sum(axis=1).values #np.array
+    sig = np.asarray(rectified_signals.sum(axis=1))
     sig_center = sig[k:-k]
     if peak_sign == '+':
         peaks = sig_center>1.
@@ -106,12 +106,17 @@ class PeakDetector_:
     """
     This is helper to estimated noise and threshold and detect peak on signals.
     It take as entry a DataFrame with signals given by DataManager.get_signals(...).    
+    med and mad can be given when signals are a chunk of a longer segment
+    so that all chunks are normalized the same way.
     """
-    def __init__(self, signals, seg_num = 0):
+    def __init__(self, signals, seg_num = 0, med = None, mad = None):
         self.sigs = signals
         self.seg_num = seg_num
         
-        self.estimate_noise()
+        if med is None or mad is None:
+            self.estimate_noise()
+        else:
+            self.med, self.mad = med, mad
         self.normed_sigs = normalize_signals(self.sigs, med = self.med, mad = self.mad)
         #self.rectified_sigs = rectify_signals(self.normed_sigs, threshold, copy = True)
     
@@ -0,0 +1,143 @@
+import numpy as np
+import pandas as pd
+
+
+"""
+Columnar table of detected peaks (used by SpikeSorter and the GUI).
+
+Each peak is a position in contiguous arrays sorted by (segment, index):
+  * 'segment' : int32 segment num
+  * 'index' : int64 sample position in the segment
+  * 'label' : int32 cluster label (-1 before clustering)
+  * 'selected' : bool selection mask (for the UI)
+So a peak is accessed by its position in O(1), peaks of a segment are
+a slice and peaks in a time window are found with searchsorted.
+
+"""
+
+
+class PeakTable:
+    """
+    Peaks of all segments.
+
+    Usage:
+        peaks = PeakTable(segment, index, sampling_rate = 10000.)
+        sl = peaks.get_window(seg_num = 0, t1 = 1.5, t2 = 2.)
+        labels_in_window = peaks.label[sl]
+
+    Arguments
+    ---------------
+    segment: np.array
+        Segment num of each peak.
+    index: np.array
+        Sample position of each peak in its segment, sorted by (segment, index).
+    label: np.array or None
+        By default -1 for all peaks.
+    sampling_rate: float
+    t_starts: dict or None
+        Time of the first sample of each segment (0. by default).
+
+    """
+    def __init__(self, segment, index, label = None, sampling_rate = 1., t_starts = None):
+        self.segment = np.ascontiguousarray(segment, dtype = 'int32')
+        self.index = np.ascontiguousarray(index, dtype = 'int64')
+        assert self.segment.size == self.index.size, 'segment and index must have the same size'
+        if label is None:
+            self.label = np.full(self.index.size, -1, dtype = 'int32')
+        else:
+            self.label = np.ascontiguousarray(label, dtype = 'int32')
+        self.selected = np.zeros(self.index.size, dtype = 'bool')
+        self.sampling_rate = float(sampling_rate)
+
+        seg_nums, starts, counts = np.unique(self.segment, return_index = True, return_counts = True)
+        assert np.all(np.diff(self.segment)>=0), 'peaks must be sorted by segment'
+        self.seg_nums = seg_nums
+        self._seg_slices = { s:slice(start, start+count) for s, start, count in zip(seg_nums, starts, counts) }
+        for s, sl in self._seg_slices.items():
+            assert np.all(np.diff(self.index[sl])>=0), 'peaks must be sorted by index in segment {}'.format(s)
+
+        if t_starts is None:
+            t_starts = {}
+        self.t_starts = { s:float(t_starts.get(s, 0.)) for s in seg_nums }
+
+    def __len__(self):
+        return self.index.size
+
+    def __repr__(self):
+        return 'PeakTable <{} peaks, {} segments>'.format(self.index.size, self.seg_nums.size)
+
+    def get_segment_slice(self, seg_num):
+        """
+        Positions of the peaks of a segment (a slice).
+        """
+        return self._seg_slices.get(seg_num, slice(0, 0))
+
+    def get_time(self, i):
+        """
+        Time of the peak at position i.
+        """
+        return self.t_starts[self.segment[i]] + self.index[i]/self.sampling_rate
+
+    def get_times(self, sl = slice(None)):
+        """
+        Times of peaks at positions sl (slice or np.array).
+        """
+        segment, index = self.segment[sl], self.index[sl]
+        t_starts = np.array([self.t_starts[s] for s in self.seg_nums])
+        return t_starts[np.searchsorted(self.seg_nums, segment)] + index/self.sampling_rate
+
+    def get_window(self, seg_num, t1, t2):
+        """
+        Positions of the peaks of a segment with a time in [t1, t2] (a slice).
+        """
+        t_start = self.t_starts.get(seg_num, 0.)
+        i_start = int(np.ceil((t1 - t_start)*self.sampling_rate))
+        i_stop = int(np.floor((t2 - t_start)*self.sampling_rate)) + 1
+        return self.get_index_window(seg_num, i_start, i_stop)
+
+    def get_index_window(self, seg_num, i_start, i_stop):
+        """
+        Positions of the peaks of a segment with a sample index in [i_start, i_stop[ (a slice).
+        """
+        sl = self.get_segment_slice(seg_num)
+        index = self.index[sl]
+        return slice(sl.start + np.searchsorted(index, i_start, side = 'left'), sl.start + np.searchsorted(index, i_stop, side = 'left'))
+
+    def find_peak(self, seg_num, t):
+        """
+        Position of the peak of a segment which is the nearest of time t, -1 if the segment has no peak.
+        """
+        sl = self.get_segment_slice(seg_num)
+        if sl.stop == sl.start:
+            return -1
+        index = self.index[sl]
+        i = int(round((t - self.t_starts[seg_num])*self.sampling_rate))
+        j = np.searchsorted(index, i)
+        candidates = [p for p in (j-1, j) if 0<=p<index.size]
+        j = min(candidates, key = lambda p: abs(index[p]-i))
+        return sl.start + j
+
+    def clear_selection(self):
+        self.selected[:] = False
+
+    def select(self, positions):
+        """
+        Select only peaks at positions.
+        """
+        self.selected[:] = False
+        self.selected[positions] = True
+
+    def get_selected(self):
+        """
+        Positions of selected peaks.
+        """
+        positions, = np.nonzero(self.selected)
+        return positions
+
+    def to_dataframe(self):
+        """
+        A copy as a pd.DataFrame with columns segment, index, time, label, selected.
+        """
+        return pd.DataFrame({'segment' : self.segment, 'index' : self.index, 'time' : self.get_times(),
+                            'label' : self.label, 'selected' : self.selected},
+                            columns = ['segment', 'index', 'time', 'label', 'selected'])
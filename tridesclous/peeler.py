@@ -1,11 +1,53 @@
+import os
+import time
+import tempfile
 import numpy as np
 import pandas as pd
 
-from .waveformextractor import  WaveformExtractor, cut_chunks
-from .peakdetector import PeakDetector
+from .waveformextractor import cut_chunks
+from .peakdetector import rectify_signals, detect_peak_method_span
+from .catalogue import (complete_catalogue, peeler_constants, make_shifted_bank, make_low_rank,
+                        make_channel_index, update_centers)
+from .spiketable import make_spikes, SpikeTable
+from .tools import median_mad
+from .dataio import read_memmap_chunk
+from .templatematching import TemplateMatcher, template_matching_params
 
+import multiprocessing
 
 
+def concatenated_windows(around, left, right, length):
+    """
+    Merge windows [p+left, p+right[ around positions (clipped in [0, length[)
+    and give sample indexes of the concatenated windows.
+    
+    Returns
+    ----------
+    indexes: np.array
+        Sample indexes of all windows (sorted, no duplicate).
+    local: np.array
+        Position of each sample in its window.
+    lengths: np.array
+        Length of the window of each sample.
+    """
+    if around.size == 0:
+        empty = np.zeros(0, dtype = 'int64')
+        return empty, empty, empty
+    around = np.sort(around)
+    starts = np.clip(around + left, 0, length)
+    stops = np.maximum.accumulate(np.clip(around + right, 0, length))
+    new_window = np.ones(around.size, dtype = 'bool')
+    new_window[1:] = starts[1:] > stops[:-1]
+    first, = np.nonzero(new_window)
+    starts = starts[first]
+    stops = stops[np.append(first[1:]-1, around.size-1)]
+    
+    win_lengths = stops - starts
+    win = np.repeat(np.arange(starts.size), win_lengths)
+    local = np.arange(win.size) - np.repeat(np.cumsum(win_lengths) - win_lengths, win_lengths)
+    indexes = starts[win] + local
+    return indexes, local, win_lengths[win]
+
 
 
 
@@ -21,35 +63,123 @@ class Peeler_:
     
     For the first peel peak_pos0 and waveforms0 can be option
     
+    The noise (median and mad of signals) is estimated once. The first level scans
+    the whole signals, next levels only scan the residual around spikes subtracted
+    at the previous level because it did not change elsewhere (see detect_peaks).
+    
     
     Arguments
     ---------------
     
     signals: pd.DataFrame
         signals, must the normed signals or the signals that correspond to catalogue.
-    
-     n_left, n_right:
-        The good limits
-     
+    catalogue: dict
+        Given by Clustering.construct_catalogue or load_catalogue.
+    n_left, n_right:
+        The good limits. By default they are taken from the catalogue.
+    residuals_retention: 'latest', 'all' or 'memmap'
+        What is kept of the residuals of previous levels:
+          * 'latest' only the current residual buffer (one signal size in memory)
+          * 'all' a copy in memory of each level
+          * 'memmap' each level is written in a raw file in memmap_dirname (for instance dataio.dirname),
+            file names are unique to this Peeler and files are removed by close()
+        Residuals of a level that are not kept are recomputed on demand with get_residuals(level).
+    memmap_dirname: str
+        Directory for residuals_retention='memmap'
+    alignment_method: 'taylor' or 'bank'
+        How the cluster and the jitter of each peak are estimated:
+          * 'taylor' second order expansion with centerD and centerDD (see estimate_jitters)
+          * 'bank' best match in a bank of centers shifted by fraction of sample
+            precomputed once in the catalogue (see estimate_jitters_bank and catalogue.make_shifted_bank)
+    lowrank: bool
+        If True dot products between waveforms and centers (and derivatives) are
+        computed on a temporal basis shared by all templates (see catalogue.make_low_rank).
+        Waveforms are projected once, then each template costs nb_channel*rank instead
+        of nb_channel*width. The worst relative error of the approximation of templates
+        is given by self.lowrank_error.
+    prefilter: None or 'peak_channel'
+        If 'peak_channel' each peak is only compared with candidate clusters of
+        its peak channel (see catalogue.make_channel_index) instead of all clusters.
+        So the cost of the nearest center search depends on the local density
+        of clusters and not on the size of the catalogue.
+    med, mad: None or np.array
+        Noise of the signals used for the detection. By default estimated on signals,
+        give them when signals are too short for a good estimation (see online.OnlinePeeler).
+    verbose: bool
+        Print each level.
     
     
     """
-    def __init__(self, signals, catalogue,  n_left, n_right,
-                            threshold=-4, peak_sign = '-', n_span = 2):
+    def __init__(self, signals, catalogue,  n_left=None, n_right=None,
+                            threshold=-4, peak_sign = '-', n_span = 2,
+                            residuals_retention = 'latest', memmap_dirname = None,
+                            alignment_method = 'taylor', lowrank = False, prefilter = None,
+                            med = None, mad = None, verbose = True):
 
         self.signals = signals
         self.catalogue = catalogue
+        if not all(k in catalogue for k in peeler_constants):
+            complete_catalogue(catalogue)
+        if n_left is None:
+            n_left = catalogue['limit_left']
+        if n_right is None:
+            n_right = catalogue['limit_right']
         self.n_left = n_left
         self.n_right = n_right
         self.threshold = threshold
         self.peak_sign = peak_sign
         self.n_span = n_span
+        self.verbose = verbose
+        
+        assert alignment_method in ('taylor', 'bank'), 'Unknown alignment_method {}'.format(alignment_method)
+        self.alignment_method = alignment_method
+        if alignment_method == 'bank' and 'shifted_bank' not in catalogue:
+            make_shifted_bank(catalogue)
+        
+        self.lowrank = lowrank
+        if lowrank:
+            if 'temporal_basis' not in catalogue:
+                make_low_rank(catalogue)
+            assert catalogue['temporal_basis'].shape[1] == self.n_right - self.n_left, 'lowrank need the limits of the catalogue'
+            self.lowrank_error = np.max(catalogue['lowrank_error'])
+        
+        assert prefilter in (None, 'peak_channel'), 'Unknown prefilter {}'.format(prefilter)
+        self.prefilter = prefilter
+        if prefilter == 'peak_channel' and 'channel_candidates' not in catalogue:
+            make_channel_index(catalogue)
         
         self.nb_channel = self.signals.shape[1]
         
+        # noise is estimated once for all levels
+        if med is None:
+            med = self.signals.median(axis=0).values
+        if mad is None:
+            mad = np.median(np.abs(self.signals.values-med),axis=0)*1.4826
+        self.med = med
+        self.mad = mad
         
-        self.cluster_labels = np.array(list(catalogue.keys()))
-        self.all_center = np.array([catalogue[k]['center'] for k in self.cluster_labels])
+        
+        self.cluster_labels = catalogue['cluster_labels']
+        self.cluster_index = { k:i for i, k in enumerate(self.cluster_labels) }
+        self.all_center = catalogue['center']
+        
+        assert residuals_retention in ('latest', 'all', 'memmap'), 'Unknown residuals_retention {}'.format(residuals_retention)
+        if residuals_retention == 'memmap':
+            assert memmap_dirname is not None, 'memmap_dirname must be given for residuals_retention=memmap'
+        self.residuals_retention = residuals_retention
+        self.memmap_dirname = memmap_dirname
+        self.memmap_filenames = {}
+        
+        self.reset(signals)
+    
+    def reset(self, signals):
+        """
+        Start again on new signals (same channels) with the same catalogue and noise,
+        so constants computed at init are kept (see online.OnlinePeeler).
+        """
+        assert signals.shape[1] == self.nb_channel, 'signals must have {} channels'.format(self.nb_channel)
+        self.close()
+        self.signals = signals
         
         # level of peel alredy done
         self.level = 0
@@ -58,12 +188,84 @@ class Peeler_:
         self.spike_labels = {}
         self.spike_jitters = {}
         self.spike_pos = {}
-        self.residuals = {}
+        
+        self._spike_tables = {}
+        
+        # one line per level: nb_spike, time, energy_reduction, residual_energy
+        self.level_stats = []
+        
+        # one residual buffer for all levels, prediction are subtracted inplace
+        self.residual = np.array(self.signals.values, dtype = 'float64')
+        self.residuals = pd.DataFrame(self.residual, index = self.signals.index, columns = self.signals.columns, copy = False)
+        self.kept_residuals = {}
         
 
     def estimate_one_jitter(self, wf):
         """
-        Estimate the jitter for one peak given its waveform
+        Estimate the jitter for one peak given its waveform.
+        See estimate_jitters.
+        """
+        labels, jitters = self.estimate_jitters(wf[None, :])
+        return labels[0], jitters[0]
+    
+    def _scoring_space(self, waveforms):
+        """
+        Waveforms, centers, centersD, centersDD in the space where dot products are computed:
+        the full space or the low rank space (waveforms projected on the temporal basis).
+        """
+        cat = self.catalogue
+        if not self.lowrank:
+            return waveforms, self.all_center, cat['centerD'], cat['centerDD']
+        basis = cat['temporal_basis']
+        n = waveforms.shape[0]
+        wfs = waveforms.reshape(n, self.nb_channel, -1).dot(basis.T).reshape(n, -1)
+        return wfs, cat['center_lowrank'], cat['centerD_lowrank'], cat['centerDD_lowrank']
+    
+    def nearest_centers(self, waveforms, wfs, centers):
+        """
+        Nearest center of each waveform: |wf-wf0|^2 = |wf|^2 - 2<wf,wf0> + |wf0|^2
+        so only <wf,wf0> is computed, with one GEMM against all centers or
+        with prefilter='peak_channel' one GEMM by peak channel against its candidates.
+        
+        Arguments
+        ---------------
+        waveforms: np.ndarray
+            shape (nb_peak, nb_channel*width)
+        wfs, centers: np.ndarray
+            waveforms and centers in the scoring space (see _scoring_space).
+        
+        Returns
+        ----------
+        cluster_idx: np.ndarray
+            Index of the nearest center for each peak.
+        wf_dot_wf0: np.ndarray
+            <wf, wf0> for each peak.
+        """
+        center_norm2 = self.catalogue['center_norm2']
+        if self.prefilter is None:
+            wf_dot_centers = wfs.dot(centers.T)
+            cluster_idx = np.argmin(center_norm2[None, :] - 2*wf_dot_centers, axis=1)
+            wf_dot_wf0 = wf_dot_centers[np.arange(cluster_idx.size), cluster_idx]
+            return cluster_idx, wf_dot_wf0
+        
+        n = waveforms.shape[0]
+        peak_values = waveforms.reshape(n, self.nb_channel, -1)[:, :, -self.n_left]
+        peak_channels = np.argmax(np.abs(peak_values), axis=1)
+        cluster_idx = np.zeros(n, dtype = 'int64')
+        wf_dot_wf0 = np.zeros(n, dtype = wfs.dtype)
+        candidates = self.catalogue['channel_candidates']
+        for chan in np.unique(peak_channels):
+            ind, = np.nonzero(peak_channels==chan)
+            cand, = np.nonzero(candidates[chan])
+            wf_dot_centers = wfs[ind].dot(centers[cand].T)
+            best = np.argmin(center_norm2[cand][None, :] - 2*wf_dot_centers, axis=1)
+            cluster_idx[ind] = cand[best]
+            wf_dot_wf0[ind] = wf_dot_centers[np.arange(ind.size), best]
+        return cluster_idx, wf_dot_wf0
+    
+    def estimate_jitters(self, waveforms):
+        """
+        Estimate the cluster and the jitter for all peaks at once given their waveforms.
         
         for best reading (at for me SG):
           * wf = the wafeform of the peak
@@ -74,75 +276,129 @@ class Peeler_:
           * h0_norm2: error at order0
           * h1_norm2: error at order1
           * h2_norm2: error at order2
+        
+        All norms are developed as function of dot products so that only
+        <wf, wf>, <wf, wf0>, <wf, wf1>, <wf, wf2> have to be computed for each peak,
+        all others products only depend on the catalogue and are precomputed.
+        
+        Arguments
+        ---------------
+        waveforms: np.ndarray
+            shape (nb_peak, nb_channel*width)
+        
+        Returns
+        ----------
+        labels: np.ndarray
+            Cluster label for each peak, -1 when the prediction is bad.
+        jitters: np.ndarray
+            Jitter for each peak.
+        
         """
-
-        cluster_idx = np.argmin(np.sum((self.all_center-wf)**2, axis = 1))
-        k = self.cluster_labels[cluster_idx]
+        if self.alignment_method == 'bank':
+            return self.estimate_jitters_bank(waveforms)
+        
+        cat = self.catalogue
+        wfs, centers, centersD, centersDD = self._scoring_space(waveforms)
         
-        wf0 = self.catalogue[k]['center']
-        wf1 = self.catalogue[k]['centerD']
-        wf2 = self.catalogue[k]['centerDD']
+        cluster_idx, wf_dot_wf0 = self.nearest_centers(waveforms, wfs, centers)
         
-        wf1_norm2 = wf1.dot(wf1)
-        wf2_norm2 = wf2.dot(wf2)
-        wf1_dot_wf2 = wf1.dot(wf2)
+        wf_norm2 = np.einsum('ij,ij->i', waveforms, waveforms)
+        wf_dot_wf1 = np.einsum('ij,ij->i', wfs, centersD[cluster_idx])
+        wf_dot_wf2 = np.einsum('ij,ij->i', wfs, centersDD[cluster_idx])
         
-        h = wf - wf0
-        h0_norm2 = h.dot(h)
-        h_dot_wf1 = h.dot(wf1)
+        wf0_norm2 = cat['center_norm2'][cluster_idx]
+        wf1_norm2 = cat['centerD_norm2'][cluster_idx]
+        wf2_norm2 = cat['centerDD_norm2'][cluster_idx]
+        wf0_dot_wf1 = cat['center_dot_centerD'][cluster_idx]
+        wf0_dot_wf2 = cat['center_dot_centerDD'][cluster_idx]
+        wf1_dot_wf2 = cat['centerD_dot_centerDD'][cluster_idx]
+        
+        # h = wf - wf0
+        h0_norm2 = wf_norm2 - 2*wf_dot_wf0 + wf0_norm2
+        h_dot_wf1 = wf_dot_wf1 - wf0_dot_wf1
+        h_dot_wf2 = wf_dot_wf2 - wf0_dot_wf2
         jitter0 = h_dot_wf1/wf1_norm2
-        h1_norm2 = np.sum((h-jitter0*wf1)**2)
-        
-        if h0_norm2 > h1_norm2:
-            #order 1 is better than order 0
-            h_dot_wf2 = np.dot(h,wf2)
-            rss_first = -2*h_dot_wf1 + 2*jitter0*(wf1_norm2 - h_dot_wf2) + 3*jitter0**2*wf1_dot_wf2 + jitter0**3*wf2_norm2
-            rss_second = 2*(wf1_norm2 - h_dot_wf2) + 6*jitter0*wf1_dot_wf2 + 3*jitter0**2*wf2_norm2
-            jitter1 = jitter0 - rss_first/rss_second
-            h2_norm2 = np.sum((h-jitter1*wf1-jitter1**2/2*wf2)**2)
-            if h1_norm2 <= h2_norm2:
-                #when order 2 is worse than order 1
-                jitter1 = jitter0
-        else:
-            jitter1 = 0.
+        h1_norm2 = h0_norm2 - 2*jitter0*h_dot_wf1 + jitter0**2*wf1_norm2
         
-        if np.sum(wf**2) > np.sum((wf0+jitter1*wf1+jitter1**2/2*wf2)**2):
-            #prediction should be smaller than original (which have noise)
-            return k, jitter1
-        else:
-            #otherwise the prediction is bad
-            return -1, 0.
-
+        rss_first = -2*h_dot_wf1 + 2*jitter0*(wf1_norm2 - h_dot_wf2) + 3*jitter0**2*wf1_dot_wf2 + jitter0**3*wf2_norm2
+        rss_second = 2*(wf1_norm2 - h_dot_wf2) + 6*jitter0*wf1_dot_wf2 + 3*jitter0**2*wf2_norm2
+        jitter1 = jitter0 - rss_first/rss_second
+        # |h - jitter1*wf1 - jitter1**2/2*wf2|^2
+        h2_norm2 = h0_norm2 - 2*jitter1*h_dot_wf1 - jitter1**2*h_dot_wf2 + jitter1**2*wf1_norm2 \
+                        + jitter1**3*wf1_dot_wf2 + jitter1**4/4.*wf2_norm2
+        
+        #when order 2 is worse than order 1
+        jitter1 = np.where(h1_norm2 <= h2_norm2, jitter0, jitter1)
+        #when order 1 is not better than order 0
+        jitter1 = np.where(h0_norm2 > h1_norm2, jitter1, 0.)
+        
+        # |wf0 + jitter1*wf1 + jitter1**2/2*wf2|^2
+        pred_norm2 = wf0_norm2 + 2*jitter1*wf0_dot_wf1 + jitter1**2*wf0_dot_wf2 + jitter1**2*wf1_norm2 \
+                        + jitter1**3*wf1_dot_wf2 + jitter1**4/4.*wf2_norm2
+        
+        #prediction should be smaller than original (which have noise)
+        #otherwise the prediction is bad
+        ok = wf_norm2 > pred_norm2
+        labels = np.where(ok, self.cluster_labels[cluster_idx], -1)
+        jitters = np.where(ok, jitter1, 0.)
+        
+        return labels, jitters
+    
+    def estimate_jitters_bank(self, waveforms):
+        """
+        Estimate the cluster and the jitter for all peaks with the shifted template bank:
+        the cluster is the nearest center (one GEMM against all centers) and the
+        shift is the nearest shifted template of this cluster (one GEMM by cluster
+        against its bank). There is no iteration so the cost by peak is constant.
+        
+        Jitters are on the grid of catalogue['bank_shifts'].
+        
+        Arguments and returns are the same as estimate_jitters.
+        """
+        cat = self.catalogue
+        bank = cat['shifted_bank']
+        wfs, centers, _, _ = self._scoring_space(waveforms)
+        
+        cluster_idx, _ = self.nearest_centers(waveforms, wfs, centers)
+        
+        # |wf-t|^2 = |wf|^2 - 2<wf,t> + |t|^2
+        shift_idx = np.zeros(cluster_idx.size, dtype = 'int64')
+        for c in np.unique(cluster_idx):
+            ind, = np.nonzero(cluster_idx==c)
+            wf_dot_bank = waveforms[ind].dot(bank[c].T)
+            shift_idx[ind] = np.argmin(cat['shifted_bank_norm2'][c][None, :] - 2*wf_dot_bank, axis=1)
+        
+        wf_norm2 = np.einsum('ij,ij->i', waveforms, waveforms)
+        pred_norm2 = cat['shifted_bank_norm2'][cluster_idx, shift_idx]
+        
+        #prediction should be smaller than original (which have noise)
+        ok = wf_norm2 > pred_norm2
+        labels = np.where(ok, self.cluster_labels[cluster_idx], -1)
+        jitters = np.where(ok, cat['bank_shifts'][shift_idx], 0.)
+        
+        return labels, jitters
     
     def classify_and_align(self, waveforms, peak_pos, residuals):
         """
+        Classify and align all waveforms at once.
+        
+        Peaks with more than one sample of jitter are moved and a new waveform
+        is taken at the good place for a second estimation (only for theses peaks).
         
         """
-
-        jitters = np.empty(waveforms.shape[0])
-        labels = np.empty(waveforms.shape[0])
-        for i in range(waveforms.shape[0]):
-            #~ print('i', i, waveforms.shape[0])
-            wf = waveforms[i,:]
-            
-            label, jitter1 = self.estimate_one_jitter(wf)
-            
-            # if more than one sample of jitter
-            # then we take a new wf at the good place and do estimate again
-            if np.abs(jitter1) > 0.5:
-                #~ print('')
-                #~ peak_pos[i] -= int(np.round(jitter1))
-                #~ print(label, jitter1, peak_pos[i])
-                peak_pos[i] -= int(np.round(jitter1))
-                chunk = cut_chunks(residuals.values, np.array([ peak_pos[i]+self.n_left], dtype = int),
-                                -self.n_left + self.n_right )
-                wf = waveforms[i,:] = chunk[0,:].reshape(-1)
-                label, jitter1 = self.estimate_one_jitter(wf)
-                #~ print(label, jitter1, peak_pos[i])
-                
-            
-            jitters[i] = jitter1
-            labels[i] = label
+        labels, jitters = self.estimate_jitters(waveforms)
+        
+        # if more than one sample of jitter
+        # then we take a new wf at the good place and do estimate again
+        width = -self.n_left + self.n_right
+        shift = np.round(jitters).astype('int64')
+        new_pos = peak_pos - shift
+        recut, = np.nonzero((np.abs(jitters) > 0.5) & (new_pos+self.n_left>=0) & (new_pos+self.n_right<residuals.shape[0]))
+        if recut.size>0:
+            peak_pos[recut] = new_pos[recut]
+            chunks = cut_chunks(residuals.values, peak_pos[recut]+self.n_left, width)
+            waveforms[recut, :] = chunks.reshape(recut.size, -1)
+            labels[recut], jitters[recut] = self.estimate_jitters(waveforms[recut, :])
         
         keep = labels!=-1
         labels = labels[keep]
@@ -151,63 +407,678 @@ class Peeler_:
         
         return spike_pos, jitters, labels
 
-    def predict(self, spike_pos, jitters, labels ):
-        prediction = np.zeros_like(self.signals)
-        length = self.n_right - self.n_left
-        for i in range(spike_pos.size):
-            k = labels[i]
-            wf0 = self.catalogue[k]['center']
-            wf1 = self.catalogue[k]['centerD']
-            wf2 = self.catalogue[k]['centerDD']
-            pred = wf0 + jitters[i]*wf1 + jitters[i]**2/2*wf2
-            pos = spike_pos[i] + self.n_left
-            prediction[pos:pos+length, :] = pred.reshape(self.nb_channel, -1).transpose()
+    def _predicted_waveforms(self, jitters, labels):
+        """
+        Predicted waveforms with shape (nb_spike, width, nb_channel).
+        """
+        cluster_idx = np.array([self.cluster_index[k] for k in labels], dtype='int64')
+        if self.alignment_method == 'bank':
+            shifts = self.catalogue['bank_shifts']
+            shift_idx = np.argmin(np.abs(jitters[:, None] - shifts[None, :]), axis=1)
+            pred = self.catalogue['shifted_bank'][cluster_idx, shift_idx]
+            return pred.reshape(pred.shape[0], self.nb_channel, self.n_right - self.n_left).transpose(0, 2, 1)
         
+        jitters = jitters[:, None]
+        pred = self.catalogue['center'][cluster_idx] + jitters*self.catalogue['centerD'][cluster_idx] \
+                        + jitters**2/2*self.catalogue['centerDD'][cluster_idx]
+        return pred.reshape(pred.shape[0], self.nb_channel, self.n_right - self.n_left).transpose(0, 2, 1)
+    
+    def subtract_prediction(self, residual, spike_pos, jitters, labels):
+        """
+        Subtract inplace the prediction of spikes on residual.
+        This is done spike window by spike window, so no full length prediction is allocated.
         
+        Arguments
+        ---------------
+        residual: np.ndarray
+            shape (nb_sample, nb_channel)
+        """
+        preds = self._predicted_waveforms(jitters, labels)
+        length = self.n_right - self.n_left
+        for i, pos in enumerate(spike_pos + self.n_left):
+            residual[pos:pos+length, :] -= preds[i]
+    
+    def predict(self, spike_pos, jitters, labels ):
+        """
+        Full length prediction of spikes.
+        Only used for plotting, the peel do not need it (see subtract_prediction).
+        """
+        prediction = np.zeros(self.signals.shape, dtype = self.residual.dtype)
+        self.subtract_prediction(prediction, spike_pos, jitters, labels)
+        prediction *= -1
         return prediction
-        
-   
+    
+    def get_prediction(self, level):
+        """
+        Full length prediction of one level (recomputed from spikes).
+        """
+        return self.predict(self.spike_pos[level], self.spike_jitters[level], self.spike_labels[level])
+    
     def peel(self):
-        print('Apply level=', self.level)
+        """
+        Apply one level of peel: detect peaks on the residual, classify and align them
+        and subtract their prediction from the residual.
         
-        #copy previous residuals for that level
-        if self.level==0:
-            self.residuals[self.level] = self.signals.copy()
-        else:
-            self.residuals[self.level] = self.residuals[self.level-1].copy()
+        The residual buffer is the same for all levels and is modified inplace.
         
-        # detect peak and take waveform on residuals
-        peakdetector = PeakDetector(self.residuals[self.level])
-        peak_pos = peakdetector.detect_peaks(threshold=self.threshold, peak_sign = self.peak_sign, n_span = self.n_span)
+        Returns
+        ----------
+        residuals: pd.DataFrame
+            The residuals after this level (a view on the residual buffer).
+        """
+        if self.verbose:
+            print('Apply level=', self.level)
+        t0 = time.perf_counter()
+        if self.level == 0:
+            self.residual_energy = np.sum(self.residual**2)
+        
+        # detect peak on residuals
+        if self.level == 0:
+            peak_pos = self.detect_peaks()
+        else:
+            peak_pos = self.detect_peaks(around = self.spike_pos[self.level-1])
         
-        #waveforms
-        waveformextractor = WaveformExtractor(peakdetector, n_left=self.n_left, n_right=self.n_right)
+        #waveforms, peaks too near borders are removed
         # in peeler n_left and n_rigth are th "good limit"
-        waveforms = waveformextractor.long_waveforms.values
+        width = self.n_right - self.n_left
+        keep = (peak_pos>-self.n_left+1) & (peak_pos<self.residual.shape[0] - self.n_right - 1)
+        peak_pos = peak_pos[keep]
+        waveforms = cut_chunks(self.residual, peak_pos+self.n_left, width).reshape(peak_pos.size, self.nb_channel*width)
         
-        spike_pos, jitters, labels = self.classify_and_align(waveforms, peak_pos, self.residuals[self.level])
+        spike_pos, jitters, labels = self.classify_and_align(waveforms, peak_pos, self.residuals)
 
         self.spike_labels[self.level] = labels
         self.spike_jitters[self.level] = jitters
         self.spike_pos[self.level] = spike_pos
+        self._spike_tables = {}
         
-        prediction = self.predict(spike_pos, jitters, labels)
-        self.residuals[self.level] -= prediction
+        # energy reduction is computed only where the residual changes
+        indexes, _, _ = concatenated_windows(spike_pos, self.n_left, self.n_right, self.residual.shape[0])
+        energy_before = np.sum(self.residual[indexes]**2)
+        self.subtract_prediction(self.residual, spike_pos, jitters, labels)
+        energy_reduction = energy_before - np.sum(self.residual[indexes]**2)
+        self.residual_energy -= energy_reduction
+        self.keep_residual(self.level)
         
+        self.level_stats.append({'level' : self.level, 'nb_spike' : spike_pos.size, 'time' : time.perf_counter() - t0,
+                            'energy_reduction' : energy_reduction, 'residual_energy' : self.residual_energy})
         self.level += 1
         
-        return prediction, self.residuals[self.level-1]
+        return self.residuals
+    
+    def run(self, max_levels = 10, min_new_spikes = 1):
+        """
+        Peel levels until a level finds less than min_new_spikes spikes
+        or max_levels levels are done.
+        
+        Returns
+        ----------
+        stats: pd.DataFrame
+            See get_level_stats.
+        """
+        while self.level < max_levels:
+            self.peel()
+            if self.level_stats[-1]['nb_spike'] < min_new_spikes:
+                break
+        return self.get_level_stats()
+    
+    def get_level_stats(self):
+        """
+        Statistics of each level done.
+        
+        Returns
+        ----------
+        stats: pd.DataFrame
+            index is level, columns are:
+              * 'nb_spike': number of spikes found at this level
+              * 'time': time spent in peel (s)
+              * 'energy_reduction': sum of square of the residual removed by this level
+              * 'residual_energy': sum of square of the residual after this level
+        """
+        columns = ['level', 'nb_spike', 'time', 'energy_reduction', 'residual_energy']
+        stats = pd.DataFrame(self.level_stats, columns = columns)
+        return stats.set_index('level')
+    
+    def detect_peaks(self, around = None):
+        """
+        Detect peaks on the residual normalized with the noise of the signals.
+        
+        Arguments
+        ---------------
+        around: None or np.array
+            If None the whole residual is scanned. Otherwise only windows around
+            these positions (spikes subtracted at previous level) are scanned:
+            a peak can only change if its own waveform overlaps a subtracted one.
+            Windows are concatenated and scanned at once.
+        
+        Returns
+        ----------
+        peak_pos: np.array
+            Sorted position of peaks.
+        """
+        k = self.n_span
+        if around is None:
+            normed = (self.residual - self.med)/self.mad
+            rectified = rectify_signals(normed, self.threshold, copy = False)
+            return detect_peak_method_span(rectified, peak_sign = self.peak_sign, n_span = k)
+        
+        if around.size == 0:
+            return np.zeros(0, dtype = 'int64')
+        
+        # windows around spikes with k samples more on each side for the detection
+        width = self.n_right - self.n_left
+        indexes, local, lengths = concatenated_windows(around, -width - k, width + k + 1, self.residual.shape[0])
+        
+        normed = (self.residual[indexes, :] - self.med)/self.mad
+        rectified = rectify_signals(normed, self.threshold, copy = False)
+        peaks = detect_peak_method_span(rectified, peak_sign = self.peak_sign, n_span = k)
+        
+        # peaks near window borders are compared with the next window so they are removed
+        # (as in a full scan, the k first and last samples of the signals are never peaks)
+        peaks = peaks[(local[peaks]>=k) & (local[peaks]<lengths[peaks]-k)]
+        return indexes[peaks]
+    
+    def keep_residual(self, level):
+        """
+        Keep (or not) the residual of this level depending on residuals_retention.
+        """
+        if self.residuals_retention == 'all':
+            self.kept_residuals[level] = self.residual.copy()
+        elif self.residuals_retention == 'memmap':
+            # unique name so several Peeler (segments) can share the same directory
+            fd, filename = tempfile.mkstemp(prefix = 'residuals_level{}_'.format(level), suffix = '.raw', dir = self.memmap_dirname)
+            os.close(fd)
+            self.memmap_filenames[level] = filename
+            arr = np.memmap(filename, dtype = self.residual.dtype, mode = 'w+', shape = self.residual.shape)
+            arr[:] = self.residual
+            arr.flush()
+            del arr
+            self.kept_residuals[level] = np.memmap(filename, dtype = self.residual.dtype, mode = 'r', shape = self.residual.shape)
+    
+    def close(self):
+        """
+        Remove raw files of residuals_retention='memmap'.
+        """
+        for level, filename in list(self.memmap_filenames.items()):
+            self.kept_residuals.pop(level, None)
+            if os.path.exists(filename):
+                os.remove(filename)
+            del self.memmap_filenames[level]
+    
+    def __del__(self):
+        if getattr(self, 'memmap_filenames', None):
+            self.close()
+    
+    def get_residuals(self, level):
+        """
+        Get the residuals after a given level.
+        If they are not kept (see residuals_retention) they are recomputed from
+        signals and the spikes of all levels up to this one.
+        
+        Returns
+        ----------
+        residuals: pd.DataFrame
+        """
+        assert level<self.level, 'level {} not peeled yet'.format(level)
+        if level == self.level-1:
+            residual = self.residual
+        elif level in self.kept_residuals:
+            residual = self.kept_residuals[level]
+        else:
+            residual = np.array(self.signals.values, dtype = self.residual.dtype)
+            for l in range(level+1):
+                self.subtract_prediction(residual, self.spike_pos[l], self.spike_jitters[l], self.spike_labels[l])
+        return pd.DataFrame(residual, index = self.signals.index, columns = self.signals.columns, copy = False)
+
+    def get_spikes(self, seg_num = 0):
+        """
+        All spikes of all levels in one structured array sorted by position.
+        
+        Returns
+        ----------
+        spikes: np.array
+            dtype is spiketable.spike_dtype ('index', 'segment', 'label', 'jitter', 'level')
+        """
+        levels = sorted(self.spike_pos.keys())
+        if len(levels) == 0:
+            return make_spikes(np.zeros(0, dtype = 'int64'), 0, 0., 0, segment = seg_num)
+        return make_spikes(np.concatenate([self.spike_pos[l] for l in levels]),
+                        np.concatenate([self.spike_labels[l] for l in levels]),
+                        np.concatenate([self.spike_jitters[l] for l in levels]),
+                        np.concatenate([np.full(self.spike_pos[l].size, l, dtype = 'uint8') for l in levels]),
+                        segment = seg_num)
+    
+    def get_spike_table(self, seg_num = 0):
+        """
+        SpikeTable of all levels done, it is cached (by seg_num) until the next peel.
+        """
+        if seg_num not in self._spike_tables:
+            self._spike_tables[seg_num] = SpikeTable(self.get_spikes(seg_num = seg_num), cluster_labels = self.cluster_labels)
+        return self._spike_tables[seg_num]
+    
+    def get_spiketrain(self, k, seg_num = 0):
+        return self.get_spike_table(seg_num = seg_num).get_spiketrain(k)
+    
+    def get_spiketrains(self, seg_num = 0):
+        return self.get_spike_table(seg_num = seg_num).get_spiketrains()
+
+
+def peel_chunk(dataio, catalogue, seg_num, i_start, i_stop, margin, med, mad, nb_level = 3, engine = 'peeler',
+                residual_stats = False, **peeler_params):
+    """
+    Apply the Peeler on one chunk of a DataIO segment.
+    
+    The chunk is read with a margin on each side so that spikes near the border
+    are well resolved, and only spikes that are in [i_start, i_stop[ are returned.
+    So when chunks are contiguous, a spike is never counted twice.
+    
+    Arguments
+    ---------------
+    dataio: DataIO
+    catalogue: dict
+    seg_num: int
+    i_start, i_stop: int
+        Sample position of the chunk.
+    margin: int
+        Number of samples read before and after the chunk.
+    med, mad: np.array
+        Noise estimation of the segment used to normalize signals.
+    nb_level: int
+        Maximum number of peel levels (see Peeler_.run), or of greedy iterations
+        for engine='templatematching'.
+    engine: 'peeler' or 'templatematching'
+        Peeler_ (detection then classification) or TemplateMatcher.
+    residual_stats: bool
+        If True also return the residual around spikes of each cluster (see cluster_residual_stats).
+    peeler_params:
+        Other parameters for Peeler_ (threshold, peak_sign, n_span) or TemplateMatcher
+        (min_gain_ratio, nfft, detection parameters are ignored).
+    
+    Returns
+    ----------
+    spikes: np.array
+        See Peeler_.get_spikes, 'index' is relative to the segment start.
+    stats: tuple
+        Only if residual_stats, see cluster_residual_stats.
+    """
+    nb_sample = dataio.get_segment_shape(seg_num)[0]
+    read_start = max(i_start - margin, 0)
+    read_stop = min(i_stop + margin, nb_sample)
+    sigs = dataio.get_signals_chunk(seg_num = seg_num, i_start = read_start, i_stop = read_stop)
+    return peel_signals(sigs, catalogue, read_start, i_start, i_stop, med, mad, nb_level = nb_level,
+                        seg_num = seg_num, engine = engine, residual_stats = residual_stats, **peeler_params)
 
-    def get_spiketrain(self, k):
-        all_pos = []
-        for l, labels in self.spike_labels.items():
-            all_pos.append(self.spike_pos[l][labels==k])
-        all_pos = np.concatenate(all_pos, axis = 0)
-        return np.sort(all_pos)
+
+def peel_signals(sigs, catalogue, read_start, i_start, i_stop, med, mad, nb_level = 3, seg_num = 0,
+                    engine = 'peeler', residual_stats = False, **peeler_params):
+    """
+    Same as peel_chunk but on signals already read (pd.DataFrame), sigs.iloc[0] being
+    the sample read_start of the segment.
+    """
+    assert engine in ('peeler', 'templatematching'), 'Unknown engine {}'.format(engine)
+    normed_sigs = (sigs - med)/mad
     
-    def get_spiketrains(self):
-        return { k:self.get_spiketrain(k) for k in self.cluster_labels }
+    if engine == 'peeler':
+        # signals are already normalized with the noise of the segment
+        nb_channel = normed_sigs.shape[1]
+        peeler = Peeler_(normed_sigs, catalogue, med = np.zeros(nb_channel), mad = np.ones(nb_channel),
+                                    verbose = False, **peeler_params)
+        peeler.run(max_levels = nb_level)
+        spikes = peeler.get_spikes(seg_num = seg_num)
+        residual = peeler.residual
+    else:
+        # the detection is not used by template matching
+        params = { k:v for k, v in peeler_params.items() if k not in ('threshold', 'peak_sign', 'n_span') }
+        unknown = [k for k in params if k not in template_matching_params]
+        assert len(unknown) == 0, 'Parameters {} are not available with engine=templatematching'.format(unknown)
+        matcher = TemplateMatcher(normed_sigs, catalogue, max_iter = nb_level, **params)
+        spikes = matcher.run(seg_num = seg_num)
+        residual = matcher.residual
+    
+    spikes['index'] += read_start
+    keep = (spikes['index']>=i_start) & (spikes['index']<i_stop)
+    spikes = spikes[keep]
+    if not residual_stats:
+        return spikes
+    return spikes, cluster_residual_stats(residual, spikes['index'] - read_start, spikes['label'], catalogue)
+
+
+def cluster_residual_stats(residual, spike_pos, labels, catalogue):
+    """
+    Residual around spikes of each cluster of the catalogue, after the peel.
+    The mean residual of a cluster is the error of its center (at jitter 0),
+    and the residual energy by spike grows when the center do not fit anymore.
+    
+    Arguments
+    ---------------
+    residual: np.array
+        shape (nb_sample, nb_channel)
+    spike_pos, labels: np.array
+        Position in residual and label of spikes.
+    
+    Returns
+    ----------
+    nb_spike: np.array
+        shape (nb_cluster, ) number of spikes used for each cluster (spikes too near borders are not)
+    residual_sum: np.array
+        shape (nb_cluster, nb_channel, width+4) sum of the residual windows, with 2 samples
+        of margin on each side (see catalogue.update_centers)
+    residual_energy: np.array
+        shape (nb_cluster, ) sum of square of the residual windows (without margin)
+    """
+    n_left, n_right = catalogue['limit_left'], catalogue['limit_right']
+    width = n_right - n_left
+    cluster_labels = catalogue['cluster_labels']
+    nb_cluster = cluster_labels.size
+    
+    keep = (spike_pos+n_left-2>=0) & (spike_pos+n_right+2<=residual.shape[0])
+    spike_pos = spike_pos[keep]
+    cluster_index = { k:i for i, k in enumerate(cluster_labels) }
+    cluster_idx = np.array([cluster_index[k] for k in labels[keep]], dtype = 'int64')
+    
+    chunks = cut_chunks(residual, spike_pos+n_left-2, width+4)
+    nb_spike = np.bincount(cluster_idx, minlength = nb_cluster)
+    residual_sum = np.zeros((nb_cluster, ) + chunks.shape[1:], dtype = residual.dtype)
+    np.add.at(residual_sum, cluster_idx, chunks)
+    residual_energy = np.bincount(cluster_idx, weights = np.sum(chunks[:, :, 2:-2]**2, axis=(1, 2)), minlength = nb_cluster)
+    return nb_spike, residual_sum, residual_energy
+
+
+class StreamingPeeler:
+    """
+    Apply the Peeler on DataIO segments chunk by chunk.
+    
+    Each chunk is read from the DataIO with a margin, normalized with the noise
+    of its segment, and peeled at all levels. Spikes are appended to the
+    DataIO store ('segment_N/spikes') chunk after chunk, so memory is constant
+    whatever the recording duration.
+    
+    Every checkpoint_interval chunks, the position of the last chunk done and the
+    number of spikes written are saved in the DataIO directory (see
+    DataIO.save_peeler_checkpoint), so an interrupted run can be continued with
+    run(resume=True). With track_drift the drifted catalogue and the drift stats
+    are saved with the checkpoint (see DataIO.save_peeler_drift), so a resumed run
+    gives the same spikes as a run that was never interrupted.
+    
+    Usage:
+        streamingpeeler = StreamingPeeler(dataio, catalogue, chunksize=60000)
+        streamingpeeler.run()
+        spikes = dataio.get_spikes(seg_num=0)
+        
+        #after a crash
+        streamingpeeler.run(resume=True)
     
+    Arguments
+    ---------------
+    dataio: DataIO
+    catalogue: dict
+        Given by Clustering.construct_catalogue or DataIO.load_catalogue.
+    chunksize: int
+        Number of samples by chunk.
+    margin: int or None
+        Number of samples read before and after each chunk.
+        By default 3 times the waveform width.
+    nb_level: int
+        Maximum number of peel levels by chunk (see Peeler_.run).
+    noise_chunksize: int
+        Number of samples at the beginning of each segment for noise estimation.
+    n_jobs: int
+        Number of processes. When n_jobs>1 chunks of all segments are peeled in
+        a process pool (see run_parallel).
+    engine: 'peeler' or 'templatematching'
+        See peel_chunk.
+    checkpoint_interval: int
+        Number of chunks between checkpoints.
+    track_drift: bool
+        Measure the residual by cluster after each chunk and update centers.
+    drift_alpha: float
+        Weight of the last chunk in the center update, 0 only flags clusters.
+    drift_min_spikes: int
+        Minimum number of spikes of a cluster in a chunk to update or flag it.
+    drift_energy_ratio: float
+        See track_drift.
+    peeler_params:
+        Other parameters for the Peeler (threshold, peak_sign, n_span) or the TemplateMatcher.
+    
+    """
+    def __init__(self, dataio, catalogue, chunksize = 60000, margin = None, nb_level = 3,
+                    noise_chunksize = 150000, n_jobs = 1, engine = 'peeler', checkpoint_interval = 1,
+                    track_drift = False, drift_alpha = 0.2, drift_min_spikes = 5, drift_energy_ratio = 1.5,
+                    **peeler_params):
+        self.dataio = dataio
+        self.catalogue = catalogue
+        if not all(k in catalogue for k in peeler_constants):
+            complete_catalogue(catalogue)
+        self.chunksize = chunksize
+        if margin is None:
+            margin = 3*(catalogue['limit_right'] - catalogue['limit_left'])
+        self.margin = margin
+        self.nb_level = nb_level
+        self.noise_chunksize = noise_chunksize
+        self.n_jobs = n_jobs
+        self.engine = engine
+        self.checkpoint_interval = checkpoint_interval
+        self.peeler_params = peeler_params
+        self.checkpoint = {}
+        
+        assert not (track_drift and n_jobs>1), 'track_drift need n_jobs=1'
+        self.track_drift = track_drift
+        self.drift_alpha = drift_alpha
+        self.drift_min_spikes = drift_min_spikes
+        self.drift_energy_ratio = drift_energy_ratio
+        if track_drift:
+            # centers are replaced (not modified inplace) so the catalogue given is kept
+            self.catalogue = dict(catalogue)
+        self.reference_energy = {}
+        self.drifting_clusters = set()
+        self.drift_stats = []
+        self.drift_num = 0
+    
+    def estimate_noise(self, seg_num):
+        """
+        Median and mad of each channel on the first samples of a segment.
+        """
+        sigs = self.dataio.get_signals_chunk(seg_num = seg_num, i_start = 0, i_stop = self.noise_chunksize)
+        med, mad = median_mad(sigs, axis = 0)
+        return med.values, mad.values
+    
+    def chunk_limits(self, seg_num, start = 0):
+        """
+        List of (i_start, i_stop) for all chunks of a segment from start.
+        """
+        nb_sample = self.dataio.get_segment_shape(seg_num)[0]
+        return [ (i, min(i+self.chunksize, nb_sample)) for i in range(start, nb_sample, self.chunksize) ]
+    
+    def run(self, seg_nums = 'all', resume = False):
+        """
+        Peel segments.
+        
+        Arguments
+        ---------------
+        seg_nums: 'all' or list
+        resume: bool
+            If True restart each segment from its last checkpoint (segments already
+            done are skipped), otherwise spikes of segments are removed and
+            peeled again.
+        """
+        if seg_nums == 'all':
+            seg_nums = self.dataio.segments.index
+        self.checkpoint = self.dataio.load_peeler_checkpoint()
+        if self.track_drift:
+            # the last drift state saved is the one of the last checkpoint
+            nums = [cursor['drift'] for cursor in self.checkpoint.values() if 'drift' in cursor]
+            self.drift_num = max(nums) + 1 if len(nums) else 0
+            if resume and len(nums):
+                self.set_drift_state(*self.dataio.load_peeler_drift(max(nums)))
+        if self.n_jobs == 1:
+            for seg_num in seg_nums:
+                self.run_segment(seg_num, resume = resume)
+        else:
+            self.run_parallel(seg_nums, resume = resume)
+    
+    def restart_position(self, seg_num, resume):
+        """
+        Prepare spikes of a segment and return the sample position where to start.
+        When resuming, spikes written after the checkpoint are removed.
+        """
+        if resume and seg_num in self.checkpoint:
+            cursor = self.checkpoint[seg_num]
+            self.dataio.truncate_spikes(seg_num = seg_num, nb_spike = cursor['nb_spike'])
+            return cursor['i_stop']
+        # the checkpoint on disk must not refer to spikes that are removed
+        self.checkpoint.pop(seg_num, None)
+        self.dataio.save_peeler_checkpoint(self.checkpoint)
+        self.dataio.remove_spikes(seg_num)
+        return 0
+    
+    def save_checkpoint(self, seg_num, i_stop):
+        self.checkpoint[seg_num] = {'i_stop' : int(i_stop), 'nb_spike' : int(self.dataio.get_nb_spikes(seg_num = seg_num))}
+        if self.track_drift:
+            self.dataio.save_peeler_drift(self.drift_num, self.catalogue, self.get_drift_state())
+            self.checkpoint[seg_num]['drift'] = self.drift_num
+            self.drift_num += 1
+        self.dataio.save_peeler_checkpoint(self.checkpoint)
+        if self.track_drift:
+            self.dataio.remove_peeler_drift(keep = [cursor['drift'] for cursor in self.checkpoint.values() if 'drift' in cursor])
+    
+    def run_parallel(self, seg_nums, resume = False):
+        """
+        Peel chunks of all segments in a process pool.
+        
+        Each worker receives the catalogue once at startup. Signals of segments are
+        exported once in raw files (see DataIO.export_signals_memmap) and workers read
+        their chunk through a memmap, so only (seg_num, limits, noise) is sent to
+        workers. Chunks are streamed with imap: workers read and peel next chunks
+        while spikes are appended in time order as they come back.
+        """
+        tasks = []
+        memmaps = {}
+        for seg_num in seg_nums:
+            med, mad = self.estimate_noise(seg_num)
+            start = self.restart_position(seg_num, resume)
+            nb_sample = self.dataio.get_segment_shape(seg_num)[0]
+            for i_start, i_stop in self.chunk_limits(seg_num, start = start):
+                read_start = max(i_start - self.margin, 0)
+                read_stop = min(i_stop + self.margin, nb_sample)
+                tasks.append((seg_num, read_start, read_stop, i_start, i_stop, med, mad))
+                if seg_num not in memmaps:
+                    memmaps[seg_num] = self.dataio.export_signals_memmap(seg_num)
+        
+        initargs = (self.catalogue, self.nb_level, self.engine, self.peeler_params, memmaps)
+        with multiprocessing.Pool(processes = self.n_jobs, initializer = _init_peel_worker, initargs = initargs) as pool:
+            cursors = {}
+            for c, (task, spikes) in enumerate(zip(tasks, pool.imap(_peel_signals_worker, tasks))):
+                self.dataio.append_spikes(spikes, seg_num = task[0])
+                cursors[task[0]] = task[4]
+                if (c+1) % self.checkpoint_interval == 0 or c == len(tasks)-1:
+                    for seg_num, i_stop in cursors.items():
+                        self.save_checkpoint(seg_num, i_stop)
+    
+    def run_segment(self, seg_num, resume = False):
+        med, mad = self.estimate_noise(seg_num)
+        start = self.restart_position(seg_num, resume)
+        chunk_limits = self.chunk_limits(seg_num, start = start)
+        for c, (i_start, i_stop) in enumerate(chunk_limits):
+            spikes = peel_chunk(self.dataio, self.catalogue, seg_num, i_start, i_stop, self.margin,
+                            med, mad, nb_level = self.nb_level, engine = self.engine,
+                            residual_stats = self.track_drift, **self.peeler_params)
+            if self.track_drift:
+                spikes, stats = spikes
+                self.update_drift(seg_num, i_start, stats)
+            self.dataio.append_spikes(spikes, seg_num = seg_num)
+            if (c+1) % self.checkpoint_interval == 0 or c == len(chunk_limits)-1:
+                self.save_checkpoint(seg_num, i_stop)
+    
+    def update_drift(self, seg_num, i_start, stats):
+        """
+        Flag clusters and update centers with the residual stats of one chunk
+        (see cluster_residual_stats).
+        """
+        nb_spike, residual_sum, residual_energy = stats
+        cat = self.catalogue
+        size = cat['nb_channel']*(cat['limit_right'] - cat['limit_left'])
+        enough = nb_spike >= self.drift_min_spikes
+        # mean square of the residual by sample, ~1 for a good center on normed signals
+        energy = residual_energy / np.maximum(nb_spike, 1) / size
+        for i, k in enumerate(cat['cluster_labels']):
+            if not enough[i]:
+                continue
+            if k not in self.reference_energy:
+                self.reference_energy[k] = energy[i]
+            flag = energy[i] > self.drift_energy_ratio*self.reference_energy[k]
+            if flag:
+                self.drifting_clusters.add(k)
+            else:
+                self.drifting_clusters.discard(k)
+            self.drift_stats.append({'seg_num' : seg_num, 'i_start' : i_start, 'label' : k, 'nb_spike' : nb_spike[i],
+                        'residual_energy' : energy[i], 'reference_energy' : self.reference_energy[k], 'flag' : flag})
+        
+        if self.drift_alpha > 0 and np.any(enough):
+            deltas = residual_sum / np.maximum(nb_spike, 1)[:, None, None]
+            update_centers(cat, deltas, np.where(enough, self.drift_alpha, 0.))
+    
+    def get_drift_stats(self):
+        """
+        Residual by cluster and by chunk when track_drift.
+        
+        Returns
+        ----------
+        stats: pd.DataFrame
+            One line per chunk and cluster with enough spikes, columns are:
+              * 'seg_num', 'i_start': the chunk
+              * 'label', 'nb_spike'
+              * 'residual_energy': mean square of the residual around spikes (before the update)
+              * 'reference_energy': residual_energy of the first chunk of the cluster
+              * 'flag': residual_energy > drift_energy_ratio*reference_energy
+        """
+        columns = [name for name, _ in drift_stats_dtype]
+        return pd.DataFrame(self.drift_stats, columns = columns)
+    
+    def get_drift_state(self):
+        """
+        Reference energies, drifting clusters and drift stats as np.array
+        (drifted centers are in self.catalogue).
+        """
+        columns = [name for name, _ in drift_stats_dtype]
+        stats = [ tuple(d[c] for c in columns) for d in self.drift_stats ]
+        return {'reference_labels' : np.array(list(self.reference_energy.keys()), dtype = 'int64'),
+                'reference_energy' : np.array(list(self.reference_energy.values()), dtype = 'float64'),
+                'drifting_clusters' : np.array(sorted(self.drifting_clusters), dtype = 'int64'),
+                'stats' : np.array(stats, dtype = drift_stats_dtype)}
+    
+    def set_drift_state(self, catalogue, drift_state):
+        """
+        Continue the drift tracking from a state saved with a checkpoint (see DataIO.load_peeler_drift).
+        """
+        self.catalogue = catalogue
+        self.reference_energy = dict(zip(drift_state['reference_labels'].tolist(), drift_state['reference_energy'].tolist()))
+        self.drifting_clusters = set(drift_state['drifting_clusters'].tolist())
+        columns = [name for name, _ in drift_stats_dtype]
+        self.drift_stats = [ dict(zip(columns, row)) for row in drift_state['stats'].tolist() ]
+
+
+# columns of StreamingPeeler.get_drift_stats
+drift_stats_dtype = [('seg_num', 'int64'), ('i_start', 'int64'), ('label', 'int64'), ('nb_spike', 'int64'),
+                ('residual_energy', 'float64'), ('reference_energy', 'float64'), ('flag', 'bool')]
+
+
+# state of each worker process of StreamingPeeler.run_parallel
+_worker_context = {}
+
+def _init_peel_worker(catalogue, nb_level, engine, peeler_params, memmaps):
+    _worker_context['catalogue'] = catalogue
+    _worker_context['nb_level'] = nb_level
+    _worker_context['engine'] = engine
+    _worker_context['peeler_params'] = peeler_params
+    _worker_context['memmaps'] = memmaps
+
+def _peel_signals_worker(task):
+    seg_num, read_start, read_stop, i_start, i_stop, med, mad = task
+    ctx = _worker_context
+    sigs = read_memmap_chunk(ctx['memmaps'][seg_num], read_start, read_stop)
+    return peel_signals(sigs, ctx['catalogue'], read_start, i_start, i_stop, med, mad,
+                        nb_level = ctx['nb_level'], seg_num = seg_num, engine = ctx['engine'], **ctx['peeler_params'])
+
 
 from .mpl_plot import PeelerPlot
 class Peeler(Peeler_, PeelerPlot):
@@ -0,0 +1,241 @@
+import os
+import time
+import json
+import copy
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from .dataio import DataIO
+from .spikesorter import SpikeSorter
+from .clustering import Clustering
+from .peaktable import PeakTable
+from .peeler import StreamingPeeler
+
+
+"""
+Pipeline runner: all steps of a sort driven by one parameter dict (or json file).
+
+Stages are run in this order:
+  * 'dataio' : open the DataIO (signals must already be appended)
+  * 'detect_peaks_extract_waveforms' : see SpikeSorter.detect_peaks_extract_waveforms
+  * 'project' : see Clustering.project
+  * 'find_clusters' : see Clustering.find_clusters
+  * 'construct_catalogue' : see Clustering.construct_catalogue
+  * 'peel' : see StreamingPeeler
+
+The output of each stage is written in the DataIO directory (hdf5 store keys
+'pipeline/...', catalogue.npz and spikes) and the state of stages in pipeline.json.
+A stage already done with the same parameters is skipped (its output is
+only loaded if a next stage need it). When a stage is run again all next
+stages are run again. After a failure, the next run start at the failed stage,
+and the peel stage restart from its last checkpoint.
+
+"""
+
+stage_names = ['dataio', 'detect_peaks_extract_waveforms', 'project', 'find_clusters', 'construct_catalogue', 'peel']
+
+default_params = {
+    'dataio' : {},
+    'detect_peaks_extract_waveforms' : {'threshold' : -4, 'peak_sign' : '-', 'n_span' : 2, 'n_left' : -30, 'n_right' : 50},
+    'project' : {'method' : 'pca', 'n_components' : 5},
+    'find_clusters' : {'n_clusters' : 5, 'method' : 'kmeans'},
+    'construct_catalogue' : {'n_max_per_cluster' : 1000},
+    'peel' : {'chunksize' : 60000, 'nb_level' : 3},
+}
+
+# stages whose output is needed to run a stage
+stage_inputs = {
+    'dataio' : [],
+    'detect_peaks_extract_waveforms' : [],
+    'project' : ['detect_peaks_extract_waveforms'],
+    'find_clusters' : ['detect_peaks_extract_waveforms', 'project'],
+    'construct_catalogue' : ['detect_peaks_extract_waveforms', 'project', 'find_clusters'],
+    'peel' : ['construct_catalogue'],
+}
+
+
+class Pipeline:
+    """
+    Run (or continue) a full sort.
+
+    Usage:
+        dataio = DataIO(dirname = 'test')
+        dataio.append_signals(sigs, seg_num=0, sampling_rate = 10000.)
+
+        pipeline = Pipeline({'dataio' : {'dirname' : 'test'}, 'find_clusters' : {'n_clusters' : 7}})
+        # or pipeline = Pipeline('params.json')
+        report = pipeline.run()
+        print(report)
+
+        #later or after a crash: done stages are skipped
+        report = pipeline.run()
+
+    Arguments
+    ---------------
+    params: dict or str
+        Parameters of each stage {stage_name : {param : value}} (see default_params)
+        or a json file with this dict. Missing stages or parameters take the default values,
+        except params['dataio']['dirname'] which is required.
+    trace_memory: bool (default False)
+        Measure the peak of memory of each stage with tracemalloc. This slow down
+        stages a lot, so times are only comparable between runs with the same value.
+
+    """
+    def __init__(self, params, trace_memory = False):
+        if isinstance(params, str):
+            with open(params, 'r', encoding = 'utf8') as f:
+                params = json.load(f)
+        for k in params:
+            assert k in stage_names, 'Unknown stage {}'.format(k)
+        assert 'dirname' in params.get('dataio', {}), "dirname is required in params['dataio']"
+
+        self.params = {}
+        for k in stage_names:
+            p = copy.deepcopy(default_params[k])
+            p.update(params.get(k, {}))
+            # same as once saved in json, so it can be compared with the state
+            self.params[k] = json.loads(json.dumps(p))
+
+        self.trace_memory = trace_memory
+        self.dataio = DataIO(**self.params['dataio'])
+        self.state_filename = os.path.join(self.dataio.dirname, 'pipeline.json')
+        self.spikesorter = None
+        self.catalogue = None
+        self.report = None
+
+    def load_state(self):
+        """
+        State of stages {stage_name : {'status' : 'started' or 'done', 'params' : ..., 'time' : ..., 'peak_memory' : ...}}
+        """
+        if not os.path.exists(self.state_filename):
+            return {}
+        with open(self.state_filename, 'r', encoding = 'utf8') as f:
+            return json.load(f)
+
+    def save_state(self, state):
+        # replaced atomically like the peeler checkpoint
+        self.dataio.store.flush(fsync = True)
+        with open(self.state_filename+'.tmp', 'w', encoding = 'utf8') as f:
+            json.dump(state, f, indent = 4)
+        os.replace(self.state_filename+'.tmp', self.state_filename)
+
+    def run(self, force = False):
+        """
+        Run stages that are not done yet.
+
+        Arguments
+        ---------------
+        force: bool
+            Run all stages again.
+
+        Returns
+        ----------
+        report: pd.DataFrame
+            For each stage: 'status' ('done' or 'skipped'), 'time' wall time in s
+            and 'peak_memory' the peak of memory allocated during the stage in MB
+            (python objects and numpy arrays of this process, not the workers when n_jobs>1),
+            NaN if trace_memory is False. Both are NaN for skipped stages.
+        """
+        state = self.load_state()
+        report = pd.DataFrame(index = stage_names, columns = ['status', 'time', 'peak_memory'])
+        loaded = set()
+        rerun = force
+        for name in stage_names:
+            stage_state = state.get(name, {})
+            done = stage_state.get('status') == 'done' and stage_state.get('params') == self.params[name]
+            if done and not rerun:
+                report.loc[name] = ['skipped', np.nan, np.nan]
+                continue
+
+            # the peel stage can restart at its checkpoint if only the peel has failed
+            resume = not rerun and stage_state.get('status') == 'started' and stage_state.get('params') == self.params[name]
+            rerun = True
+            for input_name in stage_inputs[name]:
+                if input_name not in loaded:
+                    getattr(self, 'load_'+input_name)()
+                    loaded.add(input_name)
+
+            state[name] = {'status' : 'started', 'params' : self.params[name]}
+            self.save_state(state)
+
+            if self.trace_memory:
+                was_tracing = tracemalloc.is_tracing()
+                if was_tracing:
+                    tracemalloc.stop()
+                tracemalloc.start()
+            t0 = time.perf_counter()
+            try:
+                if name == 'peel':
+                    self.run_peel(resume = resume)
+                else:
+                    getattr(self, 'run_'+name)()
+                t1 = time.perf_counter()
+                peak_memory = tracemalloc.get_traced_memory()[1]/1024.**2 if self.trace_memory else None
+            finally:
+                if self.trace_memory:
+                    tracemalloc.stop()
+                    if was_tracing:
+                        tracemalloc.start()
+            loaded.add(name)
+
+            state[name].update({'status' : 'done', 'time' : t1-t0, 'peak_memory' : peak_memory})
+            self.save_state(state)
+            report.loc[name] = ['done', t1-t0, peak_memory]
+
+        report['time'] = report['time'].astype('float64')
+        report['peak_memory'] = report['peak_memory'].astype('float64')
+        self.report = report
+        return report
+
+    def run_dataio(self):
+        assert self.dataio.segments is not None, 'No signals in {}, see DataIO.append_signals'.format(self.dataio.dirname)
+
+    def run_detect_peaks_extract_waveforms(self):
+        self.spikesorter = SpikeSorter(dataio = self.dataio)
+        self.spikesorter.detect_peaks_extract_waveforms(**self.params['detect_peaks_extract_waveforms'])
+
+        peaks = self.spikesorter.all_peaks
+        store = self.dataio.store
+        store.put('pipeline/all_waveforms', self.spikesorter.all_waveforms)
+        store.put('pipeline/all_peaks', pd.DataFrame({'segment' : peaks.segment, 'index' : peaks.index}, columns = ['segment', 'index']))
+        store.put('pipeline/limits', pd.Series([self.spikesorter.limit_left, self.spikesorter.limit_right], index = ['limit_left', 'limit_right']))
+
+    def load_detect_peaks_extract_waveforms(self):
+        store = self.dataio.store
+        self.spikesorter = SpikeSorter(dataio = self.dataio)
+        self.spikesorter.all_waveforms = store['pipeline/all_waveforms']
+        df = store['pipeline/all_peaks']
+        t_starts = { seg_num : self.dataio.segments.loc[seg_num, 't_start'] for seg_num in self.dataio.segments.index }
+        self.spikesorter.all_peaks = PeakTable(df['segment'].values, df['index'].values,
+                                    sampling_rate = self.dataio.sampling_rate, t_starts = t_starts)
+        limits = store['pipeline/limits']
+        self.spikesorter.limit_left, self.spikesorter.limit_right = int(limits['limit_left']), int(limits['limit_right'])
+        self.spikesorter.clustering = Clustering(self.spikesorter.all_waveforms)
+
+    def run_project(self):
+        self.spikesorter.project(**self.params['project'])
+        self.dataio.store.put('pipeline/features', self.spikesorter.clustering.features)
+
+    def load_project(self):
+        self.spikesorter.clustering.features = self.dataio.store['pipeline/features']
+
+    def run_find_clusters(self):
+        self.spikesorter.find_clusters(**self.params['find_clusters'])
+        self.dataio.store.put('pipeline/labels', self.spikesorter.clustering.labels)
+
+    def load_find_clusters(self):
+        self.spikesorter.set_labels(self.dataio.store['pipeline/labels'])
+
+    def run_construct_catalogue(self):
+        self.catalogue = self.spikesorter.construct_catalogue(**self.params['construct_catalogue'])
+        self.dataio.save_catalogue(self.catalogue)
+
+    def load_construct_catalogue(self):
+        self.catalogue = self.dataio.load_catalogue()
+        assert self.catalogue is not None, 'No catalogue in {}'.format(self.dataio.dirname)
+
+    def run_peel(self, resume = False):
+        streamingpeeler = StreamingPeeler(self.dataio, self.catalogue, **self.params['peel'])
+        streamingpeeler.run(resume = resume)
@@ -2,12 +2,15 @@ import numpy as np
 import pandas as pd
 import seaborn as sns
 
-from .dataio import DataIO
-from .peakdetector import PeakDetector
-from .waveformextractor import WaveformExtractor
+from .dataio import DataIO, read_memmap_chunk
+from .peakdetector import PeakDetector_
+from .waveformextractor import cut_chunks, find_good_limits
 from .clustering import Clustering
+from .peaktable import PeakTable
+from .tools import median_mad
 
 from collections import OrderedDict
+import multiprocessing
 
 try:
     from pyqtgraph.Qt import QtCore, QtGui
@@ -63,44 +66,117 @@ class SpikeSorter:
     
     def detect_peaks_extract_waveforms(self, seg_nums = 'all',  
                 threshold=-4, peak_sign = '-', n_span = 2,
-                n_left=-30, n_right=50):
+                n_left=-30, n_right=50, mad_threshold = 1.1, n_jobs = 1, chunksize = None):
+        """
+        Detect peaks and extract waveforms of all segments.
+        
+        This is done in 2 passes over chunks of signals (a segment or a part of a
+        segment), each chunk is independent so both passes are done in one process pool
+        when n_jobs>1 (workers read chunks through memmaps, see DataIO.export_signals_memmap,
+        and results are streamed back in the chunks order):
+            1. detect peaks and compute the mad of long waveforms [n_left, n_right[.
+               The good limits are found on the mad of all segments (mean of the mad
+               of each segment weighted by its number of peaks).
+            2. extract waveforms between the limits (with a margin of 2 samples).
+        Waveforms of all chunks are written in one array so they are not copied again.
+        
+        Arguments
+        ---------------
+        seg_nums: 'all' or list
+        threshold, peak_sign, n_span:
+            See PeakDetector.detect_peaks.
+        n_left, n_right: int
+            Limits of long waveforms used to find the good limits.
+        mad_threshold: float
+            See WaveformExtractor.find_good_limits.
+        n_jobs: int
+            Number of processes.
+        chunksize: None or int
+            Segments longer than chunksize samples are split in chunks. Then the noise
+            of the segment is estimated on its first chunksize samples.
+        
+        """
         if seg_nums == 'all':
             seg_nums = self.dataio.segments.index
         
-        self.all_peaks = []
-        self.all_waveforms = []
+        # chunks (seg_num, read_start, read_stop, i_start, i_stop) with a margin for
+        # the detection and the waveforms, and noise of segments that are split
+        margin = max(-n_left, n_right) + n_span + 2
+        chunks = []
+        noises = {}
+        nb_samples = { seg_num : self.dataio.get_segment_shape(seg_num)[0] for seg_num in seg_nums }
         for seg_num in seg_nums:
-            sigs = self.dataio.get_signals(seg_num=seg_num)
-            
-            #peak
-            peakdetector = PeakDetector(sigs, seg_num=seg_num)
-            peakdetector.detect_peaks(threshold=threshold, peak_sign = peak_sign, n_span = n_span)
+            nb_sample = nb_samples[seg_num]
+            if chunksize is None or nb_sample<=chunksize:
+                chunks.append((seg_num, 0, nb_sample, 0, nb_sample))
+                continue
+            sigs = self.dataio.get_signals_chunk(seg_num = seg_num, i_start = 0, i_stop = chunksize)
+            med, mad = median_mad(sigs, axis = 0)
+            noises[seg_num] = (med.values, mad.values)
+            for i_start in range(0, nb_sample, chunksize):
+                i_stop = min(i_start+chunksize, nb_sample)
+                chunks.append((seg_num, max(i_start-margin, 0), min(i_stop+margin, nb_sample), i_start, i_stop))
+        
+        pool = None
+        if n_jobs > 1:
+            memmaps = { seg_num : self.dataio.export_signals_memmap(seg_num) for seg_num in seg_nums }
+            pool = multiprocessing.Pool(processes = n_jobs, initializer = _init_chunk_worker, initargs = (memmaps, ))
+        try:
+            # pass 1: peaks and mad of long waveforms
+            tasks = []
+            for seg_num, read_start, read_stop, i_start, i_stop in chunks:
+                med, mad = noises.get(seg_num, (None, None))
+                tasks.append((seg_num, read_start, read_stop, i_start, i_stop, nb_samples[seg_num], med, mad, threshold, peak_sign, n_span, n_left, n_right))
+            detections = list(self._map_chunks(_detect_chunk, tasks, pool))
             
+            nb_peaks = np.array([d[0].size for d in detections])
+            wf_mads = np.array([d[4] for d in detections])
+            normed_mad = np.sum(wf_mads[nb_peaks>0]*nb_peaks[nb_peaks>0, None], axis=0)/np.sum(nb_peaks)
+            columns = self.dataio.get_signals_chunk(seg_num = seg_nums[0], i_start = 0, i_stop = 1).columns
+            l1, l2 = find_good_limits(normed_mad.reshape(len(columns), -1), mad_threshold = mad_threshold)
+            self.limit_left, self.limit_right = n_left + l1, n_left + l2
             
-            #waveform
-            waveformextractor = WaveformExtractor(peakdetector, n_left=n_left, n_right=n_right)
-            if seg_num==seg_nums[0]:
-                #the first segment impose limits to othes
-                # this shoudl be FIXED later on
-                limit_left, limit_right = waveformextractor.find_good_limits(mad_threshold = 1.1)
-            else:
-                waveformextractor.limit_left = limit_left
-                waveformextractor.limit_right = limit_right
-            short_wf = waveformextractor.get_ajusted_waveforms()
-            self.all_waveforms.append(short_wf)
-
-            peaks = pd.DataFrame(columns = ['label'], index = short_wf.index, dtype ='int32')
-            peaks[:] = -1
-            #~ self.dataio.append_peaks(peaks,seg_num = seg_num, append = False)
-            self.all_peaks.append(peaks)            
-
-        self.all_peaks = pd.concat(self.all_peaks, axis=0)
-        self.all_waveforms = pd.concat(self.all_waveforms, axis=0)
-
-        #create a colum to handle selection on UI
-        self.all_peaks['selected'] = False
+            # pass 2: waveforms between limits, written in place
+            tasks = [ (seg_num, read_start, read_stop, d[0], d[2], d[3], self.limit_left, self.limit_right)
+                                for (seg_num, read_start, read_stop, i_start, i_stop), d in zip(chunks, detections) ]
+            width = self.limit_right - self.limit_left + 4
+            data = np.empty((np.sum(nb_peaks), len(columns)*width), dtype = 'float64')
+            offsets = np.concatenate([[0], np.cumsum(nb_peaks)])
+            for i, wf in enumerate(self._map_chunks(_extract_chunk, tasks, pool)):
+                data[offsets[i]:offsets[i+1], :] = wf
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        
+        #peak index combine (seg_num, peak_time)
+        index = pd.MultiIndex.from_arrays([np.concatenate([np.ones(d[0].size)*c[0] for c, d in zip(chunks, detections)]),
+                                                        np.concatenate([d[1] for d in detections])])
+        sub = np.arange(self.limit_left-2, self.limit_right+2)
+        columns = pd.MultiIndex.from_tuples([(chan, s) for chan in columns for s in sub])
+        self.all_waveforms = pd.DataFrame(data, index = index, columns = columns, copy = False)
+        
+        segment = np.concatenate([np.full(d[0].size, c[0], dtype = 'int32') for c, d in zip(chunks, detections)])
+        t_starts = { seg_num : self.dataio.segments.loc[seg_num, 't_start'] for seg_num in seg_nums }
+        self.all_peaks = PeakTable(segment, np.concatenate([d[0] for d in detections]),
+                                    sampling_rate = self.dataio.sampling_rate, t_starts = t_starts)
         self.clustering = Clustering(self.all_waveforms)
     
+    def _map_chunks(self, func, tasks, pool):
+        """
+        Yield func((sigs, ) + task) for each task (seg_num, read_start, read_stop, ...)
+        in the tasks order. Without pool signals are read from the DataIO, in the pool
+        workers read them through memmaps and results are streamed with imap.
+        """
+        if pool is None:
+            for task in tasks:
+                seg_num, read_start, read_stop = task[:3]
+                sigs = self.dataio.get_signals_chunk(seg_num = seg_num, i_start = read_start, i_stop = read_stop)
+                yield func((sigs, ) + tuple(task))
+        else:
+            for result in pool.imap(_run_chunk_task, [(func, task) for task in tasks]):
+                yield result
+    
     #~ def load_all_peaks(self):
         #~ self.all_peaks = []
         #~ for seg_num in self.dataio.segments.index:
@@ -117,16 +193,77 @@ class SpikeSorter:
     def find_clusters(self, *args, **kargs):
         self.clustering.find_clusters(*args, **kargs)
         assert self.clustering.labels.size==self.all_waveforms.shape[0], 'label size problem {} {}'.format(self.clustering.labels.size, self.all_waveforms.shape[0])
-        self.all_peaks.ix[:, 'label'] = self.clustering.labels
-        self.cluster_labels = np.unique(self.all_peaks['label'].values)
-        self.cluster_count = self.all_peaks.groupby(['label'])['label'].count()
+        self.all_peaks.label[:] = self.clustering.labels.values
+        self._refresh_clusters()
+    
+    def set_labels(self, labels):
+        """
+        Set labels of all peaks (see Clustering.set_labels).
+        """
+        self.clustering.set_labels(labels)
+        self.all_peaks.label[:] = self.clustering.labels.values
+        self._refresh_clusters()
+    
+    def construct_catalogue(self, *args, **kargs):
+        self.catalogue = self.clustering.construct_catalogue(*args, **kargs)
+        return self.catalogue
+    
+    def _refresh_clusters(self, indices = None):
+        """
+        Copy labels of peaks at positions indices (all if None) from the Clustering in all_peaks
+        and take its cluster summaries (maintained incrementally on edits), so nothing
+        here depends on the number of peaks.
+        """
+        if indices is not None:
+            self.all_peaks.label[indices] = self.clustering.labels.values[indices]
+        self.cluster_labels = self.clustering.cluster_labels
+        self.cluster_count = self.clustering.cluster_count
+        self.cluster_indices = self.clustering.cluster_indices
+    
+    def merge_cluster(self, label1, label2):
+        """
+        Merge cluster label2 into label1.
+        """
+        indices = self.clustering.cluster_indices[label2]
+        self.clustering.merge_cluster(label1, label2)
+        self._refresh_clusters(indices)
+    
+    def split_cluster(self, label, n, **kargs):
+        """
+        Split one cluster in n clusters (see Clustering.split_cluster).
+        """
+        indices = self.clustering.cluster_indices[label]
+        self.clustering.split_cluster(label, n, **kargs)
+        self._refresh_clusters(indices)
+    
+    def reassign_peaks(self, indices, label):
+        """
+        Move peaks at positions indices to cluster label.
+        """
+        self.clustering.reassign_peaks(indices, label)
+        self._refresh_clusters(indices)
+    
+    def undo(self):
+        editlog = self.clustering.editlog
+        assert editlog.can_undo, 'Nothing to undo'
+        name, indices, old_labels, new_labels = editlog.edits[editlog.position-1]
+        self.clustering.undo()
+        self._refresh_clusters(indices)
+    
+    def redo(self):
+        editlog = self.clustering.editlog
+        assert editlog.can_redo, 'Nothing to redo'
+        name, indices, old_labels, new_labels = editlog.edits[editlog.position]
+        self.clustering.redo()
+        self._refresh_clusters(indices)
     
     def refresh_colors(self, reset = True, palette = 'husl'):
         if reset:
             self.colors = {}
         
-        self.cluster_labels = np.unique(self.all_peaks['label'].values)
-        self.cluster_count = self.all_peaks.groupby(['label'])['label'].count()
+        if not hasattr(self, 'cluster_labels'):
+            self.cluster_labels, counts = np.unique(self.all_peaks.label, return_counts = True)
+            self.cluster_count = pd.Series(counts, index = self.cluster_labels, name = 'count')
         color_table = sns.color_palette(palette, self.cluster_labels.size)
         for i, k in enumerate(self.cluster_labels):
             if k not in self.colors:
@@ -137,3 +274,49 @@ class SpikeSorter:
             for k, color in self.colors.items():
                 r, g, b = color
                 self.qcolors[k] = QtGui.QColor(r*255, g*255, b*255)
+
+
+# memmaps of segments in each worker process of detect_peaks_extract_waveforms
+_worker_memmaps = {}
+
+def _init_chunk_worker(memmaps):
+    _worker_memmaps.update(memmaps)
+
+def _run_chunk_task(func_task):
+    func, task = func_task
+    seg_num, read_start, read_stop = task[:3]
+    sigs = read_memmap_chunk(_worker_memmaps[seg_num], read_start, read_stop)
+    return func((sigs, ) + tuple(task))
+
+
+def _detect_chunk(task):
+    """
+    Pass 1 of SpikeSorter.detect_peaks_extract_waveforms on one chunk.
+    Return peak positions (in the segment), peak times, noise, mad of long waveforms.
+    """
+    sigs, seg_num, read_start, read_stop, i_start, i_stop, nb_sample, med, mad, threshold, peak_sign, n_span, n_left, n_right = task
+    peakdetector = PeakDetector_(sigs, seg_num = seg_num, med = med, mad = mad)
+    peak_pos = peakdetector.detect_peaks(threshold = threshold, peak_sign = peak_sign, n_span = n_span)
+    
+    # peaks of this chunk far enough from borders of the segment (see extract_peak_waveforms)
+    pos = peak_pos + read_start
+    keep = (pos>=i_start) & (pos<i_stop) & (pos>-n_left+1) & (pos<nb_sample - n_right - 1)
+    peak_pos = peak_pos[keep]
+    
+    long_wf = cut_chunks(peakdetector.normed_sigs.values, peak_pos+n_left, n_right - n_left).reshape(peak_pos.size, -1)
+    if peak_pos.size>0:
+        wf_med = np.median(long_wf, axis=0)
+        wf_mad = np.median(np.abs(long_wf-wf_med), axis=0)*1.4826
+    else:
+        wf_mad = np.zeros(long_wf.shape[1])
+    return peak_pos + read_start, sigs.index.values[peak_pos], np.asarray(peakdetector.med), np.asarray(peakdetector.mad), wf_mad
+
+
+def _extract_chunk(task):
+    """
+    Pass 2 of SpikeSorter.detect_peaks_extract_waveforms on one chunk.
+    """
+    sigs, seg_num, read_start, read_stop, peak_pos, med, mad, limit_left, limit_right = task
+    normed_sigs = (sigs.values - med)/mad
+    chunks = cut_chunks(normed_sigs, peak_pos - read_start + limit_left - 2, limit_right - limit_left + 4)
+    return chunks.reshape(peak_pos.size, -1)
@@ -0,0 +1,90 @@
+import numpy as np
+
+
+"""
+Compact spike table.
+
+Spikes are stored in one numpy structured array sorted by (segment, index):
+  * 'index' : int64 sample position in the segment
+  * 'segment' : int16 segment num
+  * 'label' : int16 cluster label
+  * 'jitter' : float32 sub sample jitter
+  * 'level' : uint8 peel level
+This is 17 bytes by spike (packed).
+
+"""
+
+spike_dtype = [('index', 'int64'), ('segment', 'int16'), ('label', 'int16'),
+                    ('jitter', 'float32'), ('level', 'uint8')]
+
+
+def make_spikes(index, label, jitter, level, segment = 0):
+    """
+    Make a structured spike array sorted by (segment, index).
+    Arguments can be np.array or scalar (for instance segment or level).
+    """
+    index = np.asarray(index)
+    spikes = np.zeros(index.size, dtype = spike_dtype)
+    spikes['index'] = index
+    spikes['segment'] = segment
+    spikes['label'] = label
+    spikes['jitter'] = jitter
+    spikes['level'] = level
+    order = np.lexsort((spikes['index'], spikes['segment']))
+    return spikes[order]
+
+
+class SpikeTable:
+    """
+    Time sorted spikes with a per cluster index.
+
+    Spike positions are also kept grouped by cluster (and time sorted inside a
+    cluster) with start/stop offsets, so get_spiketrain return a view and not a copy.
+
+    Usage:
+        spiketable = SpikeTable(spikes)
+        spiketrain = spiketable.get_spiketrain(k)
+
+    Arguments
+    ---------------
+    spikes: np.array
+        Structured array with spike_dtype sorted by (segment, index), see make_spikes.
+    cluster_labels: np.array or None
+        All labels of the catalogue. Clusters without spikes give empty spiketrains.
+        By default labels present in spikes.
+
+    """
+    def __init__(self, spikes, cluster_labels = None):
+        self.spikes = spikes
+
+        # stable sort keep the time order inside each cluster
+        order = np.argsort(spikes['label'], kind = 'mergesort')
+        self.cluster_spike_index = spikes['index'][order]
+        sorted_labels = spikes['label'][order]
+
+        if cluster_labels is None:
+            cluster_labels = np.unique(sorted_labels)
+        self.cluster_labels = np.asarray(cluster_labels)
+        # cluster_spike_index[cluster_starts[i]:cluster_stops[i]] are spikes of cluster_labels[i]
+        self.cluster_starts = np.searchsorted(sorted_labels, self.cluster_labels, side = 'left')
+        self.cluster_stops = np.searchsorted(sorted_labels, self.cluster_labels, side = 'right')
+        self._cluster_pos = { k:i for i, k in enumerate(self.cluster_labels) }
+
+    def __len__(self):
+        return self.spikes.size
+
+    def __repr__(self):
+        return 'SpikeTable <{} spikes, {} clusters>'.format(self.spikes.size, self.cluster_labels.size)
+
+    def get_spiketrain(self, k):
+        """
+        Sample indexes of spikes of cluster k (a view).
+        """
+        i = self._cluster_pos[k]
+        return self.cluster_spike_index[self.cluster_starts[i]:self.cluster_stops[i]]
+
+    def get_spiketrains(self):
+        return { k:self.get_spiketrain(k) for k in self.cluster_labels }
+
+    def get_spikes_by_level(self, level):
+        return self.spikes[self.spikes['level']==level]
@@ -0,0 +1,190 @@
+import numpy as np
+import pandas as pd
+import scipy.ndimage
+
+from .catalogue import complete_catalogue, peeler_constants
+from .spiketable import make_spikes
+
+
+"""
+Template matching engine, an alternative to the Peeler.
+
+Instead of detecting peaks on the residual and classifying them, the
+cross-correlation of the residual with all centers of the catalogue is computed
+with FFT (overlap-save, all templates in one pass by block). Spikes are then
+picked greedily: the subtraction of center k at position t reduces the
+residual energy by 2*score_k(t) - |center_k|^2, at each iteration the best
+non-overlapping positions are subtracted and scores are computed again only
+within one width around subtracted spikes (elsewhere the residual did not change).
+
+So overlapping spikes and spikes under the detection threshold can be found
+as long as they reduce the residual energy. There is no sub-sample alignment:
+spikes are at integer positions and their jitter is always 0.
+
+"""
+
+# parameters of TemplateMatcher that can be given to peel_chunk/StreamingPeeler
+template_matching_params = ['min_gain_ratio', 'nfft']
+
+
+class TemplateMatcher:
+    """
+    Find spikes on signals by greedy template matching, at integer positions
+    (the 'jitter' of spikes is always 0).
+
+    Usage:
+        matcher = TemplateMatcher(normed_sigs, catalogue)
+        spikes = matcher.run()
+
+    Arguments
+    ---------------
+    signals: pd.DataFrame
+        Normed signals (the same normalization as the catalogue).
+    catalogue: dict
+        Given by Clustering.construct_catalogue or load_catalogue.
+    min_gain_ratio: float
+        A spike of cluster k is accepted when the energy reduction is greater than
+        min_gain_ratio*|center_k|^2 (so when its score is over (1+min_gain_ratio)/2*|center_k|^2).
+    max_iter: int
+        Maximum number of greedy iterations.
+    nfft: int or None
+        FFT size of overlap-save blocks. By default the power of 2 just over 8 times the width.
+
+    """
+    def __init__(self, signals, catalogue, min_gain_ratio = 0.5, max_iter = 10, nfft = None):
+        self.signals = signals
+        self.catalogue = catalogue
+        if not all(k in catalogue for k in peeler_constants):
+            complete_catalogue(catalogue)
+        self.n_left = catalogue['limit_left']
+        self.n_right = catalogue['limit_right']
+        self.width = self.n_right - self.n_left
+        self.nb_channel = catalogue['nb_channel']
+        self.cluster_labels = catalogue['cluster_labels']
+        self.min_gain_ratio = min_gain_ratio
+        self.max_iter = max_iter
+
+        if nfft is None:
+            nfft = 2**int(np.ceil(np.log2(8*self.width)))
+        assert nfft > self.width, 'nfft must be bigger than the width'
+        self.nfft = nfft
+
+        nb_cluster = self.cluster_labels.size
+        # templates with shape (nb_cluster, width, nb_channel)
+        self.templates = catalogue['center'].reshape(nb_cluster, self.nb_channel, self.width).transpose(0, 2, 1)
+        # conjugate spectrum with shape (nb_freq, nb_channel, nb_cluster) for one matmul by block
+        templates_fft = np.fft.rfft(self.templates, n = nfft, axis=1)
+        self.templates_fft_conj = np.ascontiguousarray(np.conj(templates_fft).transpose(1, 2, 0))
+        self.templates_norm2 = catalogue['center_norm2']
+
+        self.residual = np.array(self.signals.values, dtype = 'float64')
+        self.residuals = pd.DataFrame(self.residual, index = self.signals.index, columns = self.signals.columns, copy = False)
+
+        self.spike_pos = {}
+        self.spike_labels = {}
+        self.nb_iter = 0
+
+    def compute_best_gains(self, start = 0, stop = None):
+        """
+        Energy reduction of the best cluster at positions [start, stop[ of the residual,
+        computed by overlap-save blocks. Position t is the first sample of the
+        window so the peak is at t-n_left.
+
+        Returns
+        ----------
+        best_gains: np.array
+            shape (stop-start, ), by default stop is nb_sample-width+1
+        best_clusters: np.array
+            Index in the catalogue of the best cluster at each position.
+        """
+        nb_pos = max(self.residual.shape[0] - self.width + 1, 0)
+        if stop is None:
+            stop = nb_pos
+        best_gains = np.full(max(stop-start, 0), -np.inf)
+        best_clusters = np.zeros(max(stop-start, 0), dtype = 'int64')
+        step = self.nfft - self.width + 1
+        for b in range(start, stop, step):
+            e = min(b+step, stop)
+            spectrum = np.fft.rfft(self.residual[b:b+self.nfft, :], n = self.nfft, axis=0)
+            # sum over channels for all clusters: (nb_freq, 1, nb_channel) x (nb_freq, nb_channel, nb_cluster)
+            scores = np.fft.irfft(np.matmul(spectrum[:, None, :], self.templates_fft_conj)[:, 0, :], n = self.nfft, axis=0)
+            gains = 2*scores[:e-b, :] - self.templates_norm2[None, :]
+            best_clusters[b-start:e-start] = np.argmax(gains, axis=1)
+            best_gains[b-start:e-start] = gains[np.arange(e-b), best_clusters[b-start:e-start]]
+        return best_gains, best_clusters
+
+    def pick_spikes(self, best_gains, best_clusters, start = 0, stop = None):
+        """
+        Positions in [start, stop[ where the gain is over the limit and is the best in
+        a neighborhood of one width on each side.
+        """
+        if stop is None:
+            stop = best_gains.size
+        # the neighborhood of candidates
+        a, b = max(start - self.width + 1, 0), min(stop + self.width - 1, best_gains.size)
+        gains = best_gains[a:b]
+        min_gains = self.min_gain_ratio*self.templates_norm2[best_clusters[a:b]]
+        local_max = scipy.ndimage.maximum_filter1d(gains, size = 2*self.width-1, mode = 'constant', cval = -np.inf)
+        pos, = np.nonzero((gains>=local_max) & (gains>min_gains))
+        pos = pos + a
+        pos = pos[(pos>=start) & (pos<stop)]
+        return pos, best_clusters[pos]
+
+    def subtract(self, pos, cluster_idx):
+        for t, k in zip(pos, cluster_idx):
+            self.residual[t:t+self.width, :] -= self.templates[k]
+
+    def changed_intervals(self, pos, extend = 0):
+        """
+        Merged intervals [start, stop[ of positions whose gain change when spikes
+        at pos are subtracted (one width on each side), plus extend positions on each side.
+        """
+        nb_pos = self.best_gains.size
+        starts = np.maximum(pos - self.width + 1 - extend, 0)
+        stops = np.minimum(pos + self.width + extend, nb_pos)
+        intervals = []
+        for a, b in zip(starts, stops):
+            if len(intervals)>0 and a <= intervals[-1][1]:
+                intervals[-1][1] = max(intervals[-1][1], b)
+            else:
+                intervals.append([a, b])
+        return intervals
+
+    def run(self, seg_num = 0):
+        """
+        Greedy iterations until no spike is accepted or max_iter.
+        Gains are computed on the whole residual once, then only around spikes
+        subtracted by the previous iteration.
+
+        Returns
+        ----------
+        spikes: np.array
+            See Peeler_.get_spikes, 'level' is the iteration and 'jitter' is 0.
+        """
+        self.best_gains, self.best_clusters = self.compute_best_gains()
+        intervals = [[0, self.best_gains.size]]
+        while self.nb_iter < self.max_iter:
+            picked = [self.pick_spikes(self.best_gains, self.best_clusters, a, b) for a, b in intervals]
+            pos = np.concatenate([p[0] for p in picked])
+            cluster_idx = np.concatenate([p[1] for p in picked])
+            if pos.size == 0:
+                break
+            self.subtract(pos, cluster_idx)
+            self.spike_pos[self.nb_iter] = pos - self.n_left
+            self.spike_labels[self.nb_iter] = self.cluster_labels[cluster_idx]
+            self.nb_iter += 1
+
+            for a, b in self.changed_intervals(pos):
+                self.best_gains[a:b], self.best_clusters[a:b] = self.compute_best_gains(a, b)
+            # a position can become a local maximum when a gain changes in its neighborhood
+            intervals = self.changed_intervals(pos, extend = self.width - 1)
+        return self.get_spikes(seg_num = seg_num)
+
+    def get_spikes(self, seg_num = 0):
+        iters = sorted(self.spike_pos.keys())
+        if len(iters) == 0:
+            return make_spikes(np.zeros(0, dtype = 'int64'), 0, 0., 0, segment = seg_num)
+        return make_spikes(np.concatenate([self.spike_pos[i] for i in iters]),
+                        np.concatenate([self.spike_labels[i] for i in iters]), 0.,
+                        np.concatenate([np.full(self.spike_pos[i].size, i, dtype = 'uint8') for i in iters]),
+                        segment = seg_num)
@@ -0,0 +1,121 @@
+import time
+import tempfile
+import numpy as np
+
+from tridesclous import DataIO, Peeler
+from tridesclous import make_shifted_bank, make_low_rank, update_centers
+from tridesclous.clustering import compute_template
+
+from testingtools import get_catalogue
+
+
+def test_save_load_catalogue(tmp_path):
+    dataio, peakdetector, catalogue = get_catalogue()
+    dataio = DataIO(dirname = str(tmp_path))
+    
+    wf1 = catalogue['centerD'][0]
+    assert np.allclose(catalogue['centerD_norm2'][0], wf1.dot(wf1))
+    
+    dataio.save_catalogue(catalogue)
+    t0 = time.perf_counter()
+    catalogue2 = dataio.load_catalogue()
+    t1 = time.perf_counter()
+    print('load catalogue in {:.1f} ms'.format((t1-t0)*1000.))
+    
+    assert set(catalogue2.keys()) == set(catalogue.keys())
+    for k in catalogue:
+        assert np.array_equal(catalogue[k], catalogue2[k])
+    
+    # the loaded catalogue give the limits to the peeler
+    peeler = Peeler(peakdetector.normed_sigs, catalogue2, threshold=-4, peak_sign = '-', n_span = 5)
+    assert peeler.n_left == catalogue['limit_left']
+    assert peeler.n_right == catalogue['limit_right']
+    peeler.peel()
+
+
+def test_shifted_bank(tmp_path):
+    dataio, peakdetector, catalogue = get_catalogue()
+    dataio = DataIO(dirname = str(tmp_path))
+    make_shifted_bank(catalogue, step = 0.1, max_shift = 1.)
+    shifts = catalogue['bank_shifts']
+    bank = catalogue['shifted_bank']
+    assert shifts.size == 21
+    assert bank.shape == (catalogue['center'].shape[0], 21, catalogue['center'].shape[1])
+    
+    # no shift is the center
+    assert np.allclose(bank[:, 10, :], catalogue['center'], atol = 1e-5)
+    
+    # integer shifts are exact: template(t+1) and template(t-1)
+    nb_cluster, nb_channel = catalogue['center'].shape[0], catalogue['nb_channel']
+    centers = catalogue['center'].reshape(nb_cluster, nb_channel, -1)
+    assert np.allclose(bank[:, 20, :].reshape(centers.shape)[:, :, :-1], centers[:, :, 1:], atol = 1e-5)
+    assert np.allclose(bank[:, 0, :].reshape(centers.shape)[:, :, 1:], centers[:, :, :-1], atol = 1e-5)
+    
+    # small shifts are close to the taylor expansion
+    for i in [9, 11]:
+        s = shifts[i]
+        taylor = catalogue['center'] + s*catalogue['centerD'] + s**2/2*catalogue['centerDD']
+        err = np.sum((bank[:, i, :]-taylor)**2, axis=1)/np.sum(catalogue['center']**2, axis=1)
+        print(s, err)
+        assert np.all(err<0.05)
+    
+    # the bank is saved with the catalogue
+    dataio.save_catalogue(catalogue, name = 'catalogue_bank')
+    catalogue2 = dataio.load_catalogue(name = 'catalogue_bank')
+    assert np.array_equal(catalogue2['shifted_bank'], bank)
+
+
+def test_low_rank():
+    dataio, peakdetector, catalogue = get_catalogue()
+    make_low_rank(catalogue, max_error = 0.01)
+    basis = catalogue['temporal_basis']
+    rank, width = basis.shape
+    nb_channel = catalogue['nb_channel']
+    assert width*nb_channel == catalogue['center'].shape[1]
+    assert np.all(catalogue['lowrank_error']<=0.01)
+    
+    # the reported error is the error of the reconstruction
+    for k in ['center', 'centerD', 'centerDD']:
+        t = catalogue[k]
+        rec = catalogue[k+'_lowrank'].reshape(-1, nb_channel, rank).dot(basis).reshape(t.shape)
+        err = np.sum((t-rec)**2, axis=1)/np.sum(t**2, axis=1)
+        assert np.all(err<=catalogue['lowrank_error']+1e-9)
+    
+    # a given rank
+    make_low_rank(catalogue, rank = 2)
+    assert catalogue['temporal_basis'].shape[0] == 2
+    assert catalogue['center_lowrank'].shape[1] == nb_channel*2
+
+
+def test_update_centers():
+    dataio, peakdetector, catalogue = get_catalogue()
+    make_low_rank(catalogue, rank = 3)
+    original = dict(catalogue)
+    nb_cluster = catalogue['cluster_labels'].size
+    nb_channel = catalogue['nb_channel']
+    width = catalogue['limit_right'] - catalogue['limit_left']
+    
+    deltas = np.random.randn(nb_cluster, nb_channel, width+4)
+    weights = np.linspace(0, 1, nb_cluster)
+    update_centers(catalogue, deltas, weights)
+    
+    # derivatives are the ones of clustering.compute_template
+    for i in range(nb_cluster):
+        d, dD, dDD, _ = compute_template(deltas[i][None, :, :])
+        assert np.allclose(catalogue['center'][i], original['center'][i] + weights[i]*d)
+        assert np.allclose(catalogue['centerD'][i], original['centerD'][i] + weights[i]*dD)
+        assert np.allclose(catalogue['centerDD'][i], original['centerDD'][i] + weights[i]*dDD)
+    assert np.array_equal(catalogue['center'][0], original['center'][0])
+    
+    # constants and low rank follow, arrays of the original are not modified
+    assert np.allclose(catalogue['center_norm2'], np.sum(catalogue['center']**2, axis=1))
+    assert catalogue['temporal_basis'].shape[0] == 3
+    assert not np.allclose(catalogue['center_lowrank'], original['center_lowrank'])
+    assert np.allclose(original['center_norm2'], np.sum(original['center']**2, axis=1))
+
+
+if __name__ == '__main__':
+    test_save_load_catalogue(tempfile.mkdtemp())
+    test_shifted_bank(tempfile.mkdtemp())
+    test_low_rank()
+    test_update_centers()
@@ -5,7 +5,9 @@ import seaborn as sns
 
 from tridesclous import DataIO, PeakDetector, WaveformExtractor
 
-from tridesclous import Clustering
+from tridesclous import Clustering, find_clusters
+
+from testingtools import get_clustering
 
 
 
@@ -38,18 +40,104 @@ def test_clustering():
     
     #ùake catalogue
     catalogue = clustering.construct_catalogue()
+    assert catalogue['center'].shape[0] == catalogue['cluster_labels'].size
     clustering.plot_derivatives()
     clustering.plot_catalogue()
 
 
     clustering.merge_cluster(1,2)
+    labels_before = clustering.labels.values.copy()
     clustering.split_cluster(1, 2)
+    # only peaks of cluster 1 are relabeled
+    changed = labels_before!=clustering.labels.values
+    assert np.all(labels_before[changed]==1)
+    assert np.all(clustering.labels.values[labels_before==1]>max(labels_before))
+
+    
+
+
+def test_find_clusters_engines():
+    dataio, peakdetector, clustering = get_clustering()
+    features = clustering.features
+    
+    for method in ['kmeans', 'minibatchkmeans', 'gmm']:
+        # fit on a small subsample and predict all
+        labels = find_clusters(features, 5, method=method, n_fit_max=200, chunksize=100)
+        assert labels.size == features.shape[0]
+        assert np.all(labels.index == features.index)
+        
+        labels = clustering.find_clusters(5, method=method)
+        assert np.unique(labels.values).size<=5
+    
+
+def test_construct_catalogue_parallel():
+    dataio, peakdetector, clustering = get_clustering()
+    clustering.find_clusters(5)
+    
+    catalogue1 = clustering.construct_catalogue(n_max_per_cluster=None, n_jobs=1)
+    catalogue2 = clustering.construct_catalogue(n_max_per_cluster=None, n_jobs=4)
+    for key in ['cluster_labels', 'center', 'centerD', 'centerDD', 'mad']:
+        assert np.array_equal(catalogue1[key], catalogue2[key])
+    
+    catalogue3 = clustering.construct_catalogue(n_max_per_cluster=50, n_jobs=4)
+    assert catalogue3['center'].shape == catalogue1['center'].shape
 
+
+def test_update_catalogue():
+    dataio, peakdetector, clustering = get_clustering()
+    clustering.find_clusters(5)
+    clustering.construct_catalogue(n_max_per_cluster=None)
+    
+    clustering.merge_cluster(1, 2)
+    assert clustering.dirty_labels == set([1])
+    clustering.split_cluster(3, 2)
+    assert 3 not in clustering.dirty_labels and len(clustering.dirty_labels)==3
+    catalogue = clustering.update_catalogue(n_max_per_cluster=None)
+    assert len(clustering.dirty_labels)==0
     
+    # incremental summaries are the same as full recomputation
+    labels = clustering.labels.values
+    assert np.array_equal(catalogue['cluster_labels'], np.unique(labels))
+    for k in catalogue['cluster_labels']:
+        assert clustering.cluster_count[k] == np.sum(labels==k)
+        assert np.allclose(clustering.cluster_centroid.loc[k].values, clustering.features[labels==k].mean(axis=0).values)
     
+    catalogue_full = clustering.construct_catalogue(n_max_per_cluster=None)
+    for key in ['cluster_labels', 'center', 'centerD', 'centerDD', 'mad']:
+        assert np.allclose(catalogue[key], catalogue_full[key])
+    
+    # undo/redo
+    clustering.undo()
+    clustering.undo()
+    assert np.array_equal(clustering.cluster_labels, np.arange(5))
+    for k in clustering.cluster_labels:
+        assert clustering.cluster_count[k] == np.sum(clustering.labels.values==k)
+    clustering.update_catalogue()
+    clustering.redo()
+    assert np.array_equal(clustering.cluster_labels, [0, 1, 3, 4])
+    assert clustering.dirty_labels == set([1])
+    
+    # peaks moved to an existing and a new cluster
+    indices = clustering.cluster_indices[0][:10]
+    clustering.reassign_peaks(indices, 3)
+    clustering.reassign_peaks(clustering.cluster_indices[4][::2], 10)
+    clustering.undo()
+    clustering.redo()
+    clustering.merge_cluster(0, 10)
+    labels = clustering.labels.values
+    assert np.array_equal(clustering.cluster_labels, np.unique(labels))
+    assert np.all(labels[indices]==3)
+    for k in clustering.cluster_labels:
+        assert np.array_equal(clustering.cluster_indices[k], np.nonzero(labels==k)[0])
+        assert clustering.cluster_count[k] == clustering.cluster_indices[k].size
+
+
 if __name__=='__main__':
 
     test_clustering()
+    test_find_clusters_engines()
+    test_construct_catalogue_parallel()
+    test_update_catalogue()
     
     pyplot.show()
 
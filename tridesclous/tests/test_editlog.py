@@ -0,0 +1,55 @@
+import os
+import numpy as np
+from tridesclous import EditLog
+
+
+
+def test_editlog():
+    labels = np.random.randint(0, 5, size=1000)
+    labels_init = labels.copy()
+    editlog = EditLog()
+    
+    #merge 1 into 0
+    indices, = np.nonzero(labels==1)
+    editlog.record('merge', indices, 1, 0)
+    labels[indices] = 0
+    labels_merged = labels.copy()
+    
+    #split 2 in 5 and 6
+    indices, = np.nonzero(labels==2)
+    new_labels = np.random.randint(5, 7, size=indices.size)
+    editlog.record('split', indices, labels[indices], new_labels)
+    labels[indices] = new_labels
+    labels_splited = labels.copy()
+    
+    assert len(editlog)==2
+    assert editlog.edits[0][1].dtype == 'int32'
+    
+    editlog.undo(labels)
+    assert np.array_equal(labels, labels_merged)
+    editlog.undo(labels)
+    assert np.array_equal(labels, labels_init)
+    assert not editlog.can_undo
+    editlog.redo(labels)
+    editlog.redo(labels)
+    assert np.array_equal(labels, labels_splited)
+    assert not editlog.can_redo
+    
+    # save and replay on the initial labels
+    editlog.save('test_editlog.npz')
+    editlog2 = EditLog.load('test_editlog.npz')
+    assert editlog2.position == 2
+    labels2 = editlog2.replay(labels_init.copy())
+    assert np.array_equal(labels2, labels_splited)
+    labels2 = editlog2.replay(labels_init.copy(), position=1)
+    assert np.array_equal(labels2, labels_merged)
+    os.remove('test_editlog.npz')
+    
+    # a new edit after undo forget the redo
+    editlog.undo(labels)
+    editlog.record('merge', np.array([0, 1]), labels[:2], 0)
+    assert len(editlog)==2 and not editlog.can_redo
+
+
+if __name__ == '__main__':
+    test_editlog()
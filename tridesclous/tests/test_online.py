@@ -0,0 +1,117 @@
+import threading
+import queue
+import socket
+
+import numpy as np
+
+from tridesclous import Peeler, OnlinePeeler, RingBuffer, spike_dtype
+
+from testingtools import get_catalogue
+
+
+def test_ring_buffer():
+    ring = RingBuffer(10, 2)
+    data = np.arange(50, dtype = 'float64').reshape(25, 2)
+    ring.write(data[:7])
+    ring.write(data[7:15])
+    assert np.array_equal(ring.read(5, 15), data[5:15])
+    assert np.array_equal(ring.read(8, 12), data[8:12])
+    ring.subtract(9, np.ones((3, 2)))
+    assert np.array_equal(ring.read(9, 12), data[9:12]-1)
+    try:
+        ring.read(2, 12)
+        raise AssertionError('samples overwritten must not be read')
+    except AssertionError as e:
+        assert 'not in the ring buffer' in str(e)
+
+
+def test_online_peeler():
+    dataio, peakdetector, catalogue = get_catalogue()
+    sigs = dataio.get_signals(seg_num=0).values
+    params = dict(threshold=-4, peak_sign = '-', n_span = 5)
+
+    peeler = Peeler(peakdetector.normed_sigs, catalogue, **params)
+    peeler.run(max_levels = 2)
+    spikes_offline = peeler.get_spikes()
+
+    # blocks of 1 ms at 10kHz, with noise frozen on the whole segment to compare
+    block_size = 10
+    nb_block = int(np.ceil(sigs.shape[0]/block_size))
+    onlinepeeler = OnlinePeeler(catalogue, peakdetector.med, peakdetector.mad, nb_level = 2, history = nb_block, **params)
+    emitted = []
+    for i in range(0, sigs.shape[0], block_size):
+        new_spikes = onlinepeeler.push(sigs[i:i+block_size])
+        # latency is bounded
+        assert np.all(new_spikes['index'] >= onlinepeeler.nb_sample - onlinepeeler.delay - block_size)
+        emitted.append(new_spikes)
+    emitted.append(onlinepeeler.flush())
+    spikes = onlinepeeler.get_spikes()
+    assert spikes.dtype == np.dtype(spike_dtype)
+    assert np.array_equal(spikes, np.concatenate(emitted))
+    assert np.all(np.diff(spikes["index"])>=0)
+
+    common = np.intersect1d(spikes_offline['index'], spikes['index'])
+    print(spikes_offline.size, spikes.size, common.size)
+    assert common.size > 0.9 * spikes_offline.size
+
+    stats = onlinepeeler.get_latency_stats()
+    print(stats)
+    assert stats['nb_block'] == nb_block
+    assert stats['p50'] <= stats['p99'] <= stats['max']
+    
+    # a long acquisition keeps only the last blocks
+    onlinepeeler = OnlinePeeler(catalogue, peakdetector.med, peakdetector.mad, nb_level = 2, history = 100, **params)
+    for i in range(0, 50000, block_size):
+        onlinepeeler.push(sigs[i:i+block_size])
+    assert len(onlinepeeler.latencies) == 100 and len(onlinepeeler.spikes) <= 100
+    assert onlinepeeler.get_latency_stats()['nb_block'] == 5000
+    kept = onlinepeeler.get_spikes()
+    assert np.array_equal(kept, spikes[(spikes['index']>=kept['index'][0]) & (spikes['index']<=kept['index'][-1])])
+
+
+def test_online_sources():
+    dataio, peakdetector, catalogue = get_catalogue()
+    sigs = dataio.get_signals(seg_num=0).values[:20000].astype('float32')
+    params = dict(threshold=-4, peak_sign = '-', n_span = 5)
+    med, mad = peakdetector.med, peakdetector.mad
+
+    onlinepeeler = OnlinePeeler(catalogue, med, mad, **params)
+    for i in range(0, sigs.shape[0], 50):
+        onlinepeeler.push(sigs[i:i+50])
+    onlinepeeler.flush()
+    spikes_ref = onlinepeeler.get_spikes()
+
+    # in process queue fed by another thread
+    q = queue.Queue()
+    def feed_queue():
+        for i in range(0, sigs.shape[0], 50):
+            q.put(sigs[i:i+50])
+        q.put(None)
+    thread = threading.Thread(target = feed_queue)
+    thread.start()
+    spikes = OnlinePeeler(catalogue, med, mad, **params).run_queue(q, timeout = 60)
+    thread.join()
+    assert np.array_equal(spikes, spikes_ref)
+
+    # local socket with irregular packets
+    sock_in, sock_out = socket.socketpair()
+    def feed_socket():
+        data = sigs.tobytes()
+        pos = 0
+        while pos < len(data):
+            n = np.random.randint(1, 3000)
+            sock_out.sendall(data[pos:pos+n])
+            pos += n
+        sock_out.close()
+    thread = threading.Thread(target = feed_socket)
+    thread.start()
+    spikes = OnlinePeeler(catalogue, med, mad, **params).run_socket(sock_in, block_size = 50)
+    thread.join()
+    sock_in.close()
+    assert np.array_equal(spikes, spikes_ref)
+
+
+if __name__=='__main__':
+    test_ring_buffer()
+    test_online_peeler()
+    test_online_sources()
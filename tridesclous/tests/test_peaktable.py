@@ -0,0 +1,53 @@
+import numpy as np
+
+from tridesclous import PeakTable
+
+
+def test_peaktable():
+    segment = np.array([0, 0, 0, 0, 2, 2, 2])
+    index = np.array([10, 50, 50, 300, 5, 20, 400])
+    peaks = PeakTable(segment, index, sampling_rate = 100., t_starts = {2 : 10.})
+    print(peaks)
+    assert len(peaks) == 7
+    assert np.all(peaks.label == -1)
+    assert peaks.get_segment_slice(1) == slice(0, 0)
+    
+    assert peaks.get_time(5) == 10.2
+    assert np.allclose(peaks.get_times(), [0.1, 0.5, 0.5, 3., 10.05, 10.2, 14.])
+    assert np.allclose(peaks.get_times(np.array([3, 4])), [3., 10.05])
+    
+    # window limits are included
+    assert peaks.get_window(0, 0.1, 0.5) == slice(0, 3)
+    assert peaks.get_window(0, 0.11, 0.49) == slice(1, 1)
+    assert peaks.get_window(2, 10., 11.) == slice(4, 6)
+    assert peaks.get_window(1, 0., 100.) == slice(0, 0)
+    assert peaks.get_index_window(2, 5, 20) == slice(4, 5)
+    
+    assert peaks.find_peak(0, 2.) == 3
+    assert peaks.find_peak(2, 10.13) == 5
+    assert peaks.find_peak(2, 0.) == 4
+    assert peaks.find_peak(1, 0.) == -1
+    
+    peaks.label[:] = [1, 1, 2, 2, 1, 2, 1]
+    peaks.select([1, 4])
+    assert np.array_equal(peaks.get_selected(), [1, 4])
+    peaks.select(peaks.label==2)
+    assert np.array_equal(peaks.get_selected(), [2, 3, 5])
+    peaks.clear_selection()
+    assert peaks.get_selected().size == 0
+    
+    df = peaks.to_dataframe()
+    assert list(df.columns) == ['segment', 'index', 'time', 'label', 'selected']
+    assert np.array_equal(df['label'].values, peaks.label)
+    
+    # must be sorted
+    for segment, index in [([1, 0], [0, 0]), ([0, 0], [5, 1])]:
+        try:
+            PeakTable(segment, index)
+            raise AssertionError('unsorted peaks must be refused')
+        except AssertionError as e:
+            assert 'sorted' in str(e)
+
+
+if __name__ == '__main__':
+    test_peaktable()
@@ -1,37 +1,23 @@
+import os
+import time
 import pandas as pd
 import numpy as np
 from matplotlib import pyplot
 import seaborn as sns
 
-from tridesclous import DataIO, PeakDetector, WaveformExtractor, Clustering, Peeler
+from tridesclous import DataIO, Peeler, StreamingPeeler, spike_dtype
+from tridesclous.clustering import compute_template
+
+from testingtools import get_catalogue
 
 
 
 def plot_interpolation():
-    dataio = DataIO(dirname = 'datatest')
-    sigs = dataio.get_signals(seg_num=0)
-    
-    #peak
-    peakdetector = PeakDetector(sigs)
-    peak_pos = peakdetector.detect_peaks(threshold=-4, peak_sign = '-', n_span = 5)
-    
-    #waveforms
-    waveformextractor = WaveformExtractor(peakdetector, n_left=-30, n_right=50)
-    limit_left, limit_right = waveformextractor.find_good_limits(mad_threshold = 1.1)
-    #~ print(limit_left, limit_right)
-    short_wf = waveformextractor.get_ajusted_waveforms(margin=2)
-    #~ print(short_wf.shape)
-    
-    #clustering
-    clustering = Clustering(short_wf)
-    features = clustering.project(method = 'pca', n_components = 5)
-    clustering.find_clusters(7)
-    catalogue = clustering.construct_catalogue()
-    
-    k = list(catalogue.keys())[1]
-    w0 = catalogue[k]['center']
-    w1 = catalogue[k]['centerD']
-    w2 = catalogue[k]['centerDD']
+    dataio, peakdetector, catalogue = get_catalogue()
+    
+    w0 = catalogue['center'][1]
+    w1 = catalogue['centerD'][1]
+    w2 = catalogue['centerDD'][1]
     
     fig, ax = pyplot.subplots()
     t = np.arange(w0.size)
@@ -55,35 +41,22 @@ def plot_interpolation():
 
 
 def test_peeler():
-    dataio = DataIO(dirname = 'datatest')
-    sigs = dataio.get_signals(seg_num=0)
-    
-    #peak
-    peakdetector = PeakDetector(sigs)
-    peak_pos = peakdetector.detect_peaks(threshold=-4, peak_sign = '-', n_span = 5)
-    
-    #waveforms
-    waveformextractor = WaveformExtractor(peakdetector, n_left=-30, n_right=50)
-    limit_left, limit_right = waveformextractor.find_good_limits(mad_threshold = 1.1)
-    #~ print(limit_left, limit_right)
-    short_wf = waveformextractor.get_ajusted_waveforms(margin=2)
-    #~ print(short_wf.shape)
-    
-    #clustering
-    clustering = Clustering(short_wf)
-    features = clustering.project(method = 'pca', n_components = 5)
-    clustering.find_clusters(7)
-    catalogue = clustering.construct_catalogue()
-    
-    clustering.plot_catalogue()
+    dataio, peakdetector, catalogue = get_catalogue()
     
     #peeler
     signals = peakdetector.normed_sigs
-    peeler = Peeler(signals, catalogue,  limit_left, limit_right,
+    peeler = Peeler(signals, catalogue,  catalogue['limit_left'], catalogue['limit_right'],
                             threshold=-4, peak_sign = '-', n_span = 5)
     
-    prediction0, residuals0 = peeler.peel()
-    prediction1, residuals1 = peeler.peel()
+    residuals0 = peeler.peel().copy()
+    residuals1 = peeler.peel()
+    # residuals is a view on the unique residual buffer
+    assert np.shares_memory(residuals1.values, peeler.residual)
+    prediction0 = peeler.get_prediction(0)
+    prediction1 = peeler.get_prediction(1)
+    assert np.allclose(signals.values - prediction0, residuals0.values)
+    assert np.allclose(residuals0.values - prediction1, residuals1.values)
+    
     fig, axs = pyplot.subplots(nrows = 6, sharex = True)#, sharey = True)
     axs[0].plot(signals)
     axs[1].plot(prediction0) 
@@ -91,19 +64,365 @@ def test_peeler():
     axs[3].plot(prediction1)
     axs[4].plot(residuals1)
     
-    colors = sns.color_palette('husl', len(catalogue))
+    colors = sns.color_palette('husl', len(catalogue['cluster_labels']))
     spiketrains = peeler.get_spiketrains()
     i = 0
     for k , pos in spiketrains.items():
         axs[5].plot(pos, np.ones(pos.size)*k, ls = 'None', marker = '|',  markeredgecolor = colors[i], markersize = 10, markeredgewidth = 2)
         i += 1
-    axs[5].set_ylim(0, len(catalogue))
+    axs[5].set_ylim(0, len(catalogue['cluster_labels']))
     #markerfacecolor = colors[i],
+
+
+def test_estimate_jitters():
+    dataio, peakdetector, catalogue = get_catalogue()
+    
+    peeler = Peeler(peakdetector.normed_sigs, catalogue, threshold=-4, peak_sign = '-', n_span = 5)
+    
+    # a template with known jitter is recovered
+    k = catalogue['cluster_labels'][1]
+    jitter = 0.3
+    wf = catalogue['center'][1] + jitter*catalogue['centerD'][1] + jitter**2/2*catalogue['centerDD'][1]
+    wf = wf*1.05 # a bit of noise
+    label, jitter1 = peeler.estimate_one_jitter(wf)
+    assert label==k
+    assert abs(jitter1-jitter)<0.1
+    
+    # low rank scores give (almost) the same result
+    peeler_lowrank = Peeler(peakdetector.normed_sigs, catalogue, threshold=-4, peak_sign = '-', n_span = 5, lowrank = True)
+    assert peeler_lowrank.lowrank_error <= 0.01
+    n = 500
+    waveforms = catalogue['center'][np.random.randint(0, 7, size=n)] + np.random.randn(n, catalogue['center'].shape[1])*0.5
+    labels, jitters = peeler.estimate_jitters(waveforms)
+    labels2, jitters2 = peeler_lowrank.estimate_jitters(waveforms)
+    assert np.mean(labels==labels2) > 0.95
+    
+    # candidate clusters by peak channel give (almost) the same result
+    peeler_prefilter = Peeler(peakdetector.normed_sigs, catalogue, threshold=-4, peak_sign = '-', n_span = 5, prefilter = 'peak_channel')
+    assert catalogue['channel_candidates'].shape == (catalogue['nb_channel'], catalogue['center'].shape[0])
+    labels3, jitters3 = peeler_prefilter.estimate_jitters(waveforms)
+    assert np.mean(labels==labels3) > 0.95
+    
+    # batch give the same result as one by one
+    n = 500
+    waveforms = catalogue['center'][np.random.randint(0, 7, size=n)] + np.random.randn(n, catalogue['center'].shape[1])
+    labels, jitters = peeler.estimate_jitters(waveforms)
+    for i in range(0, n, 50):
+        label, jitter1 = peeler.estimate_one_jitter(waveforms[i])
+        assert label == labels[i]
+        assert np.allclose(jitter1, jitters[i])
+
+
+def test_alignment_bank():
+    dataio, peakdetector, catalogue = get_catalogue()
+    
+    peeler = Peeler(peakdetector.normed_sigs, catalogue, threshold=-4, peak_sign = '-', n_span = 5,
+                        alignment_method = 'bank')
+    
+    # a shifted template is recovered with its shift
+    k = catalogue['cluster_labels'][1]
+    wf = catalogue['shifted_bank'][1, 13, :]*1.05
+    label, jitter = peeler.estimate_one_jitter(wf)
+    assert label == k
+    assert np.allclose(jitter, catalogue['bank_shifts'][13])
+    
+    for level in range(2):
+        peeler.peel()
+    spikes_bank = peeler.get_spikes()
+    
+    peeler_taylor = Peeler(peakdetector.normed_sigs, catalogue, threshold=-4, peak_sign = '-', n_span = 5)
+    for level in range(2):
+        peeler_taylor.peel()
+    spikes_taylor = peeler_taylor.get_spikes()
+    
+    common = np.intersect1d(spikes_bank['index'][spikes_bank['level']==0], spikes_taylor['index'][spikes_taylor['level']==0])
+    print(spikes_bank.size, spikes_taylor.size, common.size)
+    assert common.size > 0.9 * np.sum(spikes_taylor['level']==0)
+    
+    # predictions recomputed from spikes use the bank
+    prediction = peeler.get_prediction(0) + peeler.get_prediction(1)
+    assert np.allclose(peakdetector.normed_sigs.values - prediction, peeler.residual, atol = 1e-4)
+
+
+def test_detect_peaks_localized():
+    dataio, peakdetector, catalogue = get_catalogue()
+    
+    peeler = Peeler(peakdetector.normed_sigs, catalogue, threshold=-4, peak_sign = '-', n_span = 5)
+    
+    # level 0 is the same as PeakDetector
+    assert np.array_equal(peeler.detect_peaks(), peakdetector.peak_pos)
+    
+    peeler.peel()
+    spike_pos = peeler.spike_pos[0]
+    full = peeler.detect_peaks()
+    local = peeler.detect_peaks(around = spike_pos)
+    
+    # the local scan gives the same peaks as a full scan near subtracted spikes
+    width = peeler.n_right - peeler.n_left
+    dist = np.min(np.abs(full[:, None] - spike_pos[None, :]), axis=1)
+    assert np.array_equal(local, full[dist<=width])
+    assert peeler.detect_peaks(around = np.zeros(0, dtype='int64')).size == 0
+
+
+def test_peeler_spike_table():
+    dataio, peakdetector, catalogue = get_catalogue()
+    peeler = Peeler(peakdetector.normed_sigs, catalogue, threshold=-4, peak_sign = '-', n_span = 5)
+    peeler.run(max_levels = 2)
+    
+    # the same spikes tagged with 2 segments, the cache do not mix them
+    spiketable0 = peeler.get_spike_table(seg_num = 0)
+    spiketable1 = peeler.get_spike_table(seg_num = 1)
+    assert np.all(spiketable0.spikes['segment']==0)
+    assert np.all(spiketable1.spikes['segment']==1)
+    assert peeler.get_spike_table(seg_num = 1) is spiketable1
+    k = catalogue['cluster_labels'][0]
+    assert np.array_equal(peeler.get_spiketrain(k, seg_num = 1), spiketable1.get_spiketrain(k))
+    assert set(peeler.get_spiketrains(seg_num = 1).keys()) == set(catalogue['cluster_labels'])
+    
+    # a new level clears the cache
+    peeler.peel()
+    assert peeler.get_spike_table(seg_num = 1) is not spiketable1
+
+
+def test_peeler_run():
+    dataio, peakdetector, catalogue = get_catalogue()
+    
+    peeler = Peeler(peakdetector.normed_sigs, catalogue, threshold=-4, peak_sign = '-', n_span = 5)
+    stats = peeler.run(max_levels = 10, min_new_spikes = 5)
+    print(stats)
+    assert stats.shape[0] == peeler.level
+    assert stats.shape[0]==10 or stats['nb_spike'].iloc[-1]<5
+    assert np.all(stats['nb_spike'].iloc[:-1]>=5)
+    assert stats['energy_reduction'].iloc[0]>0
+    
+    # energy computed from local windows is the true energy of residual
+    assert np.allclose(stats['residual_energy'].iloc[-1], np.sum(peeler.residual**2))
+    energy0 = np.sum(peakdetector.normed_sigs.values.astype('float64')**2)
+    assert np.allclose(energy0 - stats['energy_reduction'].sum(), np.sum(peeler.residual**2))
+
+
+def test_residuals_retention(tmp_path):
+    dataio, peakdetector, catalogue = get_catalogue()
+    signals = peakdetector.normed_sigs
+    
+    all_residuals = {}
+    for retention in ['latest', 'all', 'memmap']:
+        peeler = Peeler(signals, catalogue, threshold=-4, peak_sign = '-', n_span = 5,
+                    residuals_retention = retention, memmap_dirname = str(tmp_path))
+        for level in range(3):
+            peeler.peel()
+        all_residuals[retention] = [peeler.get_residuals(level).values.copy() for level in range(3)]
+        if retention == 'memmap':
+            filenames = list(peeler.memmap_filenames.values())
+            assert len(set(filenames)) == 3
+            # another Peeler in the same directory do not overwrite files
+            peeler2 = Peeler(signals*2, catalogue, threshold=-4, peak_sign = '-', n_span = 5,
+                    residuals_retention = retention, memmap_dirname = str(tmp_path))
+            peeler2.peel()
+            peeler2.peel()
+            assert np.allclose(peeler.get_residuals(0).values, all_residuals[retention][0])
+            peeler2.close()
+            peeler.close()
+            assert not any(os.path.exists(f) for f in filenames)
+    
+    for level in range(3):
+        # recomputed on demand are the same as kept ones
+        assert np.allclose(all_residuals['latest'][level], all_residuals['all'][level])
+        assert np.allclose(all_residuals['memmap'][level], all_residuals['all'][level])
+
+
+def test_streaming_peeler(capsys):
+    dataio, peakdetector, catalogue = get_catalogue()
+    
+    # in memory peeler on the whole segment
+    peeler = Peeler(peakdetector.normed_sigs, catalogue, threshold=-4, peak_sign = '-', n_span = 5)
+    for level in range(2):
+        peeler.peel()
+    spikes_memory = peeler.get_spikes()
+    
+    # streaming peeler chunk by chunk (noise is estimated on the whole segment to compare)
+    streamingpeeler = StreamingPeeler(dataio, catalogue, chunksize = 20000, nb_level = 2, noise_chunksize = peakdetector.sigs.shape[0],
+                        threshold=-4, peak_sign = '-', n_span = 5)
+    capsys.readouterr()
+    streamingpeeler.run(seg_nums = [0])
+    assert 'Apply level' not in capsys.readouterr().out
+    spikes = dataio.get_spikes(seg_num = 0)
+    
+    assert np.all(np.diff(spikes['index'])>=0)
+    common = np.intersect1d(spikes_memory['index'], spikes['index'])
+    print(spikes_memory.size, spikes.size, common.size)
+    assert common.size > 0.9 * spikes_memory.size
+    
+    # spikes are persisted with the compact dtype
+    assert spikes.dtype == np.dtype(spike_dtype)
+    assert np.all(spikes['segment']==0)
+    spiketable = dataio.get_spike_table(seg_num = 0, cluster_labels = catalogue['cluster_labels'])
+    for k in catalogue['cluster_labels']:
+        assert np.array_equal(spiketable.get_spiketrain(k), spikes['index'][spikes['label']==k])
+
+
+def bench_streaming_peeler_parallel(n_jobs_list = [1, 2, 4]):
+    # throughput of StreamingPeeler.run_parallel, not a test: it depends on the machine load
+    dataio, peakdetector, catalogue = get_catalogue()
+    nb_sample = sum(dataio.get_segment_shape(seg_num)[0] for seg_num in dataio.segments.index)
+    for n_jobs in n_jobs_list:
+        streamingpeeler = StreamingPeeler(dataio, catalogue, chunksize = 20000, nb_level = 2, n_jobs = n_jobs,
+                            threshold=-4, peak_sign = '-', n_span = 5)
+        t0 = time.perf_counter()
+        streamingpeeler.run()
+        t1 = time.perf_counter()
+        print('n_jobs={} {:.2f}s {:.0f} samples/s'.format(n_jobs, t1-t0, nb_sample/(t1-t0)))
+    for seg_num in dataio.segments.index:
+        dataio.remove_signals_memmap(seg_num)
+
+
+def test_streaming_peeler_parallel():
+    dataio, peakdetector, catalogue = get_catalogue()
+    
+    seg_nums = dataio.segments.index[:2]
+    all_spikes = {}
+    for n_jobs in [1, 2]:
+        streamingpeeler = StreamingPeeler(dataio, catalogue, chunksize = 20000, nb_level = 2, n_jobs = n_jobs,
+                            threshold=-4, peak_sign = '-', n_span = 5)
+        streamingpeeler.run(seg_nums = seg_nums)
+        all_spikes[n_jobs] = [dataio.get_spikes(seg_num = seg_num) for seg_num in seg_nums]
+    # workers read signals through a memmap exported once
+    for seg_num in seg_nums:
+        assert os.path.exists(os.path.join(dataio.dirname, 'segment_{}_signals.raw'.format(seg_num)))
+        dataio.remove_signals_memmap(seg_num)
+    
+    for spikes1, spikes2 in zip(all_spikes[1], all_spikes[2]):
+        assert spikes1.shape == spikes2.shape
+        assert np.array_equal(spikes1['index'], spikes2['index'])
+        assert np.array_equal(spikes1['label'], spikes2['label'])
+
+
+class InterruptedStreamingPeeler(StreamingPeeler):
+    # simulate a crash after 2 chunks of each segment
+    def chunk_limits(self, seg_num, start = 0):
+        return StreamingPeeler.chunk_limits(self, seg_num, start = start)[:2]
+
+
+def test_streaming_peeler_resume():
+    dataio, peakdetector, catalogue = get_catalogue()
+    params = dict(chunksize = 10000, nb_level = 2, threshold=-4, peak_sign = '-', n_span = 5)
+    
+    streamingpeeler = StreamingPeeler(dataio, catalogue, **params)
+    streamingpeeler.run(seg_nums = [0])
+    spikes_ref = dataio.get_spikes(seg_num = 0)
+    checkpoint = dataio.load_peeler_checkpoint()
+    assert checkpoint[0]['i_stop'] == dataio.get_segment_shape(0)[0]
+    assert checkpoint[0]['nb_spike'] == spikes_ref.size
+    
+    # interrupted run, then spikes of a chunk written but not checkpointed
+    streamingpeeler = InterruptedStreamingPeeler(dataio, catalogue, **params)
+    streamingpeeler.run(seg_nums = [0])
+    checkpoint = dataio.load_peeler_checkpoint()
+    assert checkpoint[0]['i_stop'] == 20000
+    dataio.append_spikes(spikes_ref[-5:], seg_num = 0)
+    
+    streamingpeeler = StreamingPeeler(dataio, catalogue, **params)
+    streamingpeeler.run(seg_nums = [0], resume = True)
+    spikes = dataio.get_spikes(seg_num = 0)
+    assert np.array_equal(spikes, spikes_ref)
+    
+    # resume a finished segment do nothing
+    streamingpeeler.run(seg_nums = [0], resume = True)
+    assert np.array_equal(dataio.get_spikes(seg_num = 0), spikes_ref)
+    
+    # a new run (not resume) interrupted after a finished run, then resume:
+    # the old checkpoint must not skip the segment
+    streamingpeeler = InterruptedStreamingPeeler(dataio, catalogue, **params)
+    streamingpeeler.run(seg_nums = [0])
+    assert dataio.load_peeler_checkpoint()[0]['i_stop'] == 20000
+    streamingpeeler = StreamingPeeler(dataio, catalogue, **params)
+    streamingpeeler.run(seg_nums = [0], resume = True)
+    assert np.array_equal(dataio.get_spikes(seg_num = 0), spikes_ref)
+    
+    # crash before the first checkpoint of a new run
+    class CrashingStreamingPeeler(StreamingPeeler):
+        def save_checkpoint(self, seg_num, i_stop):
+            raise RuntimeError('crash')
+    streamingpeeler = CrashingStreamingPeeler(dataio, catalogue, **params)
+    try:
+        streamingpeeler.run(seg_nums = [0])
+    except RuntimeError:
+        pass
+    assert 0 not in dataio.load_peeler_checkpoint()
+    streamingpeeler = StreamingPeeler(dataio, catalogue, **params)
+    streamingpeeler.run(seg_nums = [0], resume = True)
+    assert np.array_equal(dataio.get_spikes(seg_num = 0), spikes_ref)
+
+
+def test_streaming_peeler_drift(tmp_path):
+    # catalogue with 3 known templates and signals where their amplitude drift
+    n_left, n_right, nb_channel = -10, 20, 4
+    t = np.arange(n_left-2, n_right+2)
+    shape = -np.exp(-(t/2.)**2) + 0.3*np.exp(-((t-6)/4.)**2)
+    amps = np.array([[12., 6., 2., 0.], [2., 10., 8., 2.], [0., 3., 7., 14.]])
+    templates = [compute_template(amp[None, :, None]*shape[None, None, :]) for amp in amps]
+    catalogue = {'cluster_labels' : np.arange(3), 'limit_left' : n_left, 'limit_right' : n_right, 'nb_channel' : nb_channel}
+    for i, key in enumerate(['center', 'centerD', 'centerDD', 'mad']):
+        catalogue[key] = np.array([tpl[i] for tpl in templates])
+    center0 = catalogue['center'].copy()
     
+    nb_sample = 100000
+    sigs = np.random.randn(nb_sample, nb_channel).astype('float32')
+    spike_pos = np.sort(np.random.choice(np.arange(100, nb_sample-100, 100), 600, replace = False))
+    spike_cluster = np.random.randint(0, 3, size = spike_pos.size)
+    gains = 1. + 0.8*spike_pos/nb_sample
+    wfs = catalogue['center'].reshape(3, nb_channel, n_right-n_left).transpose(0, 2, 1)
+    for pos, k, gain in zip(spike_pos, spike_cluster, gains):
+        sigs[pos+n_left:pos+n_right, :] += gain*wfs[k]
+    
+    dataio = DataIO(dirname = os.path.join(str(tmp_path), 'datatest_drift'))
+    dataio.append_signals(sigs, seg_num = 0, sampling_rate = 10000., already_hp_filtered = True,
+                    channels = ['ch{}'.format(c) for c in range(nb_channel)])
+    
+    params = dict(chunksize = 10000, nb_level = 2, noise_chunksize = nb_sample, track_drift = True,
+                    threshold=-4, peak_sign = '-', n_span = 5)
+    
+    # only flags
+    streamingpeeler = StreamingPeeler(dataio, catalogue, drift_alpha = 0., **params)
+    streamingpeeler.run(seg_nums = [0])
+    stats_static = streamingpeeler.get_drift_stats()
+    assert streamingpeeler.drifting_clusters == {0, 1, 2}
+    assert np.array_equal(streamingpeeler.catalogue['center'], center0)
+    
+    # centers follow the drift
+    streamingpeeler = StreamingPeeler(dataio, catalogue, drift_alpha = 0.3, **params)
+    streamingpeeler.run(seg_nums = [0])
+    stats = streamingpeeler.get_drift_stats()
+    print(stats.groupby('i_start')['residual_energy'].mean())
+    assert len(streamingpeeler.drifting_clusters) == 0
+    last = stats['i_start'] == stats['i_start'].max()
+    assert stats[last]['residual_energy'].mean() < stats_static[last]['residual_energy'].mean()
+    amplitude_ratio = np.min(streamingpeeler.catalogue['center'], axis=1)/np.min(center0, axis=1)
+    assert np.all(amplitude_ratio > 1.3)
+    # the catalogue given is not modified
+    assert np.array_equal(catalogue['center'], center0)
+    
+    spikes = dataio.get_spikes(seg_num = 0)
+    assert np.mean(np.isin(spike_pos, spikes['index'])) > 0.95
+    
+    # interrupted then resumed: same spikes, centers and stats as the run above
+    interrupted = InterruptedStreamingPeeler(dataio, catalogue, drift_alpha = 0.3, **params)
+    interrupted.run(seg_nums = [0])
+    assert dataio.load_peeler_checkpoint()[0]['i_stop'] == 20000
+    resumed = StreamingPeeler(dataio, catalogue, drift_alpha = 0.3, **params)
+    resumed.run(seg_nums = [0], resume = True)
+    assert np.array_equal(dataio.get_spikes(seg_num = 0), spikes)
+    assert np.array_equal(resumed.catalogue['center'], streamingpeeler.catalogue['center'])
+    assert resumed.get_drift_stats().equals(stats)
+    assert resumed.drifting_clusters == streamingpeeler.drifting_clusters
+
+
 if __name__=='__main__':
     
     #~ plot_interpolation()
     
     test_peeler()
     
+    #~ bench_streaming_peeler_parallel()
+    
     pyplot.show()
@@ -0,0 +1,86 @@
+import os
+import tempfile
+import json
+import numpy as np
+import pytest
+
+from tridesclous import DataIO, Pipeline
+
+
+def setup_dataio(dirname):
+    sigs = DataIO(dirname = 'datatest').get_signals(seg_num=0).values
+    dataio = DataIO(dirname = dirname)
+    for seg_num in range(2):
+        dataio.append_signals(sigs[seg_num*50000:seg_num*50000+100000], seg_num = seg_num, sampling_rate = 10000.,
+                        already_hp_filtered = True, channels = ['ch{}'.format(c) for c in range(sigs.shape[1])])
+    dataio.store.close()
+
+
+def test_pipeline(tmp_path):
+    dirname = os.path.join(str(tmp_path), 'datatest_pipeline')
+    setup_dataio(dirname)
+    params = {
+        'dataio' : {'dirname' : dirname},
+        'find_clusters' : {'n_clusters' : 5},
+        'peel' : {'chunksize' : 30000, 'nb_level' : 2},
+    }
+    
+    # dirname is required
+    with pytest.raises(AssertionError, match = 'dirname is required'):
+        Pipeline({'find_clusters' : {'n_clusters' : 5}})
+    
+    pipeline = Pipeline(params, trace_memory = True)
+    report = pipeline.run()
+    print(report)
+    assert np.all(report['status']=='done')
+    assert np.all(report['time']>0)
+    assert np.all(report['peak_memory']>0)
+    spikes = pipeline.dataio.get_spikes(seg_num=1)
+    assert spikes.size > 0
+    labels = pipeline.dataio.store['pipeline/labels'].values
+    pipeline.dataio.store.close()
+    
+    # all done: nothing is run again (params from a file)
+    filename = os.path.join(dirname, 'params.json')
+    with open(filename, 'w') as f:
+        json.dump(params, f)
+    pipeline = Pipeline(filename)
+    report = pipeline.run()
+    print(report)
+    assert np.all(report['status']=='skipped')
+    assert np.all(np.isnan(report['time'])) and np.all(np.isnan(report['peak_memory']))
+    assert np.array_equal(pipeline.dataio.get_spikes(seg_num=1), spikes)
+    pipeline.dataio.store.close()
+    
+    # new clustering parameters: only find_clusters and next stages
+    params['find_clusters']['n_clusters'] = 4
+    pipeline = Pipeline(params)
+    report = pipeline.run()
+    print(report)
+    assert list(report['status']) == ['skipped']*3 + ['done']*3
+    assert np.all(np.isnan(report['peak_memory'].values[3:]))
+    assert pipeline.catalogue['cluster_labels'].size == 4
+    pipeline.dataio.store.close()
+    
+    # failure in the peel stage, then resume
+    params['peel']['engine'] = 'unknown'
+    pipeline = Pipeline(params)
+    try:
+        pipeline.run()
+        raise AssertionError('the peel stage must fail')
+    except AssertionError as e:
+        assert 'Unknown engine' in str(e)
+    assert pipeline.load_state()['peel']['status'] == 'started'
+    pipeline.dataio.store.close()
+    
+    params['peel']['engine'] = 'peeler'
+    pipeline = Pipeline(params)
+    report = pipeline.run()
+    print(report)
+    assert list(report['status']) == ['skipped']*5 + ['done']
+    assert pipeline.dataio.get_spikes(seg_num=0).size > 0
+    pipeline.dataio.store.close()
+
+
+if __name__ == '__main__':
+    test_pipeline(tempfile.mkdtemp())
@@ -1,5 +1,9 @@
+import os
+import tempfile
+import numpy as np
+
 from tridesclous import DataIO, PeakDetector, WaveformExtractor, Clustering, Peeler
-from tridesclous import SpikeSorter
+from tridesclous import SpikeSorter, PeakTable
 
 
 def test_spikesorter():
@@ -10,8 +14,66 @@ def test_spikesorter():
     print(spikesorter.summary(level=1))
     spikesorter.project(method = 'pca', n_components = 5)
     spikesorter.find_clusters(7)
+    assert np.array_equal(spikesorter.all_peaks.label, spikesorter.clustering.labels.values)
+    
+    # edits keep all_peaks and cluster summaries in sync
+    spikesorter.merge_cluster(1, 2)
+    spikesorter.split_cluster(3, 2)
+    spikesorter.reassign_peaks(spikesorter.cluster_indices[0][:5], 1)
+    spikesorter.undo()
+    spikesorter.redo()
+    labels = spikesorter.all_peaks.label
+    assert np.array_equal(labels, spikesorter.clustering.labels.values)
+    assert np.array_equal(spikesorter.cluster_labels, np.unique(labels))
+    for k in spikesorter.cluster_labels:
+        assert spikesorter.cluster_count[k] == np.sum(labels==k)
+    spikesorter.refresh_colors()
+    assert set(spikesorter.colors.keys()) == set(spikesorter.cluster_labels)
 
 
+def test_detect_peaks_extract_waveforms(tmp_path):
+    # one segment: same as PeakDetector and WaveformExtractor
+    spikesorter = SpikeSorter(dirname = 'datatest')
+    spikesorter.detect_peaks_extract_waveforms(threshold=-4, peak_sign = '-', n_span = 2,  n_left=-30, n_right=50)
+    
+    sigs = spikesorter.dataio.get_signals(seg_num=0)
+    peakdetector = PeakDetector(sigs, seg_num=0)
+    peakdetector.detect_peaks(threshold=-4, peak_sign = '-', n_span = 2)
+    waveformextractor = WaveformExtractor(peakdetector, n_left=-30, n_right=50)
+    limit_left, limit_right = waveformextractor.find_good_limits(mad_threshold = 1.1)
+    short_wf = waveformextractor.get_ajusted_waveforms()
+    assert (spikesorter.limit_left, spikesorter.limit_right) == (limit_left, limit_right)
+    assert np.array_equal(spikesorter.all_waveforms.index.get_level_values(1), short_wf.index.get_level_values(1))
+    assert np.array_equal(spikesorter.all_waveforms.columns.values, short_wf.columns.values)
+    assert np.allclose(spikesorter.all_waveforms.values, short_wf.values)
+    assert isinstance(spikesorter.all_peaks, PeakTable)
+    assert np.array_equal(spikesorter.all_peaks.get_times(), spikesorter.all_waveforms.index.get_level_values(1))
+    assert np.all(spikesorter.all_peaks.label==-1)
     
+    # several segments split in chunks, with and without a process pool
+    sigs = sigs.values
+    dataio = DataIO(dirname = os.path.join(str(tmp_path), 'datatest_multiseg'))
+    for seg_num in range(3):
+        dataio.append_signals(sigs[seg_num*20000:seg_num*20000+90000], seg_num = seg_num, sampling_rate = 10000.,
+                        already_hp_filtered = True, channels = ['ch{}'.format(c) for c in range(sigs.shape[1])])
+    
+    all_waveforms = {}
+    for n_jobs in [1, 2]:
+        spikesorter = SpikeSorter(dataio = dataio)
+        spikesorter.detect_peaks_extract_waveforms(threshold=-4, peak_sign = '-', n_span = 2,  n_left=-30, n_right=50,
+                                    n_jobs = n_jobs, chunksize = 25000)
+        all_waveforms[n_jobs] = spikesorter.all_waveforms
+    assert all_waveforms[1].equals(all_waveforms[2])
+    seg_nums = all_waveforms[1].index.get_level_values(0)
+    assert np.array_equal(np.unique(seg_nums), [0, 1, 2])
+    assert np.all(np.diff(seg_nums)>=0)
+    
+    # chunks give the peaks of whole segments
+    spikesorter.detect_peaks_extract_waveforms(threshold=-4, peak_sign = '-', n_span = 2,  n_left=-30, n_right=50)
+    print(all_waveforms[1].shape, spikesorter.all_waveforms.shape)
+    assert abs(all_waveforms[1].shape[0] - spikesorter.all_waveforms.shape[0]) < 0.05*spikesorter.all_waveforms.shape[0]
+
+
 if __name__ == '__main__':
     test_spikesorter()
+    test_detect_peaks_extract_waveforms(tempfile.mkdtemp())
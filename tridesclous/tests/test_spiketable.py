@@ -0,0 +1,37 @@
+import numpy as np
+from tridesclous import make_spikes, SpikeTable, spike_dtype
+
+
+
+def test_spiketable():
+    n = 10000
+    index = np.random.randint(0, 1000000, size=n)
+    labels = np.random.randint(0, 5, size=n)
+    jitters = np.random.rand(n)-0.5
+    levels = np.random.randint(0, 3, size=n)
+    
+    spikes = make_spikes(index, labels, jitters, levels, segment = 2)
+    assert spikes.dtype == np.dtype(spike_dtype)
+    assert spikes.dtype.itemsize == 17
+    assert np.all(np.diff(spikes['index'])>=0)
+    assert np.all(spikes['segment']==2)
+    
+    # cluster 7 is in the catalogue but without spikes
+    spiketable = SpikeTable(spikes, cluster_labels = [0, 1, 2, 3, 4, 7])
+    assert len(spiketable) == n
+    for k in range(5):
+        spiketrain = spiketable.get_spiketrain(k)
+        assert np.array_equal(spiketrain, np.sort(index[labels==k]))
+        # zero copy
+        assert spiketrain.base is not None
+        assert np.shares_memory(spiketrain, spiketable.cluster_spike_index)
+    assert spiketable.get_spiketrain(7).size == 0
+    
+    spiketrains = spiketable.get_spiketrains()
+    assert sum(v.size for v in spiketrains.values()) == n
+    
+    assert spiketable.get_spikes_by_level(1).size == np.sum(levels==1)
+
+
+if __name__ == '__main__':
+    test_spiketable()
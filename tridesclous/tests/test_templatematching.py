@@ -0,0 +1,89 @@
+import numpy as np
+import pandas as pd
+
+from tridesclous import Peeler, TemplateMatcher, StreamingPeeler
+
+from testingtools import get_catalogue
+
+
+def test_template_matching():
+    dataio, peakdetector, catalogue = get_catalogue()
+    
+    # synthetic signals with known spikes (some overlapping) and small noise
+    nb_cluster = catalogue['cluster_labels'].size
+    nb_channel = catalogue['nb_channel']
+    n_left, n_right = catalogue['limit_left'], catalogue['limit_right']
+    templates = catalogue['center'].reshape(nb_cluster, nb_channel, n_right-n_left).transpose(0, 2, 1)
+    sigs = np.random.randn(30000, nb_channel)*0.2
+    spike_pos = np.sort(np.random.choice(np.arange(100, 29900, 9), 150, replace = False))
+    spike_cluster = np.random.randint(0, nb_cluster, size = spike_pos.size)
+    for pos, k in zip(spike_pos, spike_cluster):
+        sigs[pos+n_left:pos+n_right, :] += templates[k]
+    
+    # nfft small to have several overlap-save blocks
+    matcher = TemplateMatcher(pd.DataFrame(sigs), catalogue, nfft = 256)
+    spikes = matcher.run()
+    print(matcher.nb_iter, spikes.size, spike_pos.size)
+    
+    assert np.all(np.diff(spikes['index'])>=0)
+    found = np.isin(spike_pos, spikes['index'])
+    print('found', np.mean(found))
+    assert np.mean(found) > 0.85
+    labels = dict(zip(spikes['index'], spikes['label']))
+    ok = [labels[pos]==catalogue['cluster_labels'][k] for pos, k in zip(spike_pos[found], spike_cluster[found])]
+    assert np.mean(ok) > 0.9
+    
+    # residual energy decrease
+    assert np.sum(matcher.residual**2) < np.sum(sigs**2)
+    assert np.all(spikes['jitter']==0)
+    
+    # gains updated around subtracted spikes are the same as a full computation
+    best_gains, best_clusters = matcher.compute_best_gains()
+    assert np.allclose(matcher.best_gains, best_gains)
+    
+    # and greedy iterations give the same spikes as with gains computed on the whole residual
+    reference = TemplateMatcher(pd.DataFrame(sigs), catalogue, nfft = 256)
+    all_pos = []
+    for i in range(reference.max_iter):
+        pos, cluster_idx = reference.pick_spikes(*reference.compute_best_gains())
+        if pos.size == 0:
+            break
+        reference.subtract(pos, cluster_idx)
+        all_pos.append(pos - reference.n_left)
+    assert np.array_equal(np.sort(np.concatenate(all_pos)), spikes['index'])
+    
+    # on real data it find the spikes of the peeler
+    matcher = TemplateMatcher(peakdetector.normed_sigs, catalogue)
+    spikes = matcher.run()
+    peeler = Peeler(peakdetector.normed_sigs, catalogue, threshold=-4, peak_sign = '-', n_span = 5)
+    peeler.peel()
+    spikes_peeler = peeler.get_spikes()
+    common = np.intersect1d(spikes['index'], spikes_peeler['index'])
+    print(spikes.size, spikes_peeler.size, common.size)
+    assert common.size > 0.5 * spikes_peeler.size
+
+
+def test_streaming_template_matching():
+    dataio, peakdetector, catalogue = get_catalogue()
+    streamingpeeler = StreamingPeeler(dataio, catalogue, chunksize = 20000, nb_level = 5, engine = 'templatematching')
+    streamingpeeler.run(seg_nums = [0])
+    spikes = dataio.get_spikes(seg_num = 0)
+    assert spikes.size > 0
+    assert np.all(np.diff(spikes['index'])>=0)
+    
+    # detection parameters of the Peeler are ignored, others are refused
+    streamingpeeler = StreamingPeeler(dataio, catalogue, chunksize = 20000, nb_level = 5, engine = 'templatematching',
+                        threshold=-4, peak_sign = '-', n_span = 5, min_gain_ratio = 0.5)
+    streamingpeeler.run(seg_nums = [0])
+    assert np.array_equal(dataio.get_spikes(seg_num = 0), spikes)
+    streamingpeeler = StreamingPeeler(dataio, catalogue, chunksize = 20000, engine = 'templatematching', lowrank = True)
+    try:
+        streamingpeeler.run(seg_nums = [0])
+        raise AssertionError('lowrank is not a template matching parameter')
+    except AssertionError as e:
+        assert 'not available with engine=templatematching' in str(e)
+
+
+if __name__ == '__main__':
+    test_template_matching()
+    test_streaming_template_matching()
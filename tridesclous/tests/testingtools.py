@@ -0,0 +1,47 @@
+from tridesclous import DataIO, PeakDetector, WaveformExtractor, Clustering
+
+
+def get_clustering(dirname = 'datatest', seg_num = 0, n_span = 2, margin = 2):
+    """
+    Clustering of the waveforms of one segment of the test dataset, with
+    features projected (pca, 5 components) but not clustered.
+    
+    Returns
+    ----------
+    dataio: DataIO
+    peakdetector: PeakDetector
+        With peaks detected (threshold=-4, peak_sign='-', n_span)
+    clustering: Clustering
+    """
+    dataio = DataIO(dirname = dirname)
+    sigs = dataio.get_signals(seg_num = seg_num)
+    
+    peakdetector = PeakDetector(sigs, seg_num = seg_num)
+    peakdetector.detect_peaks(threshold=-4, peak_sign = '-', n_span = n_span)
+    waveformextractor = WaveformExtractor(peakdetector, n_left=-30, n_right=50)
+    waveformextractor.find_good_limits(mad_threshold = 1.1)
+    short_wf = waveformextractor.get_ajusted_waveforms(margin = margin)
+    
+    clustering = Clustering(short_wf)
+    clustering.project(method = 'pca', n_components = 5)
+    
+    return dataio, peakdetector, clustering
+
+
+def get_catalogue(dirname = 'datatest', seg_num = 0, n_clusters = 7):
+    """
+    Catalogue of one segment of the test dataset, shared by tests of the Peeler
+    and of other engines.
+    
+    Returns
+    ----------
+    dataio: DataIO
+    peakdetector: PeakDetector
+        With peaks detected (threshold=-4, peak_sign='-', n_span=5)
+    catalogue: dict
+    """
+    dataio, peakdetector, clustering = get_clustering(dirname = dirname, seg_num = seg_num, n_span = 5)
+    clustering.find_clusters(n_clusters)
+    catalogue = clustering.construct_catalogue()
+    
+    return dataio, peakdetector, catalogue